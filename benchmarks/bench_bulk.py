@@ -0,0 +1,135 @@
+"""
+Benchmark bulk() and the planner end to end against the fake GCS and
+BigQuery backend in fake_gcp.py, without GCP access.
+
+    PYTHONPATH=. python benchmarks/bench_bulk.py --days 30 \\
+        --partitions 10 --files 50 -c 1 -c 4 -c 8 --job-latency 0.05
+
+Every run uses the same synthetic inventory and seeded error draws, so
+results are comparable between commits.
+"""
+import argparse
+import json
+import logging
+import resource
+import tempfile
+import time
+
+from fake_gcp import FakeBackend, FakeInventory
+from parquet2bigquery.clients import set_client_factory
+from parquet2bigquery.lib import bulk
+from parquet2bigquery.plan import build_plan
+
+
+PREFIX = 'table_0/v1'
+
+
+def max_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+def bench_plan(args):
+    started = time.perf_counter()
+    plan = build_plan('fake-bucket', PREFIX, args.glob_load, False,
+                      list_workers=args.list_workers)
+    elapsed = time.perf_counter() - started
+
+    return {
+        'name': 'plan',
+        'items': plan['totals']['items'],
+        'objects': plan['totals']['objects'],
+        'seconds': elapsed,
+        'items_per_second': plan['totals']['items'] / elapsed,
+        'main_rss_mb': max_rss_mb(resource.RUSAGE_SELF),
+    }
+
+
+def bench_bulk(args, concurrency):
+    with tempfile.NamedTemporaryFile(suffix='.json') as report:
+        started = time.perf_counter()
+        bulk('fake-bucket', PREFIX, concurrency, args.glob_load, False,
+             inflight=args.inflight, pipeline=args.pipeline,
+             list_workers=args.list_workers, poll_interval=args.job_latency,
+             backoff_base=0.01, backoff_max=0.1,
+             progress_interval=args.progress_interval,
+             report=report.name)
+        elapsed = time.perf_counter() - started
+        with open(report.name) as f:
+            run_report = json.load(f)
+
+    counters = run_report['counters']
+    return {
+        'name': 'bulk',
+        'concurrency': concurrency,
+        'items': counters.get('items_done', 0),
+        'failed': counters.get('items_failed', 0),
+        'retries': counters.get('retries', 0),
+        'seconds': elapsed,
+        'items_per_second': counters.get('items_done', 0) / elapsed,
+        'main_rss_mb': max_rss_mb(resource.RUSAGE_SELF),
+        'worker_rss_mb': max_rss_mb(resource.RUSAGE_CHILDREN),
+        'stages': dict((stage, data['mean'])
+                       for stage, data in run_report['stages'].items()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tables", default=1, type=int)
+    parser.add_argument("--days", default=30, type=int)
+    parser.add_argument("--partitions", default=10, type=int,
+                        help="Extra partitions per day")
+    parser.add_argument("--files", default=50, type=int,
+                        help="Files per partition")
+    parser.add_argument("-c", "--concurrency", default=[], type=int,
+                        action="append",
+                        help="Process concurrency, can be repeated")
+    parser.add_argument("-i", "--inflight", default=4, type=int)
+    parser.add_argument("--pipeline", default=False, action="store_true")
+    parser.add_argument("-G", "--no-glob-load", dest='glob_load',
+                        default=True, action="store_false")
+    parser.add_argument("--list-workers", default=8, type=int)
+    parser.add_argument("--api-latency", default=0.0, type=float,
+                        help="Seconds per API call")
+    parser.add_argument("--job-latency", default=0.01, type=float,
+                        help="Seconds until a job is done")
+    parser.add_argument("--error-rate", default=0.0, type=float,
+                        help="Rate of retryable job errors")
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--progress-interval", default=3600.0, type=float)
+    parser.add_argument("--plan-only", default=False, action="store_true")
+    parser.add_argument("--json", default=False, action="store_true",
+                        help="Print the results as JSON lines")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    inventory = FakeInventory(tables=args.tables, days=args.days,
+                              partitions=args.partitions, files=args.files,
+                              seed=args.seed)
+    set_client_factory(FakeBackend(inventory=inventory,
+                                   api_latency=args.api_latency,
+                                   job_latency=args.job_latency,
+                                   error_rate=args.error_rate,
+                                   seed=args.seed))
+
+    results = [bench_plan(args)]
+    if not args.plan_only:
+        for concurrency in args.concurrency or [1, 4]:
+            results.append(bench_bulk(args, concurrency))
+
+    for result in results:
+        if args.json:
+            print(json.dumps(result, sort_keys=True))
+            continue
+        print('{:5} c={:<3} {:>9} items {:8.2f}s {:>10,.1f} items/s '
+              'rss main {:.0f}MB workers {:.0f}MB'.format(
+                  result['name'], result.get('concurrency', '-'),
+                  result['items'], result['seconds'],
+                  result['items_per_second'], result['main_rss_mb'],
+                  result.get('worker_rss_mb', 0)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark the memory and lookup time of an Inventory against the sets
+and dicts of full keys it replaces, on a synthetic hive partitioned
+listing.
+
+    PYTHONPATH=. python benchmarks/bench_inventory.py --days 365 \\
+        --partitions 100 --files 50
+"""
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+
+from fake_gcp import FakeInventory
+from parquet2bigquery.inventory import Inventory
+from parquet2bigquery.lib import blob_fingerprint
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - started
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, elapsed
+
+
+def lookups(container, keys):
+    started = time.perf_counter()
+    for key in keys:
+        key in container
+    return len(keys) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", default=100, type=int)
+    parser.add_argument("--partitions", default=100, type=int)
+    parser.add_argument("--files", default=50, type=int)
+    parser.add_argument("--lookups", default=100000, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    args = parser.parse_args()
+
+    listing = FakeInventory(days=args.days, partitions=args.partitions,
+                            files=args.files, seed=args.seed)
+
+    def _records():
+        # every container gets its own key strings, like a listing
+        for blob in listing.list('table_0/v1/'):
+            yield blob.name, blob_fingerprint(blob)
+
+    keys = [key for key, _ in _records()]
+    sample = random.Random(args.seed).sample(keys,
+                                             min(args.lookups, len(keys)))
+    del keys
+
+    def _inventory():
+        inventory = Inventory.from_records(_records())
+        # the lookup index is built on the first lookup
+        inventory.find('')
+        return inventory
+
+    results = [
+        ('set', measure(lambda: set(key for key, _ in _records()))),
+        ('dict', measure(lambda: dict(_records()))),
+        ('inventory', measure(_inventory)),
+    ]
+
+    for name, (container, size, elapsed) in results:
+        print('{:10} {:8.1f}MB {:6.1f} bytes/object built in {:6.2f}s '
+              '{:>12,.0f} lookups/s'.format(
+                  name, size / 1e6, size / len(container), elapsed,
+                  lookups(container, sample)))
+
+
+if __name__ == '__main__':
+    main()
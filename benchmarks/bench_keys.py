@@ -0,0 +1,102 @@
+"""
+Benchmark object key classification on synthetic hive partitioned keys.
+
+    python benchmarks/bench_keys.py --keys 10000000
+"""
+import argparse
+import random
+import re
+import time
+from dateutil.parser import parse
+from datetime import date, datetime, timedelta
+
+from parquet2bigquery.keys import (IGNORE_PATTERNS, classify_keys,
+                                   normalize_table_id)
+
+
+def gen_keys(count, days=1000, files_per_partition=50, seed=42):
+    """
+    Generate synthetic object keys, including the temp and metadata
+    objects Spark leaves behind.
+    """
+    rnd = random.Random(seed)
+    start = date(2016, 1, 1)
+
+    for i in range(count):
+        day = start + timedelta(days=(i // files_per_partition) % days)
+        prefix = 'main_summary/v4/submission_date_s3={}/sample_id={}'.format(
+            day.strftime('%Y%m%d'), (i // (files_per_partition * days)) % 100)
+        roll = rnd.random()
+        if roll < 0.01:
+            yield '{}/_SUCCESS'.format(prefix)
+        elif roll < 0.02:
+            yield '{}/_temporary/0/part-{:05d}.parquet'.format(prefix, i)
+        elif roll < 0.025:
+            yield '{}_$folder$'.format(prefix)
+        else:
+            yield '{}/part-{:05d}-{:08x}.snappy.parquet'.format(
+                prefix, i % files_per_partition, rnd.getrandbits(32))
+
+
+def legacy_classify(object_keys, exclude_regex=[]):
+    """
+    The original per key implementation, kept for comparison.
+    """
+    for object_key in object_keys:
+        if any([re.match(pat, object_key)
+                for pat in IGNORE_PATTERNS + exclude_regex]):
+            continue
+
+        split_key = object_key.split('/')
+        first_part_idx = next(iter([index for index, elem
+                                    in enumerate(split_key) if '=' in elem]))
+        table_id = normalize_table_id('_'.join(
+            split_key[first_part_idx - 2:first_part_idx]))
+        date_field, date_value = split_key[first_part_idx].split('=')
+        for date_format in ['%Y%m%d', '%Y-%m-%d']:
+            try:
+                datetime.strptime(date_value, date_format)
+                break
+            except ValueError:
+                continue
+        value = parse(date_value).strftime('%Y-%m-%d')
+        partitions = [elem.split('=')
+                      for elem in split_key[first_part_idx+1:]
+                      if '=' in elem]
+
+        yield object_key, (table_id, date_field, value, partitions)
+
+
+def bench(name, classify, count, exclude_regex):
+    start = time.perf_counter()
+    loaded = sum(1 for _ in classify(gen_keys(count), exclude_regex))
+    elapsed = time.perf_counter() - start
+
+    print('{:8} {:>10} keys {:>10} loaded {:8.2f}s '
+          '{:>12,.0f} keys/s'.format(name, count, loaded, elapsed,
+                                     count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--keys", default=10000000, type=int,
+                        help="Number of synthetic keys")
+    parser.add_argument("--legacy", default=False, action="store_true",
+                        help="Also benchmark the original implementation")
+    parser.add_argument("-x", "--exclude-regex", default=[],
+                        action="append")
+    args = parser.parse_args()
+
+    # key generation cost, subtract it from the results below
+    start = time.perf_counter()
+    sum(1 for _ in gen_keys(args.keys))
+    print('generate {:>10} keys {:8.2f}s'.format(
+        args.keys, time.perf_counter() - start))
+
+    bench('engine', classify_keys, args.keys, args.exclude_regex)
+    if args.legacy:
+        bench('legacy', legacy_classify, args.keys, args.exclude_regex)
+
+
+if __name__ == '__main__':
+    main()
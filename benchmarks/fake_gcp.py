@@ -0,0 +1,347 @@
+"""
+In-process fake GCS and BigQuery clients for offline benchmarks.
+
+The fakes implement the client calls parquet2bigquery makes, with a
+configurable latency per API call and per job, a rate of retryable API
+errors and a synthetic bucket inventory of hive partitioned keys which
+is generated while listing, so millions of keys cost no memory.
+
+    from parquet2bigquery.clients import set_client_factory
+    set_client_factory(FakeBackend(inventory=FakeInventory(days=365)))
+"""
+import itertools
+import multiprocessing
+import os
+import random
+import threading
+import time
+import zlib
+from datetime import date, datetime, timedelta
+
+import google.api_core.exceptions
+from google.cloud import bigquery
+
+
+PROJECT = 'fake-project'
+LOCATION = 'US'
+
+
+class FakeBlob(object):
+    __slots__ = ('name', 'updated', 'generation', 'size', 'crc32c')
+
+    def __init__(self, name, updated, generation, size, crc32c):
+        self.name = name
+        self.updated = updated
+        self.generation = generation
+        self.size = size
+        self.crc32c = crc32c
+
+
+class FakeInventory(object):
+    """
+    Synthetic bucket content: tables / days / extra partitions / files,
+    plus the _SUCCESS markers Spark writes. Keys are generated in
+    lexicographic order, like a GCS listing.
+
+    Blob attributes are derived from a hash of the key and the seed, so
+    the same configuration always lists the same inventory.
+    """
+
+    def __init__(self, tables=1, days=30, partitions=10, files=50,
+                 file_size=64 * 1024 * 1024, start=date(2019, 1, 1),
+                 seed=42):
+        self.seed = seed
+        self.file_size = file_size
+        self.count = tables * days * partitions * files
+
+        self._levels = [
+            sorted('table_{}/v1/'.format(i) for i in range(tables)),
+            sorted('submission_date={}/'.format(
+                (start + timedelta(days=d)).strftime('%Y%m%d'))
+                for d in range(days)),
+            sorted('sample_id={}/'.format(p) for p in range(partitions)),
+            sorted(['_SUCCESS'] + ['part-{:05d}.snappy.parquet'.format(f)
+                                   for f in range(files)]),
+        ]
+
+    def _blob(self, name):
+        h = zlib.crc32(name.encode('utf-8'), self.seed)
+        return FakeBlob(name,
+                        datetime(2019, 1, 1) + timedelta(seconds=h % 86400),
+                        h,
+                        0 if name.endswith('_SUCCESS') else
+                        self.file_size // 2 + h % self.file_size,
+                        '{:08x}'.format(h))
+
+    def _walk(self, parent, depth, prefix, delimiter, prefixes):
+        leaf = depth == len(self._levels) - 1
+
+        for name in self._levels[depth]:
+            path = parent + name
+            if not (path.startswith(prefix) or prefix.startswith(path)):
+                continue
+
+            rest = path[len(prefix):]
+            if delimiter and len(path) > len(prefix) and delimiter in rest:
+                prefixes.add(prefix + rest[:rest.index(delimiter) + 1])
+                continue
+
+            if leaf:
+                yield self._blob(path)
+            else:
+                for blob in self._walk(path, depth + 1, prefix, delimiter,
+                                       prefixes):
+                    yield blob
+
+    def list(self, prefix='', delimiter=None, prefixes=None):
+        return self._walk('', 0, prefix or '', delimiter,
+                          set() if prefixes is None else prefixes)
+
+
+class FakeBlobIterator(object):
+    """
+    Lazy listing, prefixes are populated once it has been consumed like
+    google.api_core.page_iterator.HTTPIterator.
+    """
+
+    def __init__(self, backend, prefix, delimiter):
+        self.prefixes = set()
+        self._backend = backend
+        self._blobs = backend.inventory.list(prefix, delimiter,
+                                             self.prefixes)
+
+    def __iter__(self):
+        page_size = self._backend.page_size
+        while True:
+            page = list(itertools.islice(self._blobs, page_size))
+            self._backend.call('list_blobs')
+            for blob in page:
+                yield blob
+            if len(page) < page_size:
+                return
+
+
+class FakeBucket(object):
+
+    def __init__(self, backend, name):
+        self._backend = backend
+        self.name = name
+
+    def list_blobs(self, prefix=None, delimiter=None):
+        return FakeBlobIterator(self._backend, prefix, delimiter)
+
+
+class FakeStorageClient(object):
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def bucket(self, bucket_name):
+        return FakeBucket(self._backend, bucket_name)
+
+
+class FakeJob(object):
+    """
+    A job which is done job_latency seconds after it was created.
+    """
+
+    def __init__(self, backend, job_id=None, rows=None, **stats):
+        self.job_id = job_id or '{}_{}'.format(backend.process_name,
+                                               next(backend.job_ids))
+        self.state = 'RUNNING'
+        self.error_result = None
+        self._done_at = time.time() + backend.job_latency
+        self._rows = rows or []
+        for name, value in stats.items():
+            setattr(self, name, value)
+
+    def reload(self):
+        if time.time() >= self._done_at:
+            self.state = 'DONE'
+
+    def done(self):
+        self.reload()
+        return self.state == 'DONE'
+
+    def result(self):
+        time.sleep(max(0, self._done_at - time.time()))
+        self.state = 'DONE'
+        return self._rows
+
+
+def _table_key(table_ref):
+    return '{}.{}'.format(table_ref.dataset_id,
+                          table_ref.table_id.split('$')[0])
+
+
+class FakeBigQueryClient(object):
+    """
+    Keeps tables and jobs in memory. Loads give the table the schema of
+    the synthetic Parquet files, updates are conditional on the table
+    etag and job ids must be unique like the real API. Unlike BigQuery,
+    tables and jobs are not shared between processes.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._tables = {}
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _add_job(self, job_id, **kwargs):
+        with self._lock:
+            if job_id in self._jobs:
+                raise google.api_core.exceptions.Conflict(
+                    'Job {} exists'.format(job_id))
+            job = FakeJob(self._backend, job_id, **kwargs)
+            if job_id:
+                self._jobs[job_id] = job
+            return job
+
+    def get_job(self, job_id, location=None):
+        self._backend.call('get_job')
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise google.api_core.exceptions.NotFound(
+                'Job {} not found'.format(job_id))
+        job.reload()
+        return job
+
+    def dataset(self, dataset_id):
+        return bigquery.DatasetReference(PROJECT, dataset_id)
+
+    def get_dataset(self, dataset_ref):
+        self._backend.call('get_dataset')
+        dataset = bigquery.Dataset(dataset_ref)
+        dataset.location = LOCATION
+        return dataset
+
+    def _store(self, table):
+        stored = bigquery.Table.from_api_repr(table.to_api_repr())
+        stored._properties['etag'] = str(next(self._backend.etags))
+        self._tables[_table_key(table.reference)] = stored
+        return bigquery.Table.from_api_repr(stored.to_api_repr())
+
+    def get_table(self, table_ref):
+        self._backend.call('get_table')
+        with self._lock:
+            table = self._tables.get(_table_key(table_ref))
+            if table is None:
+                raise google.api_core.exceptions.NotFound(
+                    'Table {} not found'.format(_table_key(table_ref)))
+            return bigquery.Table.from_api_repr(table.to_api_repr())
+
+    def create_table(self, table):
+        self._backend.call('create_table')
+        with self._lock:
+            if _table_key(table.reference) in self._tables:
+                raise google.api_core.exceptions.Conflict(
+                    'Table {} exists'.format(_table_key(table.reference)))
+            return self._store(table)
+
+    def update_table(self, table, fields):
+        self._backend.call('update_table')
+        with self._lock:
+            key = _table_key(table.reference)
+            current = self._tables.get(key)
+            if current is None:
+                raise google.api_core.exceptions.NotFound(key)
+            if table.etag and table.etag != current.etag:
+                raise google.api_core.exceptions.PreconditionFailed(key)
+            return self._store(table)
+
+    def delete_table(self, table_ref):
+        self._backend.call('delete_table')
+        with self._lock:
+            if self._tables.pop(_table_key(table_ref), None) is None:
+                raise google.api_core.exceptions.NotFound(
+                    _table_key(table_ref))
+
+    def load_table_from_uri(self, uri, table_ref, job_id=None,
+                            job_config=None):
+        self._backend.call('load_table_from_uri')
+        with self._lock:
+            key = _table_key(table_ref)
+            table = self._tables.get(key)
+            if table is None:
+                table = bigquery.Table(table_ref)
+            if not table.schema:
+                table.schema = self._backend.file_schema
+                self._store(table)
+
+        files = len(uri) if isinstance(uri, list) else 1
+        size = self._backend.inventory.file_size * files
+        return self._add_job(job_id, input_files=files,
+                             input_file_bytes=size, output_bytes=size * 3,
+                             output_rows=size // 100)
+
+    def query(self, query, job_config=None, job_id=None):
+        self._backend.call('query')
+        size = self._backend.inventory.file_size
+        return self._add_job(job_id, total_bytes_processed=size * 3,
+                             total_bytes_billed=size * 3)
+
+
+class FakeClientPool(object):
+    """
+    Stands in for clients.ClientPool.
+    """
+
+    def __init__(self, backend, pool_size):
+        self.pool_size = pool_size
+        self.pid = os.getpid()
+        self.bigquery = FakeBigQueryClient(backend)
+        self.storage = FakeStorageClient(backend)
+
+    def close(self):
+        pass
+
+
+class FakeBackend(object):
+    """
+    Client factory for clients.set_client_factory.
+
+    api_latency and job_latency are in seconds. error_rate is the
+    probability of a call in error_methods failing with a retryable
+    error, drawn from a generator seeded per worker process so runs are
+    repeatable.
+    """
+
+    file_schema = [
+        bigquery.SchemaField('client_id', 'STRING'),
+        bigquery.SchemaField('sample_id', 'INTEGER'),
+        bigquery.SchemaField('value', 'FLOAT'),
+    ]
+
+    def __init__(self, inventory=None, api_latency=0.0, job_latency=0.0,
+                 error_rate=0.0, page_size=1000, seed=42,
+                 error_methods=('load_table_from_uri', 'query')):
+        self.inventory = inventory or FakeInventory(seed=seed)
+        self.api_latency = api_latency
+        self.job_latency = job_latency
+        self.error_rate = error_rate
+        self.error_methods = error_methods
+        self.page_size = page_size
+        self.seed = seed
+
+    def __call__(self, pool_size):
+        # state a forked worker must not share with its parent
+        self.process_name = multiprocessing.current_process().name
+        self._random = random.Random('{}:{}'.format(self.seed,
+                                                    self.process_name))
+        self._random_lock = threading.Lock()
+        self.job_ids = itertools.count()
+        self.etags = itertools.count()
+
+        return FakeClientPool(self, pool_size)
+
+    def call(self, method):
+        if self.api_latency:
+            time.sleep(self.api_latency)
+        if self.error_rate and method in self.error_methods:
+            with self._random_lock:
+                failed = self._random.random() < self.error_rate
+            if failed:
+                raise google.api_core.exceptions.ServiceUnavailable(
+                    'fake {} error'.format(method))
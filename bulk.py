@@ -1,17 +1,39 @@
-from parquet2bigquery.lib import bulk
+from parquet2bigquery.lib import (bulk, work, DEFAULT_BATCH_MAX_URIS,
+                                  DEFAULT_LIST_WORKERS, DEFAULT_JOB_ID_PREFIX,
+                                  DEFAULT_LOAD_MODE, DEFAULT_ORDER,
+                                  DEFAULT_QUEUE_SIZE, DEFAULT_WRITE_MODE,
+                                  LOAD_MODES, ORDERS, WRITE_MODES)
+from parquet2bigquery.clients import DEFAULT_POOL_SIZE
+from parquet2bigquery.plan import build_plan
+from parquet2bigquery.executor import DEFAULT_INFLIGHT, DEFAULT_POLL_INTERVAL
+from parquet2bigquery.metrics import DEFAULT_PROGRESS_INTERVAL
+from parquet2bigquery.quota import parse_quota
+from parquet2bigquery.retry import (DEFAULT_BACKOFF_BASE, DEFAULT_BACKOFF_MAX,
+                                    DEFAULT_MAX_ATTEMPTS)
+from parquet2bigquery.locks import DEFAULT_LOCK_STRIPES
+from parquet2bigquery.sources import load_sources
 import argparse
+import json
 
 
 def main():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-b", "--bucket",
-                        help="GCS Bucket",
-                        action="store", required=True)
+                        help="GCS Bucket, not used by --worker",
+                        action="store", required=False)
 
     parser.add_argument("-p", "--prefix",
-                        help="Object Prefix",
-                        action="store", required=True)
+                        help="Object Prefix, can be repeated to load "
+                             "several tables with the same workers",
+                        default=[],
+                        action="append")
+
+    parser.add_argument("--sources",
+                        help="JSON file of prefixes with their alias, "
+                             "dataset and weight, loaded along with "
+                             "--prefix",
+                        action="store", required=False)
 
     parser.add_argument("-d", "--dataset",
                         help="BigQuery Destination Dataset",
@@ -27,6 +49,222 @@ def main():
                         type=int,
                         action="store")
 
+    parser.add_argument("-i", "--inflight",
+                        help="Objects in flight per process",
+                        default=DEFAULT_INFLIGHT,
+                        type=int,
+                        action="store")
+
+    parser.add_argument("--poll-interval",
+                        help="Seconds between BigQuery job polls",
+                        default=DEFAULT_POLL_INTERVAL,
+                        type=float,
+                        action="store")
+
+    parser.add_argument("--pool-size",
+                        help="HTTP connection pool size per process",
+                        default=DEFAULT_POOL_SIZE,
+                        type=int,
+                        action="store")
+
+    parser.add_argument("--load-mode",
+                        help="Load via a temp table (tmp), directly "
+                             "into the partition (direct) or query the "
+                             "objects as an external table (external)",
+                        default=DEFAULT_LOAD_MODE,
+                        choices=LOAD_MODES,
+                        action="store")
+
+    parser.add_argument("--write-mode",
+                        help="Append objects to their table (append) or "
+                             "replace the rows of their date and extra "
+                             "partition values (overwrite, requires "
+                             "--glob-load)",
+                        default=DEFAULT_WRITE_MODE,
+                        choices=WRITE_MODES,
+                        action="store")
+
+    parser.add_argument("--job-id-prefix",
+                        help="Prefix of deterministic job ids which let "
+                             "a restarted run reattach to earlier jobs. "
+                             "Jobs already done are not run again, "
+                             "change it to force a reload, e.g. after "
+                             "dropping the table. Random job ids if not "
+                             "set",
+                        default=DEFAULT_JOB_ID_PREFIX,
+                        action="store")
+
+    parser.add_argument("--queue-size",
+                        help="Max number of queued tasks",
+                        default=DEFAULT_QUEUE_SIZE,
+                        type=int,
+                        action="store")
+
+    parser.add_argument("--list-workers",
+                        help="Number of partitions listed concurrently",
+                        default=DEFAULT_LIST_WORKERS,
+                        type=int,
+                        action="store")
+
+    parser.add_argument("-x", "--exclude-regex",
+                        help="Ignore object keys matching this pattern, "
+                             "can be repeated",
+                        default=[],
+                        action="append")
+
+    parser.add_argument("--batch-bytes",
+                        help="Without --glob-load, load the objects of "
+                             "the same table, date and partition values "
+                             "in batches of about this many bytes",
+                        type=int,
+                        action="store", required=False)
+
+    parser.add_argument("--batch-max-uris",
+                        help="Max number of objects per batch",
+                        default=DEFAULT_BATCH_MAX_URIS,
+                        type=int,
+                        action="store")
+
+    parser.add_argument("--order",
+                        help="Queue the items of each prefix as listed "
+                             "(listing), largest first (largest) or by "
+                             "date (newest, oldest), any order but "
+                             "listing waits for listing to finish",
+                        default=DEFAULT_ORDER,
+                        choices=ORDERS,
+                        action="store")
+
+    parser.add_argument("--lock-stripes",
+                        help="Number of locks table schema updates "
+                             "are spread over",
+                        default=DEFAULT_LOCK_STRIPES,
+                        type=int,
+                        action="store")
+
+    parser.add_argument("--pipeline",
+                        help="Run the load, schema and append stages "
+                             "of each process as a pipeline",
+                        default=False,
+                        action="store_true")
+
+    parser.add_argument("--max-attempts",
+                        help="Attempts before an object is dead lettered",
+                        default=DEFAULT_MAX_ATTEMPTS,
+                        type=int,
+                        action="store")
+
+    parser.add_argument("--backoff-base",
+                        help="First retry delay in seconds",
+                        default=DEFAULT_BACKOFF_BASE,
+                        type=float,
+                        action="store")
+
+    parser.add_argument("--backoff-max",
+                        help="Max retry delay in seconds",
+                        default=DEFAULT_BACKOFF_MAX,
+                        type=float,
+                        action="store")
+
+    parser.add_argument("--dead-letter",
+                        help="File objects which ran out of attempts "
+                             "are written to",
+                        action="store", required=False)
+
+    parser.add_argument("--quota",
+                        help="Per table quota as operation=capacity/seconds "
+                             "(operations: load, query, update), "
+                             "can be repeated",
+                        default=[],
+                        type=parse_quota,
+                        action="append")
+
+    parser.add_argument("--no-admission-control",
+                        help="Do not defer work for tables out of quota",
+                        dest='admission_control',
+                        default=True,
+                        action="store_false")
+
+    parser.add_argument("-m", "--manifest",
+                        help="Local manifest file used to record and "
+                             "resume the load",
+                        action="store", required=False)
+
+    parser.add_argument("--sync",
+                        help="Only load objects which are new or changed "
+                             "since the last run, requires --manifest, "
+                             "and --sync-overwrite with --glob-load. "
+                             "Changed objects are skipped without "
+                             "--glob-load",
+                        action="store_true", default=False)
+    parser.add_argument("--sync-overwrite",
+                        help="Replace the partitions of changed "
+                             "directories instead of appending them "
+                             "again, requires --sync and --glob-load",
+                        action="store_true", default=False)
+
+    parser.add_argument("--report",
+                        help="File the JSON run report is written to",
+                        action="store", required=False)
+
+    parser.add_argument("--prometheus",
+                        help="Prometheus textfile kept up to date with "
+                             "the run metrics",
+                        action="store", required=False)
+
+    parser.add_argument("--progress-interval",
+                        help="Seconds between throughput and ETA lines",
+                        default=DEFAULT_PROGRESS_INTERVAL,
+                        type=float,
+                        action="store")
+
+    parser.add_argument("--start-date",
+                        help="First date partition to load, YYYY-MM-DD "
+                             "or YYYYMMDD",
+                        action="store", required=False)
+
+    parser.add_argument("--end-date",
+                        help="Last date partition to load, YYYY-MM-DD "
+                             "or YYYYMMDD",
+                        action="store", required=False)
+
+    parser.add_argument("--date",
+                        dest="dates",
+                        help="Date partition to load, can be repeated. "
+                             "Only the date partitions to load are "
+                             "listed and checked on resume",
+                        default=[],
+                        action="append")
+
+    parser.add_argument("--queue",
+                        help="Work queue: local, sqlite:PATH or "
+                             "tcp://HOST:PORT, the last two are shared "
+                             "with --worker processes on other hosts. "
+                             "PATH has to be on a filesystem all of "
+                             "them can open, with working file locks",
+                        action="store", required=False)
+
+    parser.add_argument("--queue-authkey",
+                        help="Authkey of a tcp:// queue, by default "
+                             "from $P2B_QUEUE_AUTHKEY",
+                        action="store", required=False)
+
+    parser.add_argument("--worker",
+                        help="Load the items of the run which owns "
+                             "--queue instead of listing",
+                        action="store_true", default=False)
+
+    parser.add_argument("--profile",
+                        help="Directory the profiles of the workers and "
+                             "the listing are written to and merged "
+                             "into merged.prof (pstats), merged.collapsed "
+                             "(flamegraph stacks) and merged.txt",
+                        action="store", required=False)
+
+    parser.add_argument("--plan",
+                        help="Print a JSON plan of the work to load "
+                             "without creating tables or jobs",
+                        action="store_true", default=False)
+
     glob_group = parser.add_mutually_exclusive_group()
 
     glob_group.add_argument("-g", "--glob-load",
@@ -51,8 +289,65 @@ def main():
 
     args = parser.parse_args()
 
+    if args.worker:
+        if not args.queue:
+            parser.error('--worker requires --queue')
+        work(args.queue, args.concurrency, queue_authkey=args.queue_authkey,
+             pool_size=args.pool_size, lock_stripes=args.lock_stripes,
+             inflight=args.inflight, poll_interval=args.poll_interval,
+             pipeline=args.pipeline, max_attempts=args.max_attempts,
+             backoff_base=args.backoff_base, backoff_max=args.backoff_max,
+             dead_letter=args.dead_letter, quotas=dict(args.quota),
+             admission_control=args.admission_control,
+             manifest=args.manifest, report=args.report,
+             prometheus=args.prometheus,
+             progress_interval=args.progress_interval,
+             profile=args.profile)
+        return
+
+    if not args.bucket:
+        parser.error('--bucket is required')
+    if not args.prefix and not args.sources:
+        parser.error('at least one --prefix or --sources is required')
+
+    sources = load_sources(args.sources) if args.sources else None
+
+    if args.plan:
+        plan = build_plan(args.bucket, args.prefix, args.glob_load,
+                          args.resume_load, dest_dataset=args.dataset,
+                          alias=args.alias, load_mode=args.load_mode,
+                          list_workers=args.list_workers,
+                          exclude_regex=args.exclude_regex,
+                          manifest=args.manifest, sync=args.sync,
+                          sync_overwrite=args.sync_overwrite,
+                          quotas=dict(args.quota),
+                          write_mode=args.write_mode, sources=sources,
+                          batch_bytes=args.batch_bytes,
+                          batch_max_uris=args.batch_max_uris,
+                          profile=args.profile, start_date=args.start_date,
+                          end_date=args.end_date, dates=args.dates)
+        print(json.dumps(plan, indent=2, sort_keys=True))
+        return
+
     bulk(args.bucket, args.prefix, args.concurrency, args.glob_load,
-         args.resume_load, dest_dataset=args.dataset, alias=args.alias)
+         args.resume_load, dest_dataset=args.dataset, alias=args.alias,
+         pool_size=args.pool_size, load_mode=args.load_mode,
+         queue_size=args.queue_size, list_workers=args.list_workers,
+         exclude_regex=args.exclude_regex, lock_stripes=args.lock_stripes,
+         inflight=args.inflight, poll_interval=args.poll_interval,
+         pipeline=args.pipeline, max_attempts=args.max_attempts,
+         backoff_base=args.backoff_base, backoff_max=args.backoff_max,
+         dead_letter=args.dead_letter, quotas=dict(args.quota),
+         admission_control=args.admission_control, manifest=args.manifest,
+         sync=args.sync, sync_overwrite=args.sync_overwrite,
+         report=args.report, prometheus=args.prometheus,
+         progress_interval=args.progress_interval,
+         write_mode=args.write_mode, job_id_prefix=args.job_id_prefix or None,
+         sources=sources, batch_bytes=args.batch_bytes,
+         batch_max_uris=args.batch_max_uris, order=args.order,
+         queue=args.queue, queue_authkey=args.queue_authkey,
+         profile=args.profile, start_date=args.start_date,
+         end_date=args.end_date, dates=args.dates)
 
 
 main()
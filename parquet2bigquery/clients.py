@@ -0,0 +1,98 @@
+import logging
+import os
+import threading
+
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import storage, bigquery
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_POOL_SIZE = 10
+
+# a single scope which covers both BigQuery and GCS
+SCOPES = ('https://www.googleapis.com/auth/cloud-platform',)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# callable(pool_size) returning the client pool, see set_client_factory
+_client_factory = None
+
+
+class ClientPool(object):
+    """
+    Holds long lived BigQuery and GCS clients which share one authorized
+    HTTP session, so credentials are discovered once and TLS connections
+    are reused between API calls.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE):
+        self.pool_size = pool_size
+        self.pid = os.getpid()
+
+        credentials, project = google.auth.default(scopes=SCOPES)
+
+        self.session = AuthorizedSession(credentials)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+
+        kwargs = {'credentials': credentials, '_http': self.session}
+        if project:
+            kwargs['project'] = project
+
+        self.bigquery = bigquery.Client(**kwargs)
+        self.storage = storage.Client(**kwargs)
+
+        logging.info('Process-{}: client pool created with {} '
+                     'connections.'.format(self.pid, pool_size))
+
+    def close(self):
+        self.session.close()
+
+
+def set_client_factory(factory):
+    """
+    Replace ClientPool by factory(pool_size), which returns an object
+    with the same attributes, e.g. fake clients for benchmarks. Processes
+    forked afterwards inherit the factory. None restores ClientPool.
+    """
+    global _client_factory, _pool
+
+    with _pool_lock:
+        _client_factory = factory
+        _pool = None
+
+
+def _create_pool(pool_size):
+    return (_client_factory or ClientPool)(pool_size)
+
+
+def init_client_pool(pool_size=DEFAULT_POOL_SIZE):
+    """
+    Create the client pool for the current process, replacing any pool
+    inherited from a parent process.
+    """
+    global _pool
+
+    with _pool_lock:
+        _pool = _create_pool(pool_size)
+
+    return _pool
+
+
+def get_client_pool():
+    """
+    Return the client pool for the current process, creating it on
+    first use.
+    """
+    global _pool
+
+    with _pool_lock:
+        # sockets must never be shared across a fork
+        if _pool is None or _pool.pid != os.getpid():
+            pool_size = _pool.pool_size if _pool else DEFAULT_POOL_SIZE
+            _pool = _create_pool(pool_size)
+
+    return _pool
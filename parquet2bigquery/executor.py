@@ -0,0 +1,248 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+DEFAULT_INFLIGHT = 4
+DEFAULT_POLL_INTERVAL = 2.0
+
+# BigQuery job state once a job has finished
+_DONE_STATE = 'DONE'
+
+_poller = None
+_poller_lock = threading.Lock()
+
+
+class JobPoller(object):
+    """
+    Polls every in-flight BigQuery job of a process from a single thread.
+
+    Worker threads submit their jobs and wait on a future instead of
+    each polling its own job, so the number of jobs in flight is not
+    tied to the number of polling loops hitting the API.
+    """
+
+    def __init__(self, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self.pid = os.getpid()
+
+        self._jobs = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+        thread = threading.Thread(target=self._run, name='job-poller')
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, job):
+        """
+        Register a started job and return a future which resolves with
+        the job result.
+        """
+        future = Future()
+        with self._lock:
+            self._jobs.append((job, future))
+        self._wakeup.set()
+
+        return future
+
+    def wait(self, job):
+        """
+        Block until a job is done and return its result, raising the
+        job error if it failed.
+        """
+        return self.submit(job).result()
+
+    def _poll(self, job, future):
+        """
+        Refresh a job and resolve its future if it is done. Returns True
+        when the job is no longer pending.
+        """
+        try:
+            # reload() instead of done(): QueryJob.done() can hang on
+            # getQueryResults for several seconds
+            job.reload()
+            if job.state != _DONE_STATE:
+                return False
+            future.set_result(job.result())
+        except Exception as e:
+            future.set_exception(e)
+
+        return True
+
+    def _run(self):
+        while True:
+            with self._lock:
+                jobs = list(self._jobs)
+
+            if not jobs:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            started = time.time()
+            finished = [(job, future) for job, future in jobs
+                        if self._poll(job, future)]
+
+            if finished:
+                with self._lock:
+                    self._jobs = [j for j in self._jobs if j not in finished]
+
+            time.sleep(max(0, self.poll_interval - (time.time() - started)))
+
+
+def init_job_poller(poll_interval=DEFAULT_POLL_INTERVAL):
+    """
+    Create the job poller for the current process.
+    """
+    global _poller
+
+    with _poller_lock:
+        _poller = JobPoller(poll_interval)
+
+    return _poller
+
+
+def wait_for_job(job):
+    """
+    Wait for a BigQuery job to finish and return its result.
+
+    Jobs are handed to the process job poller if one was created with
+    init_job_poller, otherwise the calling thread polls the job itself.
+    """
+    poller = _poller
+    if poller is None or poller.pid != os.getpid():
+        return job.result()
+
+    return poller.wait(job)
+
+
+def start_threads(target, count, name, args=()):
+    """
+    Start count daemon threads running target(thread_id, *args).
+    """
+    threads = []
+    for thread_id in range(count):
+        thread = threading.Thread(target=target, args=(thread_id,) + args,
+                                  name='{}-{}'.format(name, thread_id))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    logging.debug('{}: started {} threads'.format(name, count))
+
+    return threads
+
+
+class Pipeline(object):
+    """
+    Runs items through a sequence of stages. Each stage has its own queue
+    and threads, so an item can be loading while earlier items are in
+    their schema or query stages.
+
+    stages is a list of (name, fn, threads). fn(item) returns True if the
+    item moves on to the next stage and False if it is finished. Once an
+    item is finished or a stage raised, on_done(item, error) is called.
+    """
+
+    def __init__(self, stages, on_done, max_items):
+        self._on_done = on_done
+        self._max_items = max_items
+        self._slots = threading.BoundedSemaphore(max_items)
+        self._queues = [queue.Queue() for _ in stages]
+        self._threads = []
+
+        for index, (name, fn, threads) in enumerate(stages):
+            self._threads.append(start_threads(self._run_stage, threads,
+                                               name, args=(index, fn)))
+
+    def submit(self, item):
+        """
+        Submit an item to the first stage, blocking while max_items
+        items are in flight.
+        """
+        self._slots.acquire()
+        self._queues[0].put(item)
+
+    def _run_stage(self, thread_id, index, fn):
+        stage_queue = self._queues[index]
+
+        for item in iter(stage_queue.get, None):
+            try:
+                if fn(item) and index + 1 < len(self._queues):
+                    self._queues[index + 1].put(item)
+                    continue
+                error = None
+            except Exception as e:
+                error = e
+
+            try:
+                self._on_done(item, error)
+            except Exception:
+                logging.exception('Pipeline: on_done failed')
+            finally:
+                self._slots.release()
+
+    def close(self):
+        """
+        Wait for all in flight items and stop the stage threads.
+        """
+        for _ in range(self._max_items):
+            self._slots.acquire()
+
+        for stage_queue, threads in zip(self._queues, self._threads):
+            for _ in threads:
+                stage_queue.put(None)
+            for thread in threads:
+                thread.join()
+
+
+class BatchWorker(object):
+    """
+    Collects items in the background and hands them to fn(items) in
+    batches of up to batch_size, at least every interval seconds.
+    """
+
+    def __init__(self, fn, name, batch_size=50, interval=5.0):
+        self._fn = fn
+        self._batch_size = batch_size
+        self._interval = interval
+        self._queue = queue.Queue()
+
+        self._thread = start_threads(self._run, 1, name)[0]
+
+    def add(self, item):
+        self._queue.put(item)
+
+    def _run(self, thread_id):
+        closing = False
+
+        while not closing:
+            batch = []
+            deadline = time.time() + self._interval
+            while len(batch) < self._batch_size:
+                try:
+                    item = self._queue.get(
+                        timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+
+            if batch:
+                try:
+                    self._fn(batch)
+                except Exception:
+                    logging.exception('BatchWorker: batch failed')
+
+    def close(self):
+        """
+        Flush the pending items and stop the background thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,228 @@
+from array import array
+
+
+# stands for a missing fingerprint value in the integer columns
+_NULL = -2 ** 63
+
+
+class _Strings(object):
+    """
+    Append-only list of strings stored back to back in one byte array,
+    data, ends() are the offsets where they end. Offsets take 4 bytes
+    until the strings take more than 4GB.
+
+    A sparse list only stores offsets from its first non-empty string on,
+    a column of empty strings takes no memory.
+    """
+
+    def __init__(self, sparse=False):
+        self.data = bytearray()
+        self._ends = None if sparse else array('I')
+        self._len = 0
+
+    def append(self, value):
+        self._len += 1
+        if self._ends is None:
+            if not value:
+                return
+            self._ends = array('I', bytes(4 * (self._len - 1)))
+
+        self.data += value.encode('utf-8')
+        if self._ends.typecode == 'I' and len(self.data) >= 2 ** 32:
+            self._ends = array('Q', self._ends)
+        self._ends.append(len(self.data))
+
+    def ends(self):
+        return self._ends
+
+    def __getitem__(self, i):
+        if self._ends is None:
+            return ''
+        start = self._ends[i - 1] if i else 0
+        return self.data[start:self._ends[i]].decode('utf-8')
+
+    def __len__(self):
+        return self._len
+
+    def nbytes(self):
+        if self._ends is None:
+            return 0
+        return len(self.data) + self._ends.itemsize * len(self._ends)
+
+
+class Inventory(object):
+    """
+    Compact table of object keys (or glob paths) with their fingerprint,
+    number of objects and, for a glob path, the key of its latest
+    object.
+
+    Keys are split into their directory, which is stored once however
+    many objects it holds, and their name. Names and crc32c values are
+    stored back to back in byte arrays and the numbers in typed arrays,
+    which takes a fraction of the memory of the equivalent Python
+    tuples and dicts.
+
+    Entries are looked up by key with an open addressing hash index of
+    entry numbers, built on the first lookup. Keys are not hashed when
+    added, the index hashes them once when it is built.
+    """
+
+    def __init__(self):
+        self._dirs = []
+        self._dir_ids = {}
+        self._dir = array('I')
+        self._names = _Strings()
+        self._latest = _Strings(sparse=True)
+        self._crc32c = _Strings(sparse=True)
+        self._generation = array('q')
+        self._size = array('q')
+        self._objects = array('I')
+        self._index = None
+
+    @classmethod
+    def from_keys(cls, keys):
+        inventory = cls()
+        for key in keys:
+            inventory.add(key)
+        return inventory
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Build an inventory from (key, fingerprint) tuples.
+        """
+        inventory = cls()
+        for key, fingerprint in records:
+            inventory.add(key, fingerprint)
+        return inventory
+
+    def add(self, key, fingerprint=None, objects=1, latest=None):
+        """
+        Add an entry, latest is the key of the latest object of a glob
+        path.
+        """
+        # the latest object of a glob path is one of its objects
+        if latest and not latest.startswith(key + '/'):
+            raise ValueError('{} is not an object of {}'.format(latest, key))
+
+        # the directory keeps its trailing slash, if any
+        split = key.rfind('/') + 1
+        directory, name = key[:split], key[split:]
+
+        dir_id = self._dir_ids.get(directory)
+        if dir_id is None:
+            dir_id = self._dir_ids[directory] = len(self._dirs)
+            self._dirs.append(directory)
+
+        self._dir.append(dir_id)
+        self._names.append(name)
+        self._latest.append(latest[len(key) + 1:] if latest else '')
+
+        generation, size, crc32c = fingerprint or (None, None, None)
+        self._generation.append(_NULL if generation is None else generation)
+        self._size.append(_NULL if size is None else size)
+        self._crc32c.append(crc32c or '')
+        self._objects.append(objects or 0)
+
+        self._index = None
+
+    def __len__(self):
+        return len(self._dir)
+
+    def directory(self, i):
+        return self._dirs[self._dir[i]]
+
+    def key(self, i):
+        return self._dirs[self._dir[i]] + self._names[i]
+
+    def latest(self, i):
+        """
+        Return the key of the latest object of a glob path, or the key
+        itself.
+        """
+        name = self._latest[i]
+        return '{}/{}'.format(self.key(i), name) if name else self.key(i)
+
+    def fingerprint(self, i):
+        generation, size = self._generation[i], self._size[i]
+        crc32c = self._crc32c[i]
+        if generation == _NULL and size == _NULL and not crc32c:
+            return None
+        return (None if generation == _NULL else generation,
+                None if size == _NULL else size,
+                crc32c or None)
+
+    def size(self, i):
+        size = self._size[i]
+        return 0 if size == _NULL else size
+
+    def objects(self, i):
+        return self._objects[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.key(i)
+
+    def _build_index(self):
+        # at most half full, slots hold entry number + 1
+        size = 1
+        while size < 2 * len(self):
+            size *= 2
+        mask = size - 1
+
+        index = array('I', bytes(4 * size)) if len(self) < 2 ** 32 - 1 \
+            else array('Q', bytes(8 * size))
+        # entries are hashed on their directory number and encoded name,
+        # a read-only memoryview slice hashes like the bytes it holds
+        names = memoryview(bytes(self._names.data))
+        start = 0
+        for i, (dir_id, end) in enumerate(zip(self._dir,
+                                              self._names.ends())):
+            slot = hash((dir_id, names[start:end])) & mask
+            start = end
+            while index[slot]:
+                slot = (slot + 1) & mask
+            index[slot] = i + 1
+
+        self._index = index
+
+    def find(self, key):
+        """
+        Return the index of key, or -1.
+        """
+        if self._index is None:
+            self._build_index()
+
+        split = key.rfind('/') + 1
+        dir_id = self._dir_ids.get(key[:split])
+        if dir_id is None:
+            return -1
+        name = key[split:].encode('utf-8')
+
+        index, dirs = self._index, self._dir
+        data, ends = self._names.data, self._names.ends()
+        mask = len(index) - 1
+        slot = hash((dir_id, name)) & mask
+        while index[slot]:
+            i = index[slot] - 1
+            if (dirs[i] == dir_id and
+                    data[ends[i - 1] if i else 0:ends[i]] == name):
+                return i
+            slot = (slot + 1) & mask
+
+        return -1
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def nbytes(self):
+        """
+        Approximate memory used by the entries, without the Python object
+        overhead of the inventory itself.
+        """
+        columns = (self._dir, self._generation, self._size, self._objects,
+                   self._index or array('I'))
+        return (sum(c.itemsize * len(c) for c in columns) +
+                self._names.nbytes() + self._latest.nbytes() +
+                self._crc32c.nbytes() +
+                sum(len(d) + 50 for d in self._dirs))
@@ -0,0 +1,168 @@
+import functools
+import logging
+import re
+from dateutil.parser import parse
+from datetime import datetime
+
+
+IGNORE_PATTERNS = [
+    r'.*/$',  # dirs
+    r'.*/_[^=/]*/',  # temp dirs
+    r'.*/_[^/]*$',  # temp files
+    r'.*/[^/]*\$folder\$/?',  # metadata dirs and files
+    r'.*/\.spark-staging.*$',  # spark staging dirs
+]
+
+DATE_FORMATS = [
+    '%Y%m%d',
+    '%Y-%m-%d'
+]
+
+# number of partition directories kept in the metadata cache
+METADATA_CACHE_SIZE = 2 ** 16
+
+
+@functools.lru_cache(maxsize=None)
+def compile_ignore_pattern(exclude_regex=()):
+    """
+    Compile IGNORE_PATTERNS and any additional exclude patterns into a
+    single pattern, so each key is matched once.
+
+    exclude_regex must be hashable (tuple).
+    """
+    patterns = IGNORE_PATTERNS + list(exclude_regex)
+
+    return re.compile('|'.join('(?:{})'.format(pat) for pat in patterns))
+
+
+def ignore_key(key, exclude_regex=()):
+    """
+    Ignore a string based on IGNORE_PATTERNS and exclude_regex.
+    """
+    return compile_ignore_pattern(tuple(exclude_regex)).match(key) is not None
+
+
+@functools.lru_cache(maxsize=1024)
+def get_date_format(date):
+    """
+    Attempt to determine the date format.
+    """
+    for date_format in DATE_FORMATS:
+        try:
+            datetime.strptime(date, date_format)
+            logging.debug("date format {} detected.".format(date_format))
+            return date_format
+        except ValueError:
+            continue
+
+    logging.error('Date format not detected for {}.'.format(date))
+
+
+def normalize_table_id(table_name):
+    """
+    Normalize table name for use with BigQuery.
+    * Contain up to 1,024 characters
+    * Contain letters (upper or lower case), numbers, and underscores
+
+    We intentionally lower case the table_name.
+
+    https://cloud.google.com/bigquery/docs/tables
+    """
+    if len(table_name) > 1024:
+        raise ValueError('table_name cannot contain more than 1024 characters')
+    else:
+        return re.sub(r'\W+', '_', table_name).lower()
+
+
+@functools.lru_cache(maxsize=METADATA_CACHE_SIZE)
+def _parse_partition_path(partition_path):
+    """
+    Parse the partition directory of an object key. Objects sharing a
+    directory share the result, see get_object_key_metadata.
+    """
+    split_key = partition_path.split('/')
+
+    first_part_idx = next((index for index, elem in enumerate(split_key)
+                           if '=' in elem), None)
+    if first_part_idx is None:
+        raise ValueError('No partition found in {}'.format(partition_path))
+
+    table_version = split_key[first_part_idx - 1]
+    table_name = split_key[first_part_idx - 2]
+
+    date_field, date_value = split_key[first_part_idx].split('=')
+    date_format = get_date_format(date_value)
+    if date_format:
+        date = datetime.strptime(date_value, date_format)
+    else:
+        date = parse(date_value)
+
+    # try to get additional partition information
+    extra_partitions = tuple(tuple(elem.split('='))
+                             for elem in split_key[first_part_idx+1:]
+                             if '=' in elem)
+
+    return (first_part_idx,
+            normalize_table_id('_'.join([table_name, table_version])),
+            date_field, date_format, date.strftime('%Y-%m-%d'),
+            extra_partitions)
+
+
+def get_object_key_metadata(object_key):
+    """
+    Parse object key and return useful metadata.
+
+    sample object_key:
+    'table_name/vtable_version/date_partition=x/first_partition=y/...'
+
+    Parsing is memoized on the partition directory, so only the first
+    object of every directory is actually parsed.
+
+    Args:
+        object_key - contains the gcs object key (str)
+    Returns:
+        A dict which contains:
+        partitions: non date partitions (list)
+        table_id: derived table_id (str)
+        date_partition: (dict)
+            format: date time format (str)
+            value: date value (str)
+            field: date partition field name (str)
+    """
+    head, _, tail = object_key.rpartition('/')
+    # glob paths end with a partition, object keys with a file name
+    partition_path = object_key if '=' in tail else head
+
+    (first_part_idx, table_id, date_field, date_format, date_value,
+     extra_partitions) = _parse_partition_path(partition_path)
+
+    return {
+        'first_part_idx': first_part_idx,
+        'table_id': table_id,
+        'partitions': [list(p) for p in extra_partitions],
+        'date_partition': {
+            'field': date_field,
+            'format': date_format,
+            'value': date_value
+        }
+    }
+
+
+def classify_keys(object_keys, exclude_regex=()):
+    """
+    Classify a batch of object keys in two stages: keys matching the
+    combined ignore pattern are dropped, then the remaining keys are
+    parsed with the memoized metadata parser.
+
+    Yields a (object_key, meta) tuple for every key to load. Keys
+    without a partition are logged and skipped.
+    """
+    match = compile_ignore_pattern(tuple(exclude_regex)).match
+
+    for object_key in object_keys:
+        if match(object_key) is not None:
+            continue
+        try:
+            yield object_key, get_object_key_metadata(object_key)
+        except ValueError:
+            logging.warning('Unable to parse {}, ignoring.'.format(object_key))
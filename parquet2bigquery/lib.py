@@ -1,14 +1,57 @@
+import hashlib
 import logging
-import re
+import queue
+import random
 import secrets
-from dateutil.parser import parse
-from datetime import datetime
-from multiprocessing import Process, JoinableQueue, Lock
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import Manager, Process
 
 import google.api_core.exceptions
-from google.cloud import storage, bigquery
+from google.cloud import bigquery
 from google.cloud.bigquery.table import TimePartitioning, TimePartitioningType
 
+try:
+    from google.cloud.bigquery.external_config import HivePartitioningOptions
+except ImportError:
+    # hive partitioning requires google-cloud-bigquery >= 1.23
+    HivePartitioningOptions = None
+
+from parquet2bigquery.clients import (DEFAULT_POOL_SIZE, get_client_pool,
+                                      init_client_pool)
+from parquet2bigquery.executor import (DEFAULT_INFLIGHT, DEFAULT_POLL_INTERVAL,
+                                       BatchWorker, Pipeline, init_job_poller,
+                                       start_threads, wait_for_job)
+from parquet2bigquery.inventory import Inventory
+from parquet2bigquery.keys import (compile_ignore_pattern, ignore_key,
+                                   normalize_table_id)
+from parquet2bigquery.keys import (
+    get_object_key_metadata as _get_object_key_metadata)
+from parquet2bigquery.locks import DEFAULT_LOCK_STRIPES, StripedLocks
+from parquet2bigquery.metrics import (DEFAULT_PROGRESS_INTERVAL,
+                                      MetricsPublisher, RunReporter,
+                                      get_metrics, init_metrics, timed,
+                                      write_report)
+from parquet2bigquery.profiling import merge_profiles, start_profiler
+from parquet2bigquery.manifest import (BATCH_SIZE, STATE_APPENDED,
+                                       STATE_LOADED_TMP, STATE_QUEUED,
+                                       Manifest, ManifestWriter)
+from parquet2bigquery.quota import TableQuotas
+from parquet2bigquery.retry import (DEFAULT_BACKOFF_BASE, DEFAULT_BACKOFF_MAX,
+                                    DEFAULT_MAX_ATTEMPTS, RetryScheduler,
+                                    is_retryable)
+from parquet2bigquery.schema import SchemaManager
+from parquet2bigquery.sources import get_sources, interleave
+from parquet2bigquery.window import (describe_window,
+                                     filter_partition_prefixes, make_window,
+                                     window_predicate)
+from parquet2bigquery.workqueue import open_work_queue
+
 
 # sample message 2019-02-07 12:34:55,439 root WARNING yay
 logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s',
@@ -17,137 +60,179 @@ logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s',
 # defaults
 DEFAULT_DATASET = 'telemetry'
 DEFAULT_TMP_DATASET = 'tmp'
+DEFAULT_LOAD_MODE = 'tmp'
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_LIST_WORKERS = 8
 
-IGNORE_PATTERNS = [
-    r'.*/$',  # dirs
-    r'.*/_[^=/]*/',  # temp dirs
-    r'.*/_[^/]*$',  # temp files
-    r'.*/[^/]*\$folder\$/?',  # metadata dirs and files
-    r'.*/\.spark-staging.*$',  # spark staging dirs
-]
+# tmp: load into a temp table and append via query
+# direct: hive partitioned load straight into the partition decorator
+# external: append via query from a temporary external table over GCS
+LOAD_MODES = ['tmp', 'direct', 'external']
 
+# append: append the object(s) to the table
+# overwrite: replace the rows of their date and extra partition values
+DEFAULT_WRITE_MODE = 'append'
+WRITE_MODES = ['append', 'overwrite']
 
-class P2BWarning(Exception):
-    pass
+# with a prefix, job ids are derived from the work they do, so a
+# restarted run finds the jobs of the previous one, see submit_job. Off
+# by default: a finished job is found again after its table was dropped
+# or truncated, and its rows are not loaded again
+DEFAULT_JOB_ID_PREFIX = None
+# reruns of a job id whose earlier job failed
+MAX_JOB_RERUNS = 10
 
+# order items are queued in: as listed, largest first, or by date
+DEFAULT_ORDER = 'listing'
+ORDERS = ['listing', 'largest', 'newest', 'oldest']
 
-def get_bq_client(table_id, dataset):
-    """
-    Returns a tuple that contains the BigQuery client and TableReference.
+# max number of URIs of a BigQuery load job, and of a batch of objects
+DEFAULT_BATCH_MAX_URIS = 10000
+# batches still being filled, the least recently filled one is queued
+# once there are more
+BATCH_OPEN_GROUPS = 64
 
-    """
-    client = bigquery.Client()
-    dataset_ref = client.dataset(dataset)
-    table_ref = dataset_ref.table(table_id)
-
-    return client, table_ref
+# marks the end of a listing shard
+_SHARD_DONE = object()
 
+# tables whose direct load fallback was logged by this process
+_direct_fallback_tables = set()
 
-def get_date_format(date):
-    """
-    Attempt to determine the date format.
-    """
-    date_formats = [
-        '%Y%m%d',
-        '%Y-%m-%d'
-     ]
+# dataset locations looked up by this process, see get_dataset_location
+_dataset_locations = {}
 
-    for date_format in date_formats:
-        try:
-            datetime.strptime(date, date_format)
-            logging.info("date format {} detected.".format(date_format))
-            return date_format
-        except ValueError:
-            continue
 
-    logging.error('Date format not detected, exiting.')
-    exit
+class P2BWarning(Exception):
+    pass
 
 
-def gen_rand_string(size=3):
+@contextmanager
+def retryable_errors(table_id, message='BigQuery Retryable Error.'):
     """
-    Generate a random string.
+    Turn retryable API errors (see retry.is_retryable) raised in the
+    block into a P2BWarning.
     """
-    return secrets.token_hex(size)
+    try:
+        yield
+    except google.api_core.exceptions.GoogleAPICallError as e:
+        if not is_retryable(e):
+            raise
+        logging.exception('{}: {}'.format(table_id, message))
+        raise P2BWarning(message) from e
 
 
-def ignore_key(key, exclude_regex=[]):
+def make_item(bucket_name, object_key, path=None, fingerprint=None,
+              overwrite=False, objects=None, alias=None, dataset=None,
+              batch=None):
     """
-    Ignore a string based on IGNORE_PATTERNS.
+    Create a work queue item. Items carry the alias and dataset of their
+    source, so the sources of a run can share the workers.
+
+    A batch item loads a list of (object_key, fingerprint) tuples of the
+    same table, date and extra partition values, object_key is the first
+    of them.
     """
-    return any([re.match(pat, key) for pat in IGNORE_PATTERNS + exclude_regex])
+    return {
+        'bucket_name': bucket_name,
+        'path': path,
+        'object_key': object_key,
+        'alias': alias,
+        'dataset': dataset,
+        'fingerprint': fingerprint,
+        'overwrite': overwrite,
+        'objects': objects,
+        'batch': batch,
+        'attempt': 0
+    }
 
 
-def normalize_table_id(table_name):
+def get_bq_client(table_id, dataset):
     """
-    Normalize table name for use with BigQuery.
-    * Contain up to 1,024 characters
-    * Contain letters (upper or lower case), numbers, and underscores
-
-    We intentionally lower case the table_name.
+    Returns a tuple that contains the BigQuery client and TableReference.
 
-    https://cloud.google.com/bigquery/docs/tables
+    The client is taken from the per-process client pool.
     """
-    if len(table_name) > 1024:
-        raise ValueError('table_name cannot contain more than 1024 characters')
-    else:
-        return re.sub('\W+', '_', table_name).lower()
+    client = get_client_pool().bigquery
+    dataset_ref = client.dataset(dataset)
+    table_ref = dataset_ref.table(table_id)
 
+    return client, table_ref
 
-def _get_object_key_metadata(object_key):
-    """
-    Parse object key and return useful metadata.
 
-    sample object_key:
-    'table_name/vtable_version/date_partition=x/first_partition=y/...'
+def make_digest(*parts):
+    """
+    Hash the parts identifying a unit of work, for deterministic job ids
+    and temp table names.
+    """
+    return hashlib.sha1('|'.join(str(part) for part in parts)
+                        .encode('utf-8')).hexdigest()[:20]
 
-    Args:
-        object_key - contains the gcs object key (str)
-    Returns:
-        A dict which contains:
-        partitions: non date partitions (list)
-        table_id: derived table_id (str)
-        date_partition: (dict)
-            format: date time format (str)
-            value: date value (str)
-            field: date partition field name (str)
-    """
-
-    meta = {
-        'partitions': [],
-        'date_partition': {}
-    }
 
-    split_key = object_key.split('/')
+def get_dataset_location(dataset):
+    """
+    Return the location of a dataset, which the jobs writing to it run
+    in. Looked up once per process.
+    """
+    if dataset not in _dataset_locations:
+        client = get_client_pool().bigquery
+        _dataset_locations[dataset] = client.get_dataset(
+            client.dataset(dataset)).location
 
-    first_part_idx = next(iter([index for index, elem in enumerate(split_key)
-                          if '=' in elem]))
+    return _dataset_locations[dataset]
 
-    table_version = split_key[first_part_idx - 1]
-    table_name = split_key[first_part_idx - 2]
 
-    meta['first_part_idx'] = first_part_idx
+def submit_job(submit, job_id, table_id, dataset, reuse_done=True):
+    """
+    Start a job with a deterministic id, or reattach to the job which
+    already has that id.
 
-    meta['table_id'] = normalize_table_id('_'.join([table_name,
-                                                    table_version]))
+    submit(job_id) starts the job, which writes to dataset. If the id is
+    taken by a running job it is returned so the caller waits for it, a
+    successful job is returned as is unless reuse_done is False.
+    Otherwise the job is rerun as job_id_r1, job_id_r2, ...
+    """
+    client = get_client_pool().bigquery
 
-    date_field, date_value = split_key[first_part_idx].split('=')
-    meta['date_partition']['field'] = date_field
-    meta['date_partition']['format'] = get_date_format(date_value)
-    meta['date_partition']['value'] = parse(date_value).strftime('%Y-%m-%d')
+    for rerun in range(MAX_JOB_RERUNS):
+        _job_id = '{}_r{}'.format(job_id, rerun) if rerun else job_id
+        try:
+            return submit(_job_id)
+        except google.api_core.exceptions.Conflict:
+            # jobs outside of the US and EU multi-regions are only found
+            # in their location
+            job = client.get_job(_job_id,
+                                 location=get_dataset_location(dataset))
+
+        if job.state != 'DONE':
+            logging.info('{}: reattaching to running job '
+                         '{}'.format(table_id, _job_id))
+            get_metrics().incr('jobs_reattached')
+            return job
+
+        if reuse_done and job.error_result is None:
+            logging.warning('{}: job {} already done, its data is not '
+                            'loaded again. Use another job id prefix to '
+                            'reload it.'.format(table_id, _job_id))
+            get_metrics().incr('jobs_reused')
+            return job
+
+    raise RuntimeError('{}: no job id left after {} '
+                       'reruns of {}'.format(table_id, MAX_JOB_RERUNS,
+                                             job_id))
 
-    # try to get additional partition information
-    extra_partitions = [elem.split('=')
-                        for elem in split_key[first_part_idx+1:]
-                        if '=' in elem]
-    meta['partitions'] += extra_partitions
 
-    return meta
+def gen_rand_string(size=3):
+    """
+    Generate a random string.
+    """
+    return secrets.token_hex(size)
 
 
 def create_bq_table(table_id, dataset, schema=None, partition_field=None):
     """
     Create a BigQuery table.
+
+    Returns False if the table already existed.
     """
 
     client, table_ref = get_bq_client(table_id, dataset)
@@ -162,9 +247,10 @@ def create_bq_table(table_id, dataset, schema=None, partition_field=None):
         client.create_table(table_def)
     except google.api_core.exceptions.Conflict:
         logging.info('{}: BigQuery table already exists.'.format(table_id))
-        pass
+        return False
 
     logging.info('{}: table created.'.format(table_id))
+    return True
 
 
 def get_bq_table_schema(table_id, dataset):
@@ -218,12 +304,43 @@ def generate_bq_schema(table_id, dataset, date_partition_field=None,
     return partition_fields + schema
 
 
+def get_source_uris(bucket, object_key):
+    """
+    Return the URI of an object key, or the list of URIs of a list of
+    object keys (a batch).
+    """
+    if isinstance(object_key, list):
+        return ['gs://{}/{}'.format(bucket, key) for key in object_key]
+    return 'gs://{}/{}'.format(bucket, object_key)
+
+
+def describe_keys(object_key):
+    """
+    Describe an object key, or a list of them, for log messages.
+    """
+    if isinstance(object_key, list):
+        return '{} and {} more'.format(object_key[0], len(object_key) - 1)
+    return object_key
+
+
 def load_parquet_to_bq(bucket, object_key, table_id, dataset, schema=None,
-                       partition=None):
+                       partition=None, hive_partitioning=None,
+                       partition_field=None, write_disposition=None,
+                       job_id=None, reuse_done=True):
     """
     Load parquet data into BigQuery.
+
+    If partition is set (YYYYMMDD) the data is loaded into the partition
+    decorator table_id$partition. hive_partitioning and partition_field
+    allow partition columns to be derived from the object key and the
+    table to be created as a day partitioned table if needed.
+
+    A job_id makes the load idempotent, see submit_job.
     """
 
+    if partition:
+        table_id = '{}${}'.format(table_id, partition)
+
     client, table_ref = get_bq_client(table_id, dataset)
 
     job_config = bigquery.LoadJobConfig()
@@ -235,71 +352,101 @@ def load_parquet_to_bq(bucket, object_key, table_id, dataset, schema=None,
         bigquery.SchemaUpdateOption.ALLOW_FIELD_RELAXATION
     ]
 
-    uri = 'gs://{}/{}'.format(bucket, object_key)
+    if write_disposition:
+        job_config.write_disposition = write_disposition
+    if hive_partitioning:
+        job_config.hive_partitioning = hive_partitioning
+    if partition_field:
+        job_config.time_partitioning = TimePartitioning(
+            type_=TimePartitioningType.DAY, field=partition_field)
 
-    if partition:
-        table_id = '{}${}'.format(table_id, partition)
+    uri = get_source_uris(bucket, object_key)
+
+    def _submit(job_id=None):
+        return client.load_table_from_uri(
+            uri,
+            table_ref,
+            job_id=job_id,
+            job_config=job_config)
 
-    load_job = client.load_table_from_uri(
-        uri,
-        table_ref,
-        job_config=job_config)
+    if job_id:
+        load_job = submit_job(_submit, job_id, table_id, dataset,
+                              reuse_done)
+    else:
+        load_job = _submit()
 
-    load_job.result()
+    wait_for_job(load_job)
     logging.info('{}: Parquet file {} loaded '
                  'into BigQuery.'.format(table_id,
-                                         object_key))
+                                         describe_keys(object_key)))
+
+    return load_job
 
 
-def _compare_columns(new_col, cur_col):
+def get_hive_partitioning(bucket, object_key, meta):
     """
-    Compare two columns to see if they are changing.
-    This is currently only checks to see if column MODE
-    is changing.
+    Build hive partitioning options which derive the date partition
+    and the additional partition columns from the object key.
+
+    The partition columns are declared explicitly (CUSTOM mode) so the
+    date partition is typed as DATE and the remaining partitions as
+    STRING, matching the columns added by construct_select_query.
     """
-    if isinstance(new_col, tuple):
-        for i in range(len(new_col)):
-            _compare_columns(new_col[i], cur_col[i])
+    split_key = object_key.split('/')
+    uri_prefix = '/'.join(split_key[:meta['first_part_idx']])
 
-    if isinstance(new_col, google.cloud.bigquery.schema.SchemaField):
-        if new_col.fields and cur_col.fields:
-            _compare_columns(new_col.fields, cur_col.fields)
+    custom_cols = ['{{{}:DATE}}'.format(meta['date_partition']['field'])]
+    for partition, _ in meta['partitions']:
+        custom_cols.append('{{{}:STRING}}'.format(partition))
 
-        # if mode is changing from NULLABLE to REQUIRED
-        if(new_col.mode == 'REQUIRED' and cur_col.mode == 'NULLABLE'):
-            logging.warn('Column mode changed from '
-                         'REQUIRED to NULLABLE, ignoring.')
-            return False
+    options = HivePartitioningOptions()
+    options.mode = 'CUSTOM'
+    options.source_uri_prefix = 'gs://{}/{}/{}'.format(bucket, uri_prefix,
+                                                       '/'.join(custom_cols))
+
+    return options
 
-    return False
 
+def direct_load_supported(meta):
+    """
+    Check if an object can be loaded directly into its partition.
 
-def get_schema_additions(current_schema, newest_schema):
+    BigQuery can only parse hive DATE partitions in YYYY-MM-DD format.
     """
-    Compare two BigQuery table schemas and get the additional columns.
-    newest_schema should contain the latest schema and current_schema should be
-    the current schema. We only append additional columns.
+    if HivePartitioningOptions is None:
+        return False
+
+    return meta['date_partition']['format'] == '%Y-%m-%d'
+
 
-    Handling column changes are currently not implemented.
+def effective_load_mode(load_mode, meta, overwrite=False):
     """
-    schema_additions = []
+    Return the load mode an item actually runs with. Direct loads fall
+    back to tmp if the date partition can't be loaded directly, or if an
+    overwrite has to keep the other slices of the date partition.
+    External overwrites need the columns of a temp table.
+    """
+    if load_mode == 'direct' and not direct_load_supported(meta):
+        return 'tmp'
+    if load_mode == 'direct' and overwrite and meta['partitions']:
+        # a load job can only truncate the whole date partition
+        return 'tmp'
+    if load_mode == 'external' and overwrite:
+        return 'tmp'
+    return load_mode
 
-    schema_diff = set(newest_schema) - set(current_schema)
 
-    for sd_col in schema_diff:
-        already_exists = False
-        for cs_col in current_schema:
-            # check to see if the column we are attempting to add exists
-            if sd_col.name == cs_col.name:
-                already_exists = True
-                # we found an existing column, find out what has changed
-                col = (_compare_columns(sd_col, cs_col))
-                if col:
-                    raise NotImplementedError()
-        # we found a new column, add it
-        if not already_exists:
-            schema_additions.append(sd_col)
-    return schema_additions
+def check_load_mode(load_mode):
+    """
+    Validate the load mode, and warn once if direct loads will fall back
+    to tmp table loads.
+    """
+    if load_mode not in LOAD_MODES:
+        raise ValueError('load_mode must be one of {}'.format(LOAD_MODES))
+    if load_mode == 'direct' and HivePartitioningOptions is None:
+        logging.warning('main_process: hive partitioning is not supported '
+                        'by this google-cloud-bigquery version, direct '
+                        'loads fall back to tmp table loads.')
 
 
 def construct_select_query(table_id, date_partition_field,
@@ -309,6 +456,9 @@ def construct_select_query(table_id, date_partition_field,
     """
     Construct a query to select all data from a temp table, append
     the relevant partitions and output into the primary table.
+
+    If dataset is None table_id is a table definition of the query,
+    see get_external_config.
     """
 
     select_cols = ['SELECT *']
@@ -323,29 +473,118 @@ def construct_select_query(table_id, date_partition_field,
 
     _select_cols = ','.join(select_cols)
 
+    source = '{}.{}'.format(dataset, table_id) if dataset else table_id
+
     query = """
     {0}
-    FROM {1}.{2}
-    """.format(_select_cols, dataset, table_id)
+    FROM {1}
+    """.format(_select_cols, source)
+
+    return query
+
+
+def construct_overwrite_query(table_id_tmp, table_id, dataset, columns,
+                              tmp_columns, date_partition_field,
+                              date_partition_value, partitions=None):
+    """
+    Construct a query which selects the full content of a primary table
+    partition once the temp table data replaced its slice.
+
+    The slice is defined by the extra partition values, the rows of the
+    other slices of the date partition are kept. columns are the primary
+    table columns, the ones missing from the temp table are NULL.
+    """
+    select_query = construct_select_query(table_id_tmp,
+                                          date_partition_field,
+                                          date_partition_value,
+                                          partitions=partitions)
+
+    tmp_columns = set(tmp_columns)
+    select_cols = ', '.join(col if col in tmp_columns
+                            else 'NULL AS {}'.format(col)
+                            for col in columns)
+
+    query = """
+    SELECT {0} FROM ({1})
+    """.format(select_cols, select_query)
+
+    if partitions:
+        slice_filter = ' AND '.join("{0} = '{1}'".format(*partition)
+                                    for partition in partitions)
+        query += """
+    UNION ALL
+    SELECT {0} FROM {1}.{2}
+    WHERE {3} = '{4}' AND NOT IFNULL({5}, FALSE)
+    """.format(', '.join(columns), dataset, table_id,
+               date_partition_field, date_partition_value, slice_filter)
 
     return query
 
 
-def load_bq_query_to_table(query, table_id, dataset):
+def get_external_config(bucket, object_key):
+    """
+    Build the definition of a temporary external table over the Parquet
+    object(s) of an object key, which may end with a wildcard, or of a
+    list of object keys.
+    """
+    uris = get_source_uris(bucket, object_key)
+
+    external_config = bigquery.ExternalConfig('PARQUET')
+    external_config.source_uris = uris if isinstance(uris, list) else [uris]
+
+    return external_config
+
+
+def load_bq_query_to_table(query, table_id, dataset, partition=None,
+                           write_disposition=None, table_definitions=None,
+                           partition_field=None, job_id=None):
     """
     Execute constructed query to load data into BigQuery.
+
+    The results are appended to the table, unless a write_disposition
+    is given. If partition is set (YYYYMMDD) the results are written to
+    the partition decorator table_id$partition.
+
+    table_definitions maps the names of temporary external tables used
+    by the query to their ExternalConfig. The query then creates the
+    table if needed, day partitioned on partition_field, and adds or
+    relaxes columns like a load job.
+
+    A job_id makes the query idempotent, see submit_job.
     """
+    if partition:
+        table_id = '{}${}'.format(table_id, partition)
 
     job_config = bigquery.QueryJobConfig()
     client, table_ref = get_bq_client(table_id, dataset)
 
     job_config.destination = table_ref
-    job_config.write_disposition = bigquery.job.WriteDisposition.WRITE_APPEND
+    job_config.write_disposition = (
+        write_disposition or bigquery.job.WriteDisposition.WRITE_APPEND)
+
+    if table_definitions:
+        job_config.table_definitions = table_definitions
+        job_config.schema_update_options = [
+            bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION,
+            bigquery.SchemaUpdateOption.ALLOW_FIELD_RELAXATION
+        ]
+    if partition_field:
+        job_config.time_partitioning = TimePartitioning(
+            type_=TimePartitioningType.DAY, field=partition_field)
+
+    def _submit(job_id=None):
+        return client.query(query, job_config=job_config, job_id=job_id)
+
+    if job_id:
+        query_job = submit_job(_submit, job_id, table_id, dataset)
+    else:
+        query_job = _submit()
 
-    query_job = client.query(query, job_config=job_config)
-    query_job.result()
+    wait_for_job(query_job)
     logging.info('{}: query results loaded.'.format(table_id))
 
+    return query_job
+
 
 def check_bq_table_exists(table_id, dataset):
     """
@@ -378,46 +617,303 @@ def delete_bq_table(table_id, dataset=DEFAULT_TMP_DATASET):
         pass
 
 
-def list_blobs_with_prefix(bucket_name, prefix, delimiter=None):
+def delete_bq_tables(table_ids, dataset=DEFAULT_TMP_DATASET):
     """
-    Return a list of all objects in a bucket prefix.
+    Delete a batch of BigQuery tables.
+    """
+    for table_id in table_ids:
+        try:
+            delete_bq_table(table_id, dataset)
+        except google.api_core.exceptions.GoogleAPICallError:
+            logging.exception('{}: unable to delete table.'.format(table_id))
+
+
+def _list_blobs(bucket_name, prefix, delimiter=None):
+    """
+    Return a lazy iterator over the blobs in a bucket prefix. Pages are
+    fetched from GCS as the iterator is consumed.
+    """
+    storage_client = get_client_pool().storage
+    # bucket() does not issue a metadata request, unlike get_bucket()
+    bucket = storage_client.bucket(bucket_name)
+
+    return bucket.list_blobs(prefix=prefix, delimiter=delimiter)
+
+
+def list_partition_prefixes(bucket_name, prefix):
+    """
+    List the top level partition prefixes of a bucket prefix.
+
+    Returns a tuple with the sorted partition prefixes
+    ('dataset/version/date=.../') and the blobs found directly under
+    the prefix.
+    """
+    prefix = prefix.rstrip('/') + '/'
+    blobs = _list_blobs(bucket_name, prefix, delimiter='/')
+
+    # prefixes are only populated once the pages have been consumed
+    with timed('list'):
+        root_blobs = list(blobs)
+
+    return sorted(blobs.prefixes), root_blobs
+
+
+def list_window_prefixes(bucket_name, prefix, window):
+    """
+    Return the date partition prefixes of a bucket prefix in a window,
+    see window.make_window, in order.
+    """
+    partition_prefixes, _ = list_partition_prefixes(bucket_name, prefix)
+    shards = filter_partition_prefixes(partition_prefixes, window)
+
+    logging.info('main_process: {} of {} date partitions of {} in '
+                 'window {}'.format(len(shards), len(partition_prefixes),
+                                    prefix, describe_window(window)))
+    return shards
+
+
+def blob_fingerprint(blob):
+    """
+    Return the (generation, size, crc32c) fingerprint of a blob, which
+    changes whenever the object is rewritten.
     """
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=prefix, delimiter=delimiter)
+    return blob.generation, blob.size, blob.crc32c
+
+
+class DirectoryFingerprint(object):
+    """
+    Combines the fingerprints of the objects of a directory, listed in
+    lexicographic order, into a directory fingerprint: the latest
+    generation, the total size and a crc32 of the object fingerprints.
+    """
+
+    def __init__(self):
+        self.generation = 0
+        self.size = 0
+        self.objects = 0
+        self._crc = 0
 
-    object_keys = []
+    def add(self, blob):
+        self.add_object(blob.name, blob_fingerprint(blob))
+
+    def add_object(self, name, fingerprint):
+        generation, size, crc32c = fingerprint
+        self.objects += 1
+        self.generation = max(self.generation, generation or 0)
+        self.size += size or 0
+        self._crc = zlib.crc32('{}:{}:{}\n'.format(
+            name, generation, crc32c).encode('utf-8'), self._crc)
+
+    def fingerprint(self):
+        return self.generation, self.size, '{:08x}'.format(self._crc)
+
+
+def _iter_object_keys(blobs, exclude_regex=(), fingerprints=False):
+    match = compile_ignore_pattern(tuple(exclude_regex)).match
 
     for blob in blobs:
-        if not ignore_key(blob.name):
-            object_keys.append(blob.name)
+        if match(blob.name) is None:
+            yield (blob.name, blob_fingerprint(blob)) if fingerprints \
+                else blob.name
+
 
-    return object_keys
+def _in_path(object_path, path):
+    """
+    Check if object_path is path or one of its sub directories.
+    """
+    return object_path == path or object_path.startswith(path + '/')
 
 
-def get_latest_object(bucket_name, prefix, delimiter=None):
+def _iter_latest(blobs, exclude_regex=(), fingerprints=False):
     """
-    Get the latest object in a bucket prefix.
+    Yield a (path, object_key) tuple with the latest object of each
+    directory in a lexicographically ordered blob listing, or a (path,
+    object_key, fingerprint, objects) tuple with the directory
+    fingerprint and number of objects if fingerprints is set.
+
+    GCS lists objects in lexicographic order, so all the objects of a
+    directory are listed contiguously. A directory is emitted as soon as
+    listing has moved past its range.
     """
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    blobs = bucket.list_blobs(prefix=prefix, delimiter=delimiter)
+    match = compile_ignore_pattern(tuple(exclude_regex)).match
 
-    latest_objects = {}
-    _latest_objects_timestamp = {}
+    # path -> [updated, object_key, fingerprint] for directories still
+    # being listed
+    open_paths = {}
+
+    def _emit(path):
+        _, object_key, fingerprint = open_paths.pop(path)
+        if fingerprints:
+            return (path, object_key, fingerprint.fingerprint(),
+                    fingerprint.objects)
+        return path, object_key
 
     for blob in blobs:
-        if not ignore_key(blob.name):
-            path = '/'.join(blob.name.split('/')[0:-1])
-            if _latest_objects_timestamp.get(path):
-                if _latest_objects_timestamp[path] < blob.updated:
-                    _latest_objects_timestamp[path] = blob.updated
-                    latest_objects[path] = blob.name
-            else:
-                _latest_objects_timestamp[path] = blob.updated
-                latest_objects[path] = blob.name
+        if match(blob.name) is not None:
+            continue
+
+        path = '/'.join(blob.name.split('/')[0:-1])
+
+        for open_path in [p for p in open_paths if not _in_path(path, p)]:
+            yield _emit(open_path)
+
+        latest = open_paths.get(path)
+        if latest is None:
+            latest = open_paths[path] = [blob.updated, blob.name,
+                                         DirectoryFingerprint()]
+        elif latest[0] < blob.updated:
+            latest[:2] = blob.updated, blob.name
 
-    return latest_objects
+        if fingerprints:
+            latest[2].add(blob)
+
+    for open_path in list(open_paths):
+        yield _emit(open_path)
+
+
+def _iter_sharded(shard_fn, shards, list_workers):
+    """
+    Run shard_fn over every shard in a thread pool and yield the results
+    of all shards as they arrive.
+    """
+    results = queue.Queue(maxsize=DEFAULT_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def _put(result):
+        while not stop.is_set():
+            try:
+                results.put(result, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run_shard(shard):
+        if stop.is_set():
+            return
+        try:
+            with timed('list'):
+                for result in shard_fn(shard):
+                    if not _put(result):
+                        return
+        except Exception as e:
+            _put(e)
+        finally:
+            _put(_SHARD_DONE)
+
+    with ThreadPoolExecutor(max_workers=list_workers) as executor:
+        futures = [executor.submit(_run_shard, shard) for shard in shards]
+
+        pending = len(shards)
+        try:
+            while pending:
+                result = results.get()
+                if result is _SHARD_DONE:
+                    pending -= 1
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    yield result
+        finally:
+            # unblock the shard threads if we stop early, and drop the
+            # shards which have not started
+            stop.set()
+            for future in futures:
+                future.cancel()
+
+
+def iter_blobs_with_prefix(bucket_name, prefix, delimiter=None,
+                           list_workers=1, exclude_regex=(),
+                           fingerprints=False, shards=None):
+    """
+    Yield all object keys in a bucket prefix as they are listed, or
+    (object_key, fingerprint) tuples if fingerprints is set.
+
+    If list_workers is greater than one the partition prefixes are
+    listed concurrently. If shards is given only those partition
+    prefixes are listed, see list_window_prefixes.
+    """
+    if list_workers <= 1 and shards is None:
+        for object_key in _iter_object_keys(_list_blobs(bucket_name, prefix,
+                                                        delimiter),
+                                            exclude_regex, fingerprints):
+            yield object_key
+        return
+
+    if shards is None:
+        shards, root_blobs = list_partition_prefixes(bucket_name, prefix)
+    else:
+        root_blobs = []
+    list_workers = max(list_workers, 1)
+    logging.info('main_process: listing {} partitions '
+                 'with {} workers'.format(len(shards), list_workers))
+
+    for object_key in _iter_object_keys(root_blobs, exclude_regex,
+                                        fingerprints):
+        yield object_key
+
+    def _list_shard(shard):
+        return _iter_object_keys(_list_blobs(bucket_name, shard),
+                                 exclude_regex, fingerprints)
+
+    for object_key in _iter_sharded(_list_shard, shards, list_workers):
+        yield object_key
+
+
+def list_blobs_with_prefix(bucket_name, prefix, delimiter=None,
+                           list_workers=1, exclude_regex=()):
+    """
+    Return a list of all objects in a bucket prefix.
+    """
+    return list(iter_blobs_with_prefix(bucket_name, prefix, delimiter,
+                                       list_workers, exclude_regex))
+
+
+def iter_latest_objects(bucket_name, prefix, delimiter=None,
+                        list_workers=1, exclude_regex=(),
+                        fingerprints=False, shards=None):
+    """
+    Yield a (path, object_key) tuple with the latest object of each
+    directory in a bucket prefix, see _iter_latest for fingerprints.
+
+    If list_workers is greater than one the partition prefixes are
+    listed concurrently and reduced per partition. A directory never
+    spans two partitions so the result is the same. If shards is given
+    only those partition prefixes are listed.
+    """
+    if list_workers <= 1 and shards is None:
+        for latest in _iter_latest(_list_blobs(bucket_name, prefix,
+                                               delimiter),
+                                   exclude_regex, fingerprints):
+            yield latest
+        return
+
+    if shards is None:
+        shards, root_blobs = list_partition_prefixes(bucket_name, prefix)
+    else:
+        root_blobs = []
+    list_workers = max(list_workers, 1)
+    logging.info('main_process: listing {} partitions '
+                 'with {} workers'.format(len(shards), list_workers))
+
+    for latest in _iter_latest(root_blobs, exclude_regex, fingerprints):
+        yield latest
+
+    def _list_shard(shard):
+        return _iter_latest(_list_blobs(bucket_name, shard), exclude_regex,
+                            fingerprints)
+
+    for latest in _iter_sharded(_list_shard, shards, list_workers):
+        yield latest
+
+
+def get_latest_object(bucket_name, prefix, delimiter=None, list_workers=1,
+                      exclude_regex=()):
+    """
+    Get the latest object in a bucket prefix.
+    """
+    return dict(iter_latest_objects(bucket_name, prefix, delimiter,
+                                    list_workers, exclude_regex))
 
 
 def create_primary_bq_table(table_id, dataset,
@@ -430,96 +926,378 @@ def create_primary_bq_table(table_id, dataset,
                         date_partition_field)
 
 
-def run(bucket_name, object_key, dest_dataset, path=None, lock=None,
-        alias=None):
+def run_direct(bucket_name, object_key, object_key_load, table_id,
+               dest_dataset, meta, write_disposition=None, job_id=None):
     """
-    Take object(s) and load them into BigQuery.
+    Load object(s) straight into the primary table partition, deriving the
+    partition columns from the object key with hive partitioning.
+    """
+    dp = meta['date_partition']
+
+    logging.info('{}: loading {}/{} directly into '
+                 'partition {}'.format(table_id, bucket_name,
+                                       describe_keys(object_key_load),
+                                       dp['value']))
+    with retryable_errors(table_id):
+        return load_parquet_to_bq(bucket_name, object_key_load, table_id,
+                                  dest_dataset,
+                                  partition=dp['value'].replace('-', ''),
+                                  hive_partitioning=get_hive_partitioning(
+                                      bucket_name, object_key, meta),
+                                  partition_field=dp['field'],
+                                  write_disposition=write_disposition,
+                                  job_id=job_id)
+
+
+def admit_item(item, dest_dataset, quotas, alias=None,
+               load_mode=DEFAULT_LOAD_MODE):
+    """
+    Take a quota token for the job an item will run against its
+    destination table: a load job in direct mode, otherwise a query job.
+    The load jobs of tmp mode go into tmp tables.
+
+    Returns 0 if the item is admitted, otherwise the number of seconds
+    until its table has quota again.
+    """
+    if quotas is None:
+        return 0
+
+    try:
+        meta = _get_object_key_metadata(item['object_key'])
+    except ValueError:
+        # the item fails later on, don't hold it back
+        return 0
+
+    table_id = alias or meta['table_id']
+    direct = effective_load_mode(load_mode, meta,
+                                 item.get('overwrite', False)) == 'direct'
+    operation = 'load' if direct else 'query'
+
+    return quotas.try_acquire(operation,
+                              '{}.{}'.format(dest_dataset, table_id))
+
+
+def prepare_task(bucket_name, object_key, dest_dataset, path=None,
+                 alias=None, load_mode=DEFAULT_LOAD_MODE, exclude_regex=(),
+                 fingerprint=None, overwrite=False, job_id_prefix=None,
+                 attempt=0, batch=None):
+    """
+    Parse an object key into the task the load stages work on.
+
+    If overwrite is set the object(s) replace the rows of their date and
+    extra partition values instead of being appended. If batch is set
+    all of its objects are loaded by the same jobs, see make_item.
+
+    With a job_id_prefix the job ids and the temp table name are derived
+    from the destination, the object key and its fingerprint, so a
+    restarted run reattaches to the jobs of the previous one. The temp
+    table and its load are specific to an attempt, the append is not.
+
+    Returns None if the object key is ignored.
     """
 
     # We don't care about these objects
-    if ignore_key(object_key):
+    if ignore_key(object_key, exclude_regex):
         logging.warning('Ignoring {}.'.format(object_key))
-        return
+        return None
 
     meta = _get_object_key_metadata(object_key)
     dp = meta['date_partition']
 
     table_id = alias or meta['table_id']
 
-    table_id_tmp = normalize_table_id('_'.join([meta['table_id'],
-                                      dp['value'],
-                                      gen_rand_string()]))
-
-    query = construct_select_query(table_id_tmp,
-                                   dp['field'],
-                                   dp['value'],
-                                   partitions=meta['partitions'])
+    if job_id_prefix:
+        digest = make_digest(dest_dataset, table_id, path or object_key,
+                             overwrite, *(fingerprint or ()))
+        table_id_tmp = normalize_table_id('_'.join([meta['table_id'],
+                                          dp['value'], digest[:12],
+                                          str(attempt)]))
+    else:
+        table_id_tmp = normalize_table_id('_'.join([meta['table_id'],
+                                          dp['value'],
+                                          gen_rand_string()]))
 
     # We assume that the data will have the following extensions
     if path:
         object_key_load = '{}/*'.format(path)
         if object_key.endswith('parquet'):
             object_key_load += 'parquet'
+    elif batch:
+        object_key_load = [key for key, _ in batch]
     else:
         object_key_load = object_key
 
+    if load_mode == 'direct' and not direct_load_supported(meta):
+        # once per table and process, the whole table falls back
+        if (HivePartitioningOptions is not None and
+                table_id not in _direct_fallback_tables):
+            _direct_fallback_tables.add(table_id)
+            logging.warning('{}: direct load not supported for date format '
+                            '{}, falling back to tmp table '
+                            'loads.'.format(table_id,
+                                            meta['date_partition']['format']))
+    load_mode = effective_load_mode(load_mode, meta, overwrite)
+
+    job_ids = {}
+    if job_id_prefix:
+        job_ids['append'] = '{}_append_{}'.format(job_id_prefix, digest)
+        if load_mode == 'direct':
+            job_ids['load'] = '{}_load_{}'.format(job_id_prefix, digest)
+        else:
+            job_ids['load'] = '{}_load_{}'.format(job_id_prefix,
+                                                  table_id_tmp)
+
+    return {
+        'key': path or object_key,
+        'bucket_name': bucket_name,
+        'object_key': object_key,
+        'object_key_load': object_key_load,
+        'dest_dataset': dest_dataset,
+        'table_id': table_id,
+        'table_id_tmp': table_id_tmp,
+        'tmp_created': False,
+        'load_mode': load_mode,
+        'fingerprint': fingerprint,
+        'overwrite': overwrite,
+        'batch': batch,
+        'job_ids': job_ids,
+        'meta': meta
+    }
+
+
+def stage_load(task):
+    """
+    Load the object(s) of a task into its temp table, or straight into
+    the primary table partition in direct mode. In external mode the
+    append query reads the object(s), there is nothing to load.
+
+    Returns False if there is nothing left to do for the task.
+    """
+    if task['load_mode'] == 'external':
+        return True
+
+    if task['load_mode'] == 'direct':
+        with timed('load'):
+            load_job = run_direct(task['bucket_name'], task['object_key'],
+                                  task['object_key_load'], task['table_id'],
+                                  task['dest_dataset'], task['meta'],
+                                  write_disposition=_write_disposition(task),
+                                  job_id=task['job_ids'].get('load'))
+        get_metrics().record_job(load_job)
+        task['load_job_id'] = load_job.job_id
+        task['state'] = STATE_APPENDED
+        return False
+
     # Create a temp table and load the data into temp table
-    try:
-        create_bq_table(table_id_tmp, DEFAULT_TMP_DATASET)
-        load_parquet_to_bq(bucket_name, object_key_load, table_id_tmp,
-                           DEFAULT_TMP_DATASET)
-    except (google.api_core.exceptions.InternalServerError,
-            google.api_core.exceptions.ServiceUnavailable):
-        delete_bq_table(table_id_tmp, dataset=DEFAULT_TMP_DATASET)
-        logging.exception('{}: BigQuery Retryable Error.'.format(table_id))
-        raise P2BWarning('BigQuery Retryable Error.')
+    with timed('tmp_create'), retryable_errors(task['table_id']):
+        created = create_bq_table(task['table_id_tmp'], DEFAULT_TMP_DATASET)
+        task['tmp_created'] = True
+
+    # a load done before the temp table was (re)created loaded nothing
+    # into this table
+    with timed('load'), retryable_errors(task['table_id']):
+        load_job = load_parquet_to_bq(task['bucket_name'],
+                                      task['object_key_load'],
+                                      task['table_id_tmp'],
+                                      DEFAULT_TMP_DATASET,
+                                      job_id=task['job_ids'].get('load'),
+                                      reuse_done=not created)
+    get_metrics().record_job(load_job)
+
+    task['load_job_id'] = load_job.job_id
+    task['state'] = STATE_LOADED_TMP
+    return True
+
+
+def stage_schema(task, schema_manager=None):
+    """
+    Create the primary table or add the new columns of the temp table
+    schema to it. In external mode this is left to the append query.
+    """
+    if task['load_mode'] == 'external':
+        return True
+
+    meta = task['meta']
+    dp = meta['date_partition']
 
     # Data is now loaded, we want to grab the schema of the table
-    try:
-        new_schema = generate_bq_schema(table_id_tmp,
+    with timed('schema_fetch'), \
+            retryable_errors(task['table_id'], 'GCS Retryable Error.'):
+        new_schema = generate_bq_schema(task['table_id_tmp'],
                                         DEFAULT_TMP_DATASET,
                                         dp['field'],
                                         meta['partitions'])
-    except (google.api_core.exceptions.InternalServerError,
-            google.api_core.exceptions.ServiceUnavailable):
-        logging.exception('{}: GCS Retryable Error.'.format(table_id))
-        raise P2BWarning('GCS Retryable Error.')
 
-    # Try to create the primary BigQuery table
-    with lock:
-        create_primary_bq_table(table_id, dest_dataset, new_schema,
-                                dp['field'])
+    schema_manager = schema_manager or SchemaManager()
+    with timed('schema_update'), retryable_errors(task['table_id']):
+        schema = schema_manager.merge_schema(task['table_id'],
+                                             task['dest_dataset'],
+                                             new_schema, dp['field'])
+
+    # the overwrite query selects every primary table column
+    task['columns'] = [field.name for field in schema]
+    task['tmp_columns'] = [field.name for field in new_schema]
+
+    return True
+
+
+def _write_disposition(task):
+    if task['overwrite']:
+        return bigquery.job.WriteDisposition.WRITE_TRUNCATE
+    return None
+
+
+@contextmanager
+def overwrite_lock(task, overwrite_locks=None):
+    """
+    Hold the lock of the date partition an overwrite replaces.
+
+    The overwrite query reads the other slices of the date partition and
+    truncates the partition with the result, overwrites of two slices of
+    the same date have to run one after the other or the last one drops
+    the rows of the other.
+    """
+    if overwrite_locks is None or not task['overwrite']:
+        yield
+        return
+
+    partition = '{}.{}${}'.format(
+        task['dest_dataset'], task['table_id'],
+        task['meta']['date_partition']['value'].replace('-', ''))
+    with overwrite_locks.get(partition):
+        yield
+
 
-    # Compare temp table schema with primary table schema
-    current_schema = get_bq_table_schema(table_id, dest_dataset)
-    schema_additions = get_schema_additions(current_schema, new_schema)
+def stage_append(task, overwrite_locks=None):
+    """
+    Append the temp table data to the primary table, or replace the
+    slice of its date partition in overwrite mode, under the date
+    partition lock of overwrite_locks (see overwrite_lock).
 
-    # If there are additions then update the primary table
-    if len(schema_additions) > 0:
-        update_bq_table_schema(table_id, schema_additions, dest_dataset)
+    In external mode the data is selected from a temporary external
+    table over the object(s) instead, named like the temp table.
+    """
+    dp = task['meta']['date_partition']
+    table_definitions = None
+    partition_field = None
+
+    if task['load_mode'] == 'external':
+        query = construct_select_query(task['table_id_tmp'],
+                                       dp['field'],
+                                       dp['value'],
+                                       partitions=task['meta']['partitions'],
+                                       dataset=None)
+        table_definitions = {
+            task['table_id_tmp']: get_external_config(
+                task['bucket_name'], task['object_key_load'])
+        }
+        partition_field = dp['field']
+        partition = None
+    elif task['overwrite']:
+        query = construct_overwrite_query(task['table_id_tmp'],
+                                          task['table_id'],
+                                          task['dest_dataset'],
+                                          task['columns'],
+                                          task['tmp_columns'],
+                                          dp['field'],
+                                          dp['value'],
+                                          partitions=task['meta'][
+                                              'partitions'])
+        partition = dp['value'].replace('-', '')
+    else:
+        query = construct_select_query(task['table_id_tmp'],
+                                       dp['field'],
+                                       dp['value'],
+                                       partitions=task['meta']['partitions'])
+        partition = None
 
     logging.info('{}: loading {}/{} to BigQuery '
-                 'table {}'.format(table_id,
-                                   bucket_name,
-                                   object_key_load,
-                                   table_id_tmp))
+                 'table {}'.format(task['table_id'],
+                                   task['bucket_name'],
+                                   describe_keys(task['object_key_load']),
+                                   task['table_id_tmp']))
     # Try to load the temp table data into primary table
+    with overwrite_lock(task, overwrite_locks), timed('append'), \
+            retryable_errors(task['table_id']):
+        query_job = load_bq_query_to_table(
+            query, task['table_id'], task['dest_dataset'],
+            partition=partition,
+            write_disposition=_write_disposition(task),
+            table_definitions=table_definitions,
+            partition_field=partition_field,
+            job_id=task['job_ids'].get('append'))
+    get_metrics().record_job(query_job)
+
+    task['query_job_id'] = query_job.job_id
+    task['state'] = STATE_APPENDED
+    return True
+
+
+def record_task(manifest, task):
+    """
+    Record the state a task reached in the manifest.
+    """
+    if manifest is None or 'state' not in task:
+        return
+
+    # the fingerprint is only recorded once the data is appended
+    objects = task['batch'] or [(task['key'], task['fingerprint'])]
+    if task['state'] != STATE_APPENDED:
+        objects = [(key, None) for key, _ in objects]
+
+    manifest.mark_objects(objects, task['state'],
+                          table_key='{}.{}'.format(task['dest_dataset'],
+                                                   task['table_id']),
+                          load_job_id=task.get('load_job_id'),
+                          query_job_id=task.get('query_job_id'))
+
+
+def run_stage(stage, task, manifest=None, *args):
+    """
+    Run a stage of a task and record the state it reached.
+    """
+    result = stage(task, *args)
+    record_task(manifest, task)
+
+    return result
+
+
+def run(bucket_name, object_key, dest_dataset, path=None, schema_manager=None,
+        alias=None, load_mode=DEFAULT_LOAD_MODE, exclude_regex=(),
+        manifest=None, fingerprint=None, overwrite=False, job_id_prefix=None,
+        attempt=0, batch=None, overwrite_locks=None):
+    """
+    Take object(s) and load them into BigQuery.
+
+    Runs the load, schema and append stages of the object(s) one after
+    the other, see _bulk_pipeline for the pipelined version.
+    """
+    task = prepare_task(bucket_name, object_key, dest_dataset, path=path,
+                        alias=alias, load_mode=load_mode,
+                        exclude_regex=exclude_regex,
+                        fingerprint=fingerprint, overwrite=overwrite,
+                        job_id_prefix=job_id_prefix, attempt=attempt,
+                        batch=batch)
+    if task is None:
+        return
+
     try:
-        load_bq_query_to_table(query, table_id, dest_dataset)
-    except (google.api_core.exceptions.InternalServerError,
-            google.api_core.exceptions.ServiceUnavailable):
-        logging.exception('{}: BigQuery Retryable Error'.format(table_id))
-        raise P2BWarning('BigQuery Retryable Error')
+        if run_stage(stage_load, task, manifest):
+            stage_schema(task, schema_manager)
+            run_stage(stage_append, task, manifest, overwrite_locks)
     finally:
-        delete_bq_table(table_id_tmp)
+        if task['tmp_created']:
+            with timed('delete'):
+                delete_bq_table(task['table_id_tmp'])
 
 
 def get_bq_table_partitions(table_id, date_partition_field,
                             data_partition_format,
                             path_prefix,
-                            dataset, partitions=[]):
+                            dataset, partitions=[], window=None):
     """
-    Get all the partitions available in a BigQuery table.
+    Get all the partitions available in a BigQuery table, or only those
+    in a date window, see window.make_window.
     This is used for resume operations.
     """
     client, table_ref = get_bq_client(table_id, dataset)
@@ -541,14 +1319,21 @@ def get_bq_table_partitions(table_id, date_partition_field,
     select_cols[0] = date_partition_field
     group_cols = ','.join(select_cols)
 
+    # a filter on the partition column prunes the partitions scanned
+    where = ''
+    if window is not None:
+        where = 'WHERE {}'.format(window_predicate(window,
+                                                   date_partition_field))
+
     query = """
     SELECT {2}
     FROM {0}.{1}
+    {4}
     GROUP BY {3}
-    """.format(dataset, table_id, _select_cols, group_cols)
+    """.format(dataset, table_id, _select_cols, group_cols, where)
 
     query_job = client.query(query)
-    results = query_job.result()
+    results = wait_for_job(query_job)
 
     for row in results:
         tmp_path = []
@@ -578,104 +1363,1000 @@ def remove_loaded_objects(objects, dataset, alias):
 
     """
 
-    initial_object_tmp = list(objects)[0]
-    meta = _get_object_key_metadata(initial_object_tmp)
+    if not objects:
+        return objects
+
+    for key in get_loaded_paths(list(objects)[0], dataset, alias):
+        if objects.pop(key, False):
+            logging.info('key {} already loaded into BigQuery'.format(key))
+
+    return objects
+
+
+def get_loaded_paths(initial_object, dataset, alias, window=None):
+    """
+    Return the reconstructed paths of all partitions already loaded into
+    the BigQuery table the initial object belongs to, or only of those
+    in a date window.
+    """
+    meta = _get_object_key_metadata(initial_object)
     dp = meta['date_partition']
 
-    path_prefix = initial_object_tmp.split('/')[:meta['first_part_idx']]
+    path_prefix = initial_object.split('/')[:meta['first_part_idx']]
 
     table_id = alias or meta['table_id']
 
     if not check_bq_table_exists(table_id, dataset):
-        return objects
+        return []
 
-    object_paths = get_bq_table_partitions(table_id,
-                                           dp['field'],
-                                           dp['format'],
-                                           path_prefix,
-                                           dataset,
-                                           meta['partitions'])
+    return get_bq_table_partitions(table_id,
+                                   dp['field'],
+                                   dp['format'],
+                                   path_prefix,
+                                   dataset,
+                                   meta['partitions'],
+                                   window=window)
 
-    for key in object_paths:
-        if objects.pop(key, False):
-            logging.info('key {} already loaded into BigQuery'.format(key))
 
-    return objects
+def _in_prefixes(key, prefixes):
+    """
+    Check if a key is one of a set of prefixes or under one of them.
+    """
+    end = len(key)
+    while end > 0:
+        if key[:end] in prefixes:
+            return True
+        end = key.rfind('/', 0, end)
+    return False
+
+
+def filter_loaded_objects(objects, dataset, alias, manifest=None,
+                          window=None, glob_load=True, prefixes=None):
+    """
+    Streaming version of remove_loaded_objects. Takes an iterable of
+    listing records, (key, object_key[, fingerprint, objects]) tuples,
+    and yields those which have not been loaded into BigQuery yet.
+
+    The loaded partitions are fetched once the first object is known.
+    Without glob_load the key is an object key, which counts as loaded
+    if the partition of its directory is. The records left out are
+    recorded as appended in the manifest if one is given, with their
+    fingerprint. The objects are expected to be in window, if one is
+    given.
+
+    If prefixes is set, a set of directories without slash, only the
+    records under them are checked, the others are yielded as is.
+    """
+    loaded_paths = None
+    loaded = []
+
+    for record in objects:
+        key = record[0]
+        if prefixes is not None and not _in_prefixes(key, prefixes):
+            yield record
+            continue
+
+        path = key if glob_load else key.rpartition('/')[0]
+        if loaded_paths is None:
+            loaded_paths = Inventory.from_keys(
+                get_loaded_paths(key, dataset, alias, window))
+
+        if path not in loaded_paths:
+            yield record
+            continue
+
+        logging.info('key {} already loaded into BigQuery'.format(key))
+        if manifest is not None:
+            loaded.append((key, record[2] if len(record) > 2 else None))
+            if len(loaded) >= BATCH_SIZE:
+                manifest.mark_objects(loaded, STATE_APPENDED)
+                loaded = []
+
+    if loaded:
+        manifest.mark_objects(loaded, STATE_APPENDED)
+
+
+def _iter_manifest_objects(manifest, prefixes, state, fingerprinted=False):
+    if isinstance(prefixes, str):
+        prefixes = [prefixes]
+    for prefix in prefixes:
+        for record in manifest.iter_objects(prefix, state, fingerprinted):
+            yield record
+
+
+def filter_appended_objects(objects, manifest, prefix, key=None):
+    """
+    Yield the objects which are not recorded as appended in the manifest.
+
+    key returns the manifest key of an object, the object itself by
+    default. prefix may be a list of prefixes, e.g. the partitions of a
+    date window.
+    """
+    appended = Inventory.from_records(
+        _iter_manifest_objects(manifest, prefix, STATE_APPENDED))
+    logging.info('main_process: {} objects already appended according '
+                 'to the manifest'.format(len(appended)))
+
+    for obj in objects:
+        if (key(obj) if key else obj) in appended:
+            continue
+        yield obj
+
+
+def filter_changed_objects(records, manifest, prefix, adopt=True):
+    """
+    Compare listing records, (key, object_key, fingerprint, ...) tuples,
+    to the fingerprints of the objects appended in earlier runs.
+
+    Yields a (record, changed) tuple for every new or changed object.
+    Objects appended without a fingerprint (by a run without sync) are
+    considered loaded and, if adopt is set, take the fingerprint of the
+    listing. Objects queued again since they were appended, e.g. by an
+    overwrite which didn't finish, keep the fingerprint they were
+    appended with and are still changed. prefix may be a list of
+    prefixes.
+    """
+    synced = Inventory.from_records(
+        _iter_manifest_objects(manifest, prefix, STATE_APPENDED,
+                               fingerprinted=True))
+    adopted = []
+    counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+
+    for record in records:
+        key, fingerprint = record[0], tuple(record[2])
+
+        i = synced.find(key)
+        if i < 0:
+            counts['new'] += 1
+            yield record, False
+            continue
+
+        synced_fingerprint = synced.fingerprint(i)
+        if synced_fingerprint is None:
+            if adopt:
+                adopted.append((key, fingerprint))
+            if len(adopted) >= BATCH_SIZE:
+                manifest.set_fingerprints(adopted)
+                adopted = []
+        elif synced_fingerprint != fingerprint:
+            counts['changed'] += 1
+            yield record, True
+            continue
+
+        counts['unchanged'] += 1
+
+    if adopted:
+        manifest.set_fingerprints(adopted)
+
+    logging.info('main_process: sync found {new} new, {changed} changed '
+                 'and {unchanged} unchanged objects'.format(**counts))
+
+
+def skip_changed_objects(records):
+    """
+    Leave out the changed objects of filter_changed_objects. An object
+    can't be replaced on its own, appending it again would keep its old
+    rows next to the new ones.
+    """
+    for record, changed in records:
+        if changed:
+            logging.warning('main_process: {} changed since it was '
+                            'loaded, skipping it, reload its directory '
+                            'with --glob-load and --sync-overwrite or '
+                            '--write-mode overwrite'.format(record[0]))
+            get_metrics().incr('objects_changed_skipped')
+            continue
+        yield record, changed
+
+
+def iter_work_items(bucket_name, prefix, glob_load, resume_load, dataset,
+                    alias=None, list_workers=1, exclude_regex=(),
+                    manifest=None, sync=False, sync_overwrite=False,
+                    fingerprints=False, dry_run=False,
+                    write_mode=DEFAULT_WRITE_MODE, batch_bytes=None,
+                    batch_max_uris=DEFAULT_BATCH_MAX_URIS,
+                    order=DEFAULT_ORDER, window=None):
+    """
+    List a bucket prefix and yield the work items to load, once the glob
+    reduction and the resume or sync filtering are applied.
+
+    With a date window, see window.make_window, only the date partitions
+    in the window are listed, looked up in the manifest and queried on
+    resume.
+
+    The items carry the fingerprint and number of objects they load if
+    sync or fingerprints is set. Nothing is written to the manifest in
+    dry_run mode. Without glob_load the objects are combined into batch
+    items if batch_bytes is set, see batch_items. Items are yielded in
+    the given order, see order_items.
+    """
+    fingerprints = (fingerprints or sync or bool(batch_bytes) or
+                    order == 'largest')
+
+    shards = None
+    manifest_prefixes = [prefix] if isinstance(prefix, str) else prefix
+    if window is not None:
+        shards = list_window_prefixes(bucket_name, prefix, window)
+        # a glob path can be the date partition itself, without the slash
+        manifest_prefixes = [shard.rstrip('/') for shard in shards]
+
+    # the manifest is consulted first on resume, BigQuery is only
+    # queried for the prefixes (the date partitions of a window) the
+    # manifest has nothing about, a cold start
+    cold_prefixes = set(
+        p for p in manifest_prefixes
+        if manifest is None or not manifest.has_prefix(p))
+    warm_start = len(cold_prefixes) < len(manifest_prefixes)
+    if warm_start:
+        logging.info('main_process: resuming from manifest {} '
+                     '{}'.format(manifest.path, manifest.counts(prefix)))
+        if cold_prefixes:
+            logging.info('main_process: {} of {} date partitions are not '
+                         'in the manifest, resuming them from '
+                         'BigQuery'.format(len(cold_prefixes),
+                                           len(manifest_prefixes)))
+    # None checks every record
+    cold_filter = None if not warm_start else cold_prefixes
+
+    # records are (key, object_key[, fingerprint, objects]) tuples, the
+    # key is the glob path or the object key
+    if glob_load:
+        records = iter_latest_objects(bucket_name, prefix,
+                                      list_workers=list_workers,
+                                      exclude_regex=exclude_regex,
+                                      fingerprints=fingerprints,
+                                      shards=shards)
+    elif fingerprints:
+        records = ((object_key, object_key, fingerprint, 1)
+                   for object_key, fingerprint in iter_blobs_with_prefix(
+                       bucket_name, prefix, list_workers=list_workers,
+                       exclude_regex=exclude_regex, fingerprints=True,
+                       shards=shards))
+    else:
+        records = ((object_key, object_key)
+                   for object_key in iter_blobs_with_prefix(
+                       bucket_name, prefix, list_workers=list_workers,
+                       exclude_regex=exclude_regex, shards=shards))
+
+    if sync:
+        # the manifest of a cold start doesn't know what was loaded
+        # without it, the partitions of the table are left out
+        if cold_prefixes:
+            records = filter_loaded_objects(records, dataset, alias,
+                                            None if dry_run else manifest,
+                                            window=window,
+                                            glob_load=glob_load,
+                                            prefixes=cold_filter)
+        # changed glob paths are overwritten, see check_write_options,
+        # changed objects can't be
+        records = filter_changed_objects(records, manifest,
+                                         manifest_prefixes,
+                                         adopt=not dry_run)
+        if not glob_load:
+            records = skip_changed_objects(records)
+    else:
+        if resume_load and warm_start:
+            records = filter_appended_objects(records, manifest,
+                                              manifest_prefixes,
+                                              key=lambda r: r[0])
+        if resume_load and glob_load and cold_prefixes:
+            records = filter_loaded_objects(records, dataset, alias,
+                                            None if dry_run else manifest,
+                                            window=window,
+                                            prefixes=cold_filter)
+        records = ((record, False) for record in records)
+
+    items = (make_item(bucket_name, record[1],
+                       record[0] if glob_load else None,
+                       fingerprint=record[2] if fingerprints else None,
+                       overwrite=(write_mode == 'overwrite' or
+                                  sync_overwrite and changed),
+                       objects=record[3] if fingerprints else None,
+                       alias=alias, dataset=dataset)
+             for record, changed in records)
+
+    if batch_bytes and not glob_load:
+        items = batch_items(items, batch_bytes, batch_max_uris)
+
+    for item in order_items(items, order):
+        yield item
+
+
+def _item_date(object_key):
+    """
+    Return the date partition of an object key as a YYYYMMDD integer, 0
+    if the key can't be parsed.
+    """
+    try:
+        meta = _get_object_key_metadata(object_key)
+    except ValueError:
+        return 0
+    return int(meta['date_partition']['value'].replace('-', ''))
+
+
+def order_items(items, order=DEFAULT_ORDER):
+    """
+    Order work items by one of ORDERS: as listed, largest first (by the
+    size in their fingerprint, the whole directory in glob mode), newest
+    or oldest date partition first. Items with the same size or date
+    keep their listing order, unparsable items go last.
+
+    Any order but listing has to wait for listing to finish. The items
+    are held in an Inventory meanwhile, and rebuilt once ordered.
+    """
+    if order == 'listing':
+        return items
+    if order not in ORDERS:
+        raise ValueError('unknown order {}, expected one of '
+                         '{}'.format(order, ', '.join(ORDERS)))
+
+    return _iter_ordered(items, order)
+
+
+def _iter_ordered(items, order):
+    inventory = Inventory()
+    dates = array('l')
+    # the bucket, alias, dataset and write mode shared by most items
+    contexts = []
+    context_ids = {}
+    item_contexts = array('L')
+    # batch items are few and carry their objects, they are kept as is
+    batches = {}
+
+    for item in items:
+        context = (item['bucket_name'], item['alias'], item['dataset'],
+                   item['overwrite'], item['path'] is not None)
+        context_id = context_ids.get(context)
+        if context_id is None:
+            context_id = context_ids[context] = len(contexts)
+            contexts.append(context)
+
+        if item['batch']:
+            batches[len(inventory)] = item
+
+        item_contexts.append(context_id)
+        dates.append(_item_date(item['object_key']))
+        inventory.add(item['path'] or item['object_key'], item['fingerprint'],
+                      item['objects'],
+                      latest=item['object_key'] if item['path'] else None)
+
+    logging.info('main_process: ordering {} items {} first, {} bytes '
+                 'held'.format(len(inventory), order, inventory.nbytes()))
+
+    # unparsable items have date 0
+    if order == 'largest':
+        indexes = sorted(range(len(inventory)), key=inventory.size,
+                         reverse=True)
+    elif order == 'newest':
+        indexes = sorted(range(len(inventory)), key=dates.__getitem__,
+                         reverse=True)
+    else:
+        indexes = sorted(range(len(inventory)),
+                         key=lambda i: dates[i] or 99999999)
+
+    for i in indexes:
+        if i in batches:
+            yield batches.pop(i)
+            continue
+
+        bucket_name, alias, dataset, overwrite, glob = \
+            contexts[item_contexts[i]]
+        yield make_item(bucket_name, inventory.latest(i),
+                        inventory.key(i) if glob else None,
+                        fingerprint=inventory.fingerprint(i),
+                        overwrite=overwrite,
+                        objects=inventory.objects(i) or None,
+                        alias=alias, dataset=dataset)
+
+
+def batch_items(items, batch_bytes, max_uris=DEFAULT_BATCH_MAX_URIS):
+    """
+    Combine object items of the same table, date and extra partition
+    values into batch items of up to batch_bytes and max_uris objects,
+    each loaded with one load job and one append query. Items need a
+    fingerprint for their size.
+
+    A batch is yielded once it is full, or once listing has moved past
+    it: sharded listing fills at most one batch per shard at a time, so
+    the least recently filled batch is complete once more than
+    BATCH_OPEN_GROUPS batches are open.
+    """
+    # group -> [first item, [(object_key, fingerprint)], size]
+    open_batches = OrderedDict()
+
+    def _emit(group):
+        item, batch, _ = open_batches.pop(group)
+        if len(batch) == 1:
+            return item
+
+        fingerprint = DirectoryFingerprint()
+        for object_key, object_fingerprint in batch:
+            fingerprint.add_object(object_key, object_fingerprint)
+
+        return make_item(item['bucket_name'], item['object_key'],
+                         fingerprint=fingerprint.fingerprint(),
+                         overwrite=item['overwrite'],
+                         objects=fingerprint.objects,
+                         alias=item['alias'], dataset=item['dataset'],
+                         batch=batch)
+
+    for item in items:
+        try:
+            meta = _get_object_key_metadata(item['object_key'])
+        except ValueError:
+            # the item fails or is ignored on its own
+            yield item
+            continue
+
+        group = (meta['table_id'], meta['date_partition']['value'],
+                 tuple(map(tuple, meta['partitions'])), item['overwrite'])
+
+        entry = open_batches.get(group)
+        if entry is None:
+            entry = open_batches[group] = [item, [], 0]
+        else:
+            open_batches.move_to_end(group)
+
+        entry[1].append((item['object_key'], item['fingerprint']))
+        entry[2] += item['fingerprint'][1] or 0
+
+        if entry[2] >= batch_bytes or len(entry[1]) >= max_uris:
+            yield _emit(group)
+        elif len(open_batches) > BATCH_OPEN_GROUPS:
+            yield _emit(next(iter(open_batches)))
+
+    for group in list(open_batches):
+        yield _emit(group)
+
+
+def iter_source_items(bucket_name, sources, glob_load, resume_load, dataset,
+                      **kwargs):
+    """
+    Run iter_work_items for every source, see sources.get_sources, and
+    interleave their items by source weight so the tables of a run share
+    the workers fairly. Each source is listed with list_workers threads.
+
+    In listing order the sources are listed side by side, as their items
+    are taken. Any other order waits for the listing of a source to
+    finish before its first item, see order_items, so the sources are
+    listed one after the other.
+
+    A source without a dataset is loaded into dataset.
+    """
+    items = []
+    for source in sources:
+        logging.info('main_process: loading {} into dataset {} with '
+                     'weight {}'.format(source['prefix'],
+                                        source['dataset'] or dataset,
+                                        source['weight']))
+        items.append(iter_work_items(bucket_name, source['prefix'],
+                                     glob_load, resume_load,
+                                     source['dataset'] or dataset,
+                                     alias=source['alias'], **kwargs))
+
+    return interleave(items, [source['weight'] for source in sources])
+
+
+def check_write_options(glob_load, manifest=None, sync=False,
+                        sync_overwrite=False, write_mode=DEFAULT_WRITE_MODE):
+    """
+    Validate the combination of sync and write options.
+
+    An overwrite replaces the whole slice of a date and extra partition
+    values, so it needs every object of the slice in one item, i.e.
+    glob_load. A glob path changes with any of its objects, a sync in
+    glob_load mode has to overwrite it rather than append it again.
+    """
+    if write_mode not in WRITE_MODES:
+        raise ValueError('write_mode must be one of {}'.format(WRITE_MODES))
+    if sync and not manifest:
+        raise ValueError('sync requires a manifest')
+    if sync_overwrite and not (sync and glob_load):
+        raise ValueError('sync_overwrite requires sync and glob_load')
+    if sync and glob_load and not sync_overwrite:
+        raise ValueError('sync with glob_load requires sync_overwrite')
+    if write_mode == 'overwrite' and not glob_load:
+        raise ValueError('overwrite write_mode requires glob_load')
 
 
 def bulk(bucket_name, prefix, concurrency, glob_load, resume_load,
-         dest_dataset=None, alias=None):
+         dest_dataset=None, alias=None, pool_size=DEFAULT_POOL_SIZE,
+         load_mode=DEFAULT_LOAD_MODE, queue_size=DEFAULT_QUEUE_SIZE,
+         list_workers=DEFAULT_LIST_WORKERS, exclude_regex=(),
+         lock_stripes=DEFAULT_LOCK_STRIPES, inflight=DEFAULT_INFLIGHT,
+         poll_interval=DEFAULT_POLL_INTERVAL, pipeline=False,
+         max_attempts=DEFAULT_MAX_ATTEMPTS, backoff_base=DEFAULT_BACKOFF_BASE,
+         backoff_max=DEFAULT_BACKOFF_MAX, dead_letter=None, quotas=None,
+         admission_control=True, manifest=None, sync=False,
+         sync_overwrite=False, report=None, prometheus=None,
+         progress_interval=DEFAULT_PROGRESS_INTERVAL,
+         write_mode=DEFAULT_WRITE_MODE, job_id_prefix=DEFAULT_JOB_ID_PREFIX,
+         sources=None, batch_bytes=None,
+         batch_max_uris=DEFAULT_BATCH_MAX_URIS, order=DEFAULT_ORDER,
+         queue=None, queue_authkey=None, profile=None, start_date=None,
+         end_date=None, dates=None):
     """
     Load data into BigQuery concurrently
     Args:
         bucket_name: gcs bucket name (str)
-        prefix: object key path, 'dataset/version' (str)
+        prefix: object key path, 'dataset/version', or a list of
+                them (str or list)
         concurrency: number of processes to handle the load (int)
         glob_load: load data by globbing path dirs (boolean)
         resume_load: resume load (boolean)
         dest_dataset: override default dataset location (str)
         alias: override object key dervived table name (str)
+        pool_size: HTTP connection pool size per process (int)
+        load_mode: one of LOAD_MODES (str)
+        queue_size: max number of queued tasks, listing blocks while
+                    the queue is full (int)
+        list_workers: number of partition prefixes listed
+                      concurrently (int)
+        exclude_regex: additional object key patterns to ignore (list)
+        lock_stripes: number of locks table schema updates are
+                      spread over (int)
+        inflight: number of objects each process works on
+                  concurrently (int)
+        poll_interval: seconds between BigQuery job polls (float)
+        pipeline: run the load stages of each process as a
+                  pipeline (boolean)
+        max_attempts: attempts before an object is dead lettered (int)
+        backoff_base: first retry delay in seconds, doubled for every
+                      further attempt (float)
+        backoff_max: max retry delay in seconds (float)
+        dead_letter: file objects which ran out of attempts are
+                     written to (str)
+        quotas: per table quota overrides, operation ->
+                (capacity, seconds) (dict)
+        admission_control: defer items whose destination table is out
+                           of quota (boolean)
+        manifest: path of the local manifest, which records the state of
+                  every object and is used to resume without querying
+                  BigQuery (str)
+        sync: only load the objects which are new or changed since the
+              last run, according to the manifest, changed objects are
+              skipped without glob_load (boolean)
+        sync_overwrite: replace the partitions of changed directories
+                        instead of appending them again, requires
+                        glob_load and is required by sync with
+                        glob_load (boolean)
+        report: file the JSON run report is written to (str)
+        prometheus: Prometheus textfile kept up to date with the run
+                    metrics (str)
+        progress_interval: seconds between throughput and ETA log
+                           lines (float)
+        write_mode: one of WRITE_MODES, overwrite replaces the partition
+                    slice of every glob path so reruns and retries never
+                    duplicate rows, requires glob_load (str)
+        job_id_prefix: prefix of deterministic job ids, which let a
+                       restarted run reattach to the jobs of the previous
+                       one. Jobs already done are not run again, use a
+                       new prefix to reload, e.g. once the table was
+                       dropped or truncated. None, the default, for
+                       random job ids (str)
+        sources: additional sources, see sources.make_source, loaded
+                 by the same workers. Their items are interleaved by
+                 source weight (list)
+        batch_bytes: without glob_load, load the objects of the same
+                     table, date and extra partition values in batches
+                     of about this many bytes (int)
+        batch_max_uris: max number of objects per batch (int)
+        order: one of ORDERS, the order the items of each source are
+               queued in. Largest first shortens the tail of a backfill,
+               newest first lands recent data first (str)
+        queue: work queue, see workqueue.open_work_queue. With a
+               sqlite: or tcp:// queue, workers started on other hosts
+               with work() share the items of this run, and concurrency
+               may be 0 (str)
+        queue_authkey: authkey of a tcp:// queue (str)
+        profile: directory the profile of every worker process and of
+                 the listing are written to, and merged into
+                 merged.prof, merged.collapsed (flamegraph stacks) and
+                 merged.txt at the end of the run (str)
+        start_date: first date partition to load, YYYY-MM-DD or
+                    YYYYMMDD (str)
+        end_date: last date partition to load (str)
+        dates: date partitions to load, alone or within start_date and
+               end_date. Only the date partitions of the window are
+               listed and checked on resume (list)
     """
+    check_write_options(glob_load, manifest, sync, sync_overwrite,
+                        write_mode)
+    check_load_mode(load_mode)
+    _sources = get_sources(prefix, alias, sources)
+    window = make_window(start_date, end_date, dates)
 
     _dest_dataset = dest_dataset or DEFAULT_DATASET
+    started = time.time()
 
     logging.info('main_process: dataset set to {}'.format(_dest_dataset))
 
-    q = JoinableQueue()
-    lock = Lock()
+    if not concurrency and queue in (None, 'local'):
+        raise ValueError('concurrency 0 requires a shared queue')
+
+    q = open_work_queue(queue, queue_size, queue_authkey)
+    # workers of other hosts load with the options of this run
+    q.set_options({'dest_dataset': _dest_dataset,
+                   'load_mode': load_mode,
+                   'exclude_regex': list(exclude_regex),
+                   'job_id_prefix': job_id_prefix})
+
+    # table schemas are cached and updated under per table locks shared
+    # by all the workers
+    manager = Manager()
+
+    # per table token buckets, work for a table without quota is
+    # deferred while other tables continue
+    table_quotas = None
+    if admission_control:
+        table_quotas = TableQuotas.shared(manager, quotas, lock_stripes)
+
+    schema_manager = SchemaManager.shared(manager, lock_stripes,
+                                          table_quotas)
+
+    # overwrites of the same date partition run one after the other
+    overwrite_locks = StripedLocks.shared(lock_stripes)
+
+    # workers publish their metrics snapshots here
+    metrics = manager.dict()
+    init_metrics()
+    reporter = RunReporter(metrics, progress_interval, prometheus)
+
+    _manifest = Manifest(manifest) if manifest else None
+
+    run_kwargs = {'schema_manager': schema_manager,
+                  'overwrite_locks': overwrite_locks,
+                  'load_mode': load_mode,
+                  'exclude_regex': exclude_regex,
+                  'manifest': _manifest,
+                  'job_id_prefix': job_id_prefix}
+
+    retry_kwargs = {'max_attempts': max_attempts,
+                    'backoff_base': backoff_base,
+                    'backoff_max': backoff_max,
+                    'dead_letter': dead_letter}
+
+    # workers are started first so they can consume tasks while
+    # listing is still running
+    processes = _start_workers(concurrency, q, _dest_dataset, run_kwargs,
+                               pool_size=pool_size, inflight=inflight,
+                               poll_interval=poll_interval,
+                               pipeline=pipeline, retry_kwargs=retry_kwargs,
+                               quotas=table_quotas, metrics=metrics,
+                               profile=profile)
+
+    # started after the workers are forked, which profile themselves
+    profiler = start_profiler(profile, 'main_process')
+
+    logging.info('main_process: loading via {} '
+                 'method'.format('glob' if glob_load else 'non-glob'))
+    tasks = iter_source_items(bucket_name, _sources, glob_load, resume_load,
+                              _dest_dataset, list_workers=list_workers,
+                              exclude_regex=exclude_regex,
+                              manifest=_manifest, sync=sync,
+                              sync_overwrite=sync_overwrite,
+                              write_mode=write_mode,
+                              fingerprints=bool(job_id_prefix),
+                              batch_bytes=batch_bytes,
+                              batch_max_uris=batch_max_uris, order=order,
+                              window=window)
+
+    queued = ManifestWriter(_manifest, STATE_QUEUED) if _manifest else None
+
+    total_tasks = 0
+    for task in tasks:
+        if queued and task['batch']:
+            for object_key, _ in task['batch']:
+                queued.add(object_key)
+        elif queued:
+            queued.add(task['path'] or task['object_key'])
+        q.put(task)
+        total_tasks += 1
+        reporter.queued = total_tasks
+
+    if queued:
+        queued.flush()
+    reporter.listing_done = True
+
+    if profiler is not None:
+        profiler.stop()
+
+    logging.info('main_process: {} total tasks queued'.format(total_tasks))
 
-    if glob_load:
-        logging.info('main_process: loading via glob method')
-        object_keys = get_latest_object(bucket_name, prefix)
-        if resume_load:
-            object_keys = remove_loaded_objects(object_keys,
-                                                _dest_dataset, alias)
-
-        for path, object_key in object_keys.items():
-            q.put((bucket_name, path, object_key))
-    else:
-        logging.info('main_process: loading via non-glob method')
-        object_keys = list_blobs_with_prefix(bucket_name, prefix)
-        for object_key in object_keys:
-            q.put((bucket_name, None, object_key))
+    q.join()
 
-    for c in range(concurrency):
-        p = Process(target=_bulk_run, args=(c, lock, q, _dest_dataset, alias,))
-        p.daemon = True
-        p.start()
+    # one sentinel per worker thread, or per process when pipelined
+    q.close(concurrency if pipeline else concurrency * inflight)
 
-    logging.info('main_process: {} total tasks in queue'.format(q.qsize()))
+    for p in processes:
+        p.join()
 
-    q.join()
+    run_report = reporter.close()
+    if report:
+        write_report(report, run_report)
+    if profile:
+        merge_profiles(profile, since=started)
 
-    for c in range(concurrency):
-        q.put(None)
+    q.shutdown()
+    manager.shutdown()
+    logging.info('main_process: done')
 
-    p.join()
+
+def work(queue, concurrency, queue_authkey=None, pool_size=DEFAULT_POOL_SIZE,
+         lock_stripes=DEFAULT_LOCK_STRIPES, inflight=DEFAULT_INFLIGHT,
+         poll_interval=DEFAULT_POLL_INTERVAL, pipeline=False,
+         max_attempts=DEFAULT_MAX_ATTEMPTS, backoff_base=DEFAULT_BACKOFF_BASE,
+         backoff_max=DEFAULT_BACKOFF_MAX, dead_letter=None, quotas=None,
+         admission_control=True, manifest=None, report=None,
+         prometheus=None, progress_interval=DEFAULT_PROGRESS_INTERVAL,
+         profile=None):
+    """
+    Load the items of a bulk() run on another host
+    Args:
+        queue: the sqlite: or tcp:// work queue of the run (str)
+        concurrency: number of processes to handle the load (int)
+        queue_authkey: authkey of a tcp:// queue (str)
+
+    The other arguments are those of bulk(). Dataset, load mode, ignore
+    patterns and job id prefix are the ones of the run. Table quotas and
+    the date partition locks of overwrites are per host, schema updates
+    are safe across hosts: overwrite runs should use the workers of a
+    single host. Returns once the run is done.
+    """
+    started = time.time()
+    q = open_work_queue(queue, authkey=queue_authkey, coordinator=False)
+    options = q.get_options()
+
+    logging.info('main_process: working on {} with dataset '
+                 '{}'.format(queue, options['dest_dataset']))
+
+    manager = Manager()
+
+    table_quotas = None
+    if admission_control:
+        table_quotas = TableQuotas.shared(manager, quotas, lock_stripes)
+
+    schema_manager = SchemaManager.shared(manager, lock_stripes,
+                                          table_quotas)
+    overwrite_locks = StripedLocks.shared(lock_stripes)
+
+    metrics = manager.dict()
+    init_metrics()
+    reporter = RunReporter(metrics, progress_interval, prometheus)
+    reporter.listing_done = True
+
+    run_kwargs = {'schema_manager': schema_manager,
+                  'overwrite_locks': overwrite_locks,
+                  'load_mode': options['load_mode'],
+                  'exclude_regex': options['exclude_regex'],
+                  'manifest': Manifest(manifest) if manifest else None,
+                  'job_id_prefix': options['job_id_prefix']}
+
+    retry_kwargs = {'max_attempts': max_attempts,
+                    'backoff_base': backoff_base,
+                    'backoff_max': backoff_max,
+                    'dead_letter': dead_letter}
+
+    processes = _start_workers(concurrency, q, options['dest_dataset'],
+                               run_kwargs, pool_size=pool_size,
+                               inflight=inflight, poll_interval=poll_interval,
+                               pipeline=pipeline, retry_kwargs=retry_kwargs,
+                               quotas=table_quotas, metrics=metrics,
+                               profile=profile)
+
+    # workers stop once the coordinator closed the queue and it is empty
+    for p in processes:
+        p.join()
+
+    run_report = reporter.close()
+    if report:
+        write_report(report, run_report)
+    if profile:
+        merge_profiles(profile, since=started)
+
+    q.shutdown()
+    manager.shutdown()
     logging.info('main_process: done')
 
 
-def _bulk_run(process_id, lock, q, dest_dataset, alias):
+def _start_workers(concurrency, q, dest_dataset, run_kwargs, **kwargs):
+    """
+    Start the worker processes, see _bulk_run.
+    """
+    processes = []
+    for c in range(concurrency):
+        p = Process(target=_bulk_run,
+                    args=(c, q, dest_dataset, run_kwargs,),
+                    kwargs=kwargs)
+        p.daemon = True
+        p.start()
+        processes.append(p)
+
+    return processes
+
+
+def _bulk_run(process_id, q, dest_dataset, run_kwargs,
+              pool_size=DEFAULT_POOL_SIZE, inflight=DEFAULT_INFLIGHT,
+              poll_interval=DEFAULT_POLL_INTERVAL, pipeline=False,
+              retry_kwargs=None, quotas=None, metrics=None, profile=None):
     """
     Process run job
+
+    Runs `inflight` worker threads, or a stage pipeline, which share the
+    process clients and hand their BigQuery jobs to a single job poller.
+    Failed items are retried with backoff by the process retry scheduler.
     """
     logging.info('Process-{}: started'.format(process_id))
+    profiler = start_profiler(profile, 'Process-{}'.format(process_id))
+
+    # clients are created once per process and reused for every object
+    init_client_pool(pool_size)
+    init_job_poller(poll_interval)
+    init_metrics()
+    retries = RetryScheduler(q, **(retry_kwargs or {}))
+
+    publisher = None
+    if metrics is not None:
+        publisher = MetricsPublisher(metrics, process_id)
+
+    def _admit(item):
+        wait = admit_item(item, item.get('dataset') or dest_dataset, quotas,
+                          alias=item.get('alias'),
+                          load_mode=run_kwargs.get('load_mode'))
+        if wait:
+            # spread the deferred items of a table over time
+            wait += random.uniform(0, wait)
+            logging.info('Process-{}: table quota exhausted, deferring {} '
+                         'for {:.1f}s'.format(process_id,
+                                              item['path'] or
+                                              item['object_key'], wait))
+            get_metrics().incr('deferred')
+            retries.defer(item, wait)
+            return False
+        return True
+
+    if pipeline:
+        _bulk_pipeline(process_id, q, dest_dataset, run_kwargs, inflight,
+                       retries, _admit)
+    else:
+        threads = start_threads(_bulk_worker, inflight,
+                                'Process-{}'.format(process_id),
+                                args=(process_id, q, dest_dataset,
+                                      run_kwargs, retries, _admit))
+        for thread in threads:
+            thread.join()
 
+    if profiler is not None:
+        profiler.stop()
+
+    if publisher is not None:
+        publisher.close()
+
+    logging.info('Process-{}: done'.format(process_id))
+
+
+def _bulk_worker(thread_id, process_id, q, dest_dataset, run_kwargs,
+                 retries, admit):
+    """
+    Worker thread job
+    """
     for item in iter(q.get, None):
-        bucket_name, path, object_key = item
+        # deferred items are marked done by the retry scheduler
+        if not admit(item):
+            continue
+
+        ok = item['path'] or item['object_key']
+        retried = False
         try:
-            ok = object_key if path is None else path
             logging.info('Process-{}: running {}'.format(process_id, ok))
-            run(bucket_name, object_key, dest_dataset, path=path,
-                lock=lock, alias=alias)
-        except P2BWarning:
-            q.put(item)
-            logging.warning('Process-{}: Re-queued {} '
-                            'due to warning'.format(process_id,
-                                                    ok))
+            run(item['bucket_name'], item['object_key'],
+                item.get('dataset') or dest_dataset, path=item['path'],
+                alias=item.get('alias'), fingerprint=item.get('fingerprint'),
+                overwrite=item.get('overwrite', False),
+                attempt=item.get('attempt', 0), batch=item.get('batch'),
+                **run_kwargs)
+            get_metrics().incr('items_done')
+        except P2BWarning as e:
+            # the retry scheduler marks the item done once it is re-queued
+            retried = retries.retry(item, e)
+            if not retried:
+                get_metrics().incr('items_failed')
+        except Exception as e:
+            # e.g. a corrupt file, the thread carries on with the next item
+            retries.fail(item, e)
+            get_metrics().incr('items_failed')
         finally:
-            q.task_done()
-            logging.info('Process-{}: {} tasks left '
-                         'in queue'.format(process_id, q.qsize()))
+            if not retried:
+                q.task_done(item)
+                logging.info('Process-{}: {} tasks left '
+                             'in queue'.format(process_id, q.qsize()))
+    q.task_done()
+
+
+def _bulk_pipeline(process_id, q, dest_dataset, run_kwargs, inflight,
+                   retries, admit):
+    """
+    Pipelined worker job
+
+    Every stage (load, schema, append) gets `inflight` threads and its own
+    queue. Temp tables are deleted in batches in the background, so
+    neither cleanup nor schema work delay the next load.
+    """
+    schema_manager = run_kwargs.get('schema_manager')
+    manifest = run_kwargs.get('manifest')
+    overwrite_locks = run_kwargs.get('overwrite_locks')
+    task_kwargs = dict((k, v) for k, v in run_kwargs.items()
+                       if k not in ('schema_manager', 'manifest',
+                                    'overwrite_locks'))
+
+    def _delete(table_ids):
+        with timed('delete'):
+            delete_bq_tables(table_ids)
+
+    cleaner = BatchWorker(_delete, 'Process-{}-cleanup'.format(process_id))
+
+    def _done(entry, error):
+        item, task = entry
+        ok = item['path'] or item['object_key']
+
+        if task['tmp_created']:
+            cleaner.add(task['table_id_tmp'])
+
+        if isinstance(error, P2BWarning):
+            if retries.retry(item, error):
+                return
+        elif error is not None:
+            logging.error('Process-{}: failed to load {}'.format(process_id,
+                                                                 ok))
+            retries.fail(item, error)
+
+        get_metrics().incr('items_done' if error is None
+                           else 'items_failed')
+
+        q.task_done(item)
+        logging.info('Process-{}: {} tasks left '
+                     'in queue'.format(process_id, q.qsize()))
+
+    pipeline = Pipeline([
+        ('Process-{}-load'.format(process_id),
+         lambda entry: run_stage(stage_load, entry[1], manifest), inflight),
+        ('Process-{}-schema'.format(process_id),
+         lambda entry: stage_schema(entry[1], schema_manager), inflight),
+        ('Process-{}-append'.format(process_id),
+         lambda entry: run_stage(stage_append, entry[1], manifest,
+                                 overwrite_locks),
+         inflight),
+    ], _done, max_items=inflight * 3)
+
+    for item in iter(q.get, None):
+        if not admit(item):
+            continue
+
+        ok = item['path'] or item['object_key']
+        logging.info('Process-{}: running {}'.format(process_id, ok))
+
+        try:
+            task = prepare_task(item['bucket_name'], item['object_key'],
+                                item.get('dataset') or dest_dataset,
+                                path=item['path'], alias=item.get('alias'),
+                                fingerprint=item.get('fingerprint'),
+                                overwrite=item.get('overwrite', False),
+                                attempt=item.get('attempt', 0),
+                                batch=item.get('batch'),
+                                **task_kwargs)
+        except Exception as e:
+            logging.error('Process-{}: unable to prepare '
+                          '{}'.format(process_id, ok))
+            retries.fail(item, e)
+            get_metrics().incr('items_failed')
+            task = None
+
+        if task is None:
+            q.task_done(item)
+            continue
+
+        pipeline.submit((item, task))
+
+    pipeline.close()
+    cleaner.close()
     q.task_done()
-    logging.info('Process-{}: done'.format(process_id))
@@ -0,0 +1,32 @@
+import multiprocessing
+import threading
+import zlib
+
+
+DEFAULT_LOCK_STRIPES = 16
+
+
+class StripedLocks(object):
+    """
+    Fixed set of locks keys are spread over. A key always maps to the
+    same lock, keys on different stripes never wait for each other.
+
+    A shared StripedLocks (see shared()) holds multiprocessing locks, so
+    it can be handed to every worker process.
+    """
+
+    def __init__(self, locks=None):
+        self._locks = locks or [threading.Lock()]
+
+    @classmethod
+    def shared(cls, stripes=DEFAULT_LOCK_STRIPES):
+        """
+        Create StripedLocks which are shared across processes.
+        """
+        return cls([multiprocessing.Lock() for _ in range(stripes)])
+
+    def get(self, key):
+        return self._locks[zlib.crc32(key.encode('utf-8')) % len(self._locks)]
+
+    def __len__(self):
+        return len(self._locks)
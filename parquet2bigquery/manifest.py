@@ -0,0 +1,230 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+STATE_QUEUED = 'queued'
+STATE_LOADED_TMP = 'loaded_tmp'
+STATE_APPENDED = 'appended'
+
+# number of rows written per transaction by mark_many
+BATCH_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    table_key TEXT,
+    state TEXT NOT NULL,
+    load_job_id TEXT,
+    query_job_id TEXT,
+    updated REAL NOT NULL,
+    generation INTEGER,
+    size INTEGER,
+    crc32c TEXT
+);
+CREATE INDEX IF NOT EXISTS objects_state ON objects (state, key);
+"""
+
+# columns added after the first manifest version
+FINGERPRINT_COLUMNS = [('generation', 'INTEGER'), ('size', 'INTEGER'),
+                       ('crc32c', 'TEXT')]
+
+
+def _prefix_end(prefix):
+    """
+    Return the smallest string greater than every string starting with
+    prefix, for range scans.
+    """
+    if not prefix:
+        return chr(0x10ffff)
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _prefix_range(prefix):
+    """
+    Return the (key, start, end) arguments of a scan of the keys under a
+    prefix, which is a directory: 'table/v1' doesn't cover 'table/v10/'.
+    A glob path can be the prefix itself, without the slash, key is
+    matched exactly.
+    """
+    key = prefix.rstrip('/')
+    if not key:
+        return key, '', _prefix_end('')
+    return key, key + '/', _prefix_end(key + '/')
+
+
+class Manifest(object):
+    """
+    Local SQLite manifest recording the load state of every object (or
+    glob path): queued, loaded_tmp or appended, with the BigQuery job
+    ids which got it there and the fingerprint (generation, size,
+    crc32c) of the version which was appended.
+
+    Every process and thread opens its own connection, so a Manifest can
+    be handed to worker processes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+            columns = set(row[1] for row in
+                          conn.execute('PRAGMA table_info(objects)'))
+            for column, column_type in FINGERPRINT_COLUMNS:
+                if column not in columns:
+                    conn.execute('ALTER TABLE objects ADD COLUMN '
+                                 '{} {}'.format(column, column_type))
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def mark_objects(self, objects, state, table_key=None, load_job_id=None,
+                     query_job_id=None):
+        """
+        Record the state of the objects loaded by the same jobs, given as
+        (key, fingerprint) tuples, in one transaction. Job ids and
+        fingerprints which are not given keep their recorded value.
+        """
+        updated = time.time()
+
+        with self._conn() as conn:
+            conn.executemany("""
+                INSERT INTO objects (key, table_key, state, load_job_id,
+                                     query_job_id, updated, generation,
+                                     size, crc32c)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    table_key = COALESCE(excluded.table_key, table_key),
+                    state = excluded.state,
+                    load_job_id = COALESCE(excluded.load_job_id,
+                                           load_job_id),
+                    query_job_id = COALESCE(excluded.query_job_id,
+                                            query_job_id),
+                    updated = excluded.updated,
+                    generation = COALESCE(excluded.generation, generation),
+                    size = COALESCE(excluded.size, size),
+                    crc32c = COALESCE(excluded.crc32c, crc32c)
+                """, [(key, table_key, state, load_job_id, query_job_id,
+                       updated) + tuple(fingerprint or (None, None, None))
+                      for key, fingerprint in objects])
+
+    def mark_many(self, keys, state, updated=None):
+        """
+        Record the same state for many objects in one transaction.
+
+        Objects recorded after `updated` keep their state, so a batch
+        written late never overwrites a newer state set by a worker.
+        """
+        updated = updated or time.time()
+
+        with self._conn() as conn:
+            conn.executemany("""
+                INSERT INTO objects (key, state, updated) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    state = excluded.state,
+                    updated = excluded.updated
+                WHERE objects.updated < excluded.updated
+                """, [(key, state, updated) for key in keys])
+
+    def set_fingerprints(self, fingerprints):
+        """
+        Record the fingerprints of many objects, given as (key,
+        fingerprint) tuples, without changing their state.
+        """
+        with self._conn() as conn:
+            conn.executemany("""
+                UPDATE objects SET generation = ?, size = ?, crc32c = ?
+                WHERE key = ?
+                """, [tuple(fingerprint) + (key,)
+                      for key, fingerprint in fingerprints])
+
+    def has_prefix(self, prefix):
+        """
+        Check if any object under a key prefix was recorded, i.e. if this
+        is a warm start.
+        """
+        row = self._conn().execute("""
+            SELECT 1 FROM objects WHERE key = ? OR key >= ? AND key < ?
+            LIMIT 1
+            """, _prefix_range(prefix)).fetchone()
+        return row is not None
+
+    def iter_objects(self, prefix, state, fingerprinted=False):
+        """
+        Yield the (key, fingerprint) tuples of the objects under a prefix
+        in the given state, in key order. Objects recorded without a
+        fingerprint yield None.
+
+        With fingerprinted, the objects in other states which carry a
+        fingerprint are yielded too. A fingerprint is only recorded once
+        appended, such an object was appended before, e.g. it was queued
+        again to be overwritten.
+        """
+        rows = self._conn().execute("""
+            SELECT key, generation, size, crc32c FROM objects
+            WHERE (state = ? OR ? AND generation IS NOT NULL)
+            AND (key = ? OR key >= ? AND key < ?)
+            ORDER BY key
+            """, (state, fingerprinted) + _prefix_range(prefix))
+        for key, generation, size, crc32c in rows:
+            yield key, (None if generation is None else
+                        (generation, size, crc32c))
+
+    def counts(self, prefix):
+        """
+        Return the number of objects per state under a prefix.
+        """
+        rows = self._conn().execute("""
+            SELECT state, COUNT(*) FROM objects
+            WHERE key = ? OR key >= ? AND key < ? GROUP BY state
+            """, _prefix_range(prefix))
+        return dict(rows)
+
+
+class ManifestWriter(object):
+    """
+    Buffers state changes from the main process and writes them to the
+    manifest in batches.
+    """
+
+    def __init__(self, manifest, state, batch_size=BATCH_SIZE):
+        self.manifest = manifest
+        self.state = state
+        self.batch_size = batch_size
+        self._keys = []
+        self._first_added = None
+
+    def add(self, key):
+        if not self._keys:
+            self._first_added = time.time()
+
+        self._keys.append(key)
+        if len(self._keys) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._keys:
+            # the batch is as old as its first key
+            self.manifest.mark_many(self._keys, self.state,
+                                    self._first_added)
+            logging.debug('manifest: {} keys marked {}'.format(
+                len(self._keys), self.state))
+            self._keys = []
@@ -0,0 +1,372 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+DEFAULT_PROGRESS_INTERVAL = 30.0
+DEFAULT_PUBLISH_INTERVAL = 5.0
+
+# upper bounds of the latency histogram buckets in seconds, the last
+# bucket counts everything above
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                   120.0, 300.0, 600.0)
+
+# stages in pipeline order, used to order reports
+STAGES = ('list', 'tmp_create', 'load', 'schema_fetch', 'schema_update',
+          'append', 'delete')
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def _new_stage():
+    return {'count': 0, 'seconds': 0.0, 'errors': {},
+            'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+
+
+def _error_class(error):
+    # retryable API errors are wrapped in a P2BWarning
+    return type(error.__cause__ or error).__name__
+
+
+class Metrics(object):
+    """
+    Latency histograms and error classes per stage, and counters (items,
+    bytes, rows, retries, ...) of one process.
+
+    snapshot() returns plain dicts which can be sent to another process
+    and combined with merge_snapshots.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._stages = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds, error=None):
+        with self._lock:
+            data = self._stages.setdefault(stage, _new_stage())
+            data['count'] += 1
+            data['seconds'] += seconds
+            data['buckets'][bisect.bisect_left(LATENCY_BUCKETS,
+                                               seconds)] += 1
+            if error is not None:
+                error_class = _error_class(error)
+                data['errors'][error_class] = \
+                    data['errors'].get(error_class, 0) + 1
+
+    @contextmanager
+    def timed(self, stage):
+        """
+        Record the latency of the block, and the error class if it
+        raises.
+        """
+        started = time.time()
+        try:
+            yield
+        except Exception as e:
+            self.observe(stage, time.time() - started, e)
+            raise
+        self.observe(stage, time.time() - started)
+
+    def incr(self, counter, value=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def record_job(self, job):
+        """
+        Collect the byte and row statistics of a finished BigQuery job.
+        """
+        stats = {
+            'load_input_bytes': getattr(job, 'input_file_bytes', None),
+            'load_output_bytes': getattr(job, 'output_bytes', None),
+            'load_output_rows': getattr(job, 'output_rows', None),
+            'query_bytes_processed': getattr(job, 'total_bytes_processed',
+                                             None),
+            'query_bytes_billed': getattr(job, 'total_bytes_billed', None),
+        }
+        for counter, value in stats.items():
+            if value:
+                self.incr(counter, value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'stages': dict((stage, {'count': data['count'],
+                                        'seconds': data['seconds'],
+                                        'errors': dict(data['errors']),
+                                        'buckets': list(data['buckets'])})
+                               for stage, data in self._stages.items()),
+                'counters': dict(self._counters),
+            }
+
+
+def merge_snapshots(snapshots):
+    """
+    Combine the snapshots of several processes.
+    """
+    merged = {'stages': {}, 'counters': {}}
+
+    for snapshot in snapshots:
+        for stage, data in snapshot['stages'].items():
+            total = merged['stages'].setdefault(stage, _new_stage())
+            total['count'] += data['count']
+            total['seconds'] += data['seconds']
+            total['buckets'] = [a + b for a, b in zip(total['buckets'],
+                                                      data['buckets'])]
+            for error_class, count in data['errors'].items():
+                total['errors'][error_class] = \
+                    total['errors'].get(error_class, 0) + count
+
+        for counter, value in snapshot['counters'].items():
+            merged['counters'][counter] = \
+                merged['counters'].get(counter, 0) + value
+
+    return merged
+
+
+def init_metrics():
+    """
+    Create the metrics of the current process.
+    """
+    global _metrics
+
+    with _metrics_lock:
+        _metrics = Metrics()
+
+    return _metrics
+
+
+def get_metrics():
+    """
+    Return the metrics of the current process, a forked process gets
+    its own.
+    """
+    global _metrics
+
+    with _metrics_lock:
+        if _metrics is None or _metrics.pid != os.getpid():
+            _metrics = Metrics()
+
+    return _metrics
+
+
+def timed(stage):
+    return get_metrics().timed(stage)
+
+
+class MetricsPublisher(object):
+    """
+    Copies the metrics snapshot of a worker process into a dict shared
+    with the main process every interval seconds, and once more on
+    close.
+    """
+
+    def __init__(self, shared, process_id,
+                 interval=DEFAULT_PUBLISH_INTERVAL):
+        self._shared = shared
+        self._process_id = process_id
+        self._interval = interval
+        self._stop = threading.Event()
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='metrics-publisher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def publish(self):
+        self._shared[self._process_id] = get_metrics().snapshot()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.publish()
+            except Exception:
+                logging.exception('Process-{}: unable to publish '
+                                  'metrics'.format(self._process_id))
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.publish()
+
+
+def _quantile(buckets, count, q):
+    """
+    Estimate a quantile from histogram buckets, as the upper bound of
+    the bucket it falls in.
+    """
+    rank = q * count
+    seen = 0
+    for bound, bucket_count in zip(LATENCY_BUCKETS + (None,), buckets):
+        seen += bucket_count
+        if seen >= rank:
+            return bound
+    return None
+
+
+def _format_eta(seconds):
+    seconds = int(seconds)
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60,
+                                     seconds % 60)
+
+
+class RunReporter(object):
+    """
+    Combines the metrics of the main and the worker processes. Logs a
+    throughput and ETA line every interval seconds, keeps an optional
+    Prometheus textfile up to date and builds the final run report.
+    """
+
+    def __init__(self, shared, interval=DEFAULT_PROGRESS_INTERVAL,
+                 prometheus=None):
+        self._shared = shared
+        self._interval = interval
+        self._prometheus = prometheus
+        self.started = time.time()
+        self.queued = 0
+        self.listing_done = False
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='run-reporter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def merged(self):
+        snapshots = list(self._shared.values())
+        snapshots.append(get_metrics().snapshot())
+        return merge_snapshots(snapshots)
+
+    def progress(self, merged):
+        counters = merged['counters']
+        elapsed = max(time.time() - self.started, 1e-6)
+        done = counters.get('items_done', 0) + counters.get('items_failed',
+                                                            0)
+        rate = done / elapsed
+
+        if not self.listing_done:
+            eta = 'listing'
+        elif rate:
+            eta = _format_eta(max(0, self.queued - done) / rate)
+        else:
+            eta = 'unknown'
+
+        return ('main_process: {}/{} items done ({} failed), '
+                '{:.2f} items/s, {:.2f} MB/s, ETA {}'.format(
+                    done, self.queued, counters.get('items_failed', 0),
+                    rate,
+                    counters.get('load_input_bytes', 0) / elapsed / 1e6,
+                    eta))
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                merged = self.merged()
+                logging.info(self.progress(merged))
+                if self._prometheus:
+                    write_prometheus(self._prometheus, merged)
+            except Exception:
+                logging.exception('main_process: unable to report '
+                                  'progress')
+
+    def close(self):
+        """
+        Stop the periodic reporting and return the final run report.
+        """
+        self._stop.set()
+        self._thread.join()
+
+        merged = self.merged()
+        logging.info(self.progress(merged))
+        if self._prometheus:
+            write_prometheus(self._prometheus, merged)
+
+        return build_report(merged, self.started, time.time(), self.queued)
+
+
+def build_report(merged, started, finished, queued):
+    """
+    Build the JSON run report from merged metrics.
+    """
+    seconds = max(finished - started, 1e-6)
+    counters = merged['counters']
+
+    stages = {}
+    for stage, data in merged['stages'].items():
+        count = data['count']
+        stages[stage] = {
+            'count': count,
+            'errors': data['errors'],
+            'seconds': data['seconds'],
+            'mean': data['seconds'] / count if count else None,
+            'p50': _quantile(data['buckets'], count, 0.5),
+            'p90': _quantile(data['buckets'], count, 0.9),
+            'p99': _quantile(data['buckets'], count, 0.99),
+            'buckets': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['inf'],
+                                data['buckets'])),
+        }
+
+    return {
+        'started': started,
+        'finished': finished,
+        'seconds': seconds,
+        'queued': queued,
+        'counters': counters,
+        'throughput': {
+            'items_per_second': counters.get('items_done', 0) / seconds,
+            'bytes_per_second': counters.get('load_input_bytes', 0) / seconds,
+            'rows_per_second': counters.get('load_output_rows', 0) / seconds,
+        },
+        'stages': stages,
+    }
+
+
+def write_report(path, report):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def write_prometheus(path, merged):
+    """
+    Write merged metrics in the Prometheus text format, for the node
+    exporter textfile collector. The file is replaced atomically.
+    """
+    lines = ['# TYPE p2b_stage_seconds histogram']
+    for stage in sorted(merged['stages'], key=_stage_order):
+        data = merged['stages'][stage]
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',),
+                                data['buckets']):
+            cumulative += count
+            lines.append('p2b_stage_seconds_bucket{{stage="{}",le="{}"}} '
+                         '{}'.format(stage, bound, cumulative))
+        lines.append('p2b_stage_seconds_sum{{stage="{}"}} {}'.format(
+            stage, data['seconds']))
+        lines.append('p2b_stage_seconds_count{{stage="{}"}} {}'.format(
+            stage, data['count']))
+
+    lines.append('# TYPE p2b_stage_errors_total counter')
+    for stage in sorted(merged['stages'], key=_stage_order):
+        for error_class, count in sorted(
+                merged['stages'][stage]['errors'].items()):
+            lines.append('p2b_stage_errors_total{{stage="{}",error="{}"}} '
+                         '{}'.format(stage, error_class, count))
+
+    for counter, value in sorted(merged['counters'].items()):
+        lines.append('# TYPE p2b_{}_total counter'.format(counter))
+        lines.append('p2b_{}_total {}'.format(counter, value))
+
+    tmp_path = '{}.{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.rename(tmp_path, path)
+
+
+def _stage_order(stage):
+    return (STAGES.index(stage) if stage in STAGES else len(STAGES), stage)
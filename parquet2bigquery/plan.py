@@ -0,0 +1,181 @@
+import logging
+import time
+
+from parquet2bigquery.keys import get_object_key_metadata
+from parquet2bigquery.lib import (DEFAULT_BATCH_MAX_URIS, DEFAULT_DATASET,
+                                  DEFAULT_LIST_WORKERS, DEFAULT_LOAD_MODE,
+                                  DEFAULT_WRITE_MODE,
+                                  check_load_mode, check_write_options,
+                                  effective_load_mode,
+                                  iter_source_items)
+from parquet2bigquery.manifest import Manifest
+from parquet2bigquery.profiling import merge_profiles, start_profiler
+from parquet2bigquery.quota import DEFAULT_QUOTAS
+from parquet2bigquery.sources import get_sources
+from parquet2bigquery.window import make_window
+
+
+def _new_table():
+    return {
+        'dates': set(),
+        'partitions': set(),
+        'items': 0,
+        'objects': 0,
+        'bytes': 0,
+        'load_jobs': 0,
+        'direct_load_jobs': 0,
+        'query_jobs': 0,
+        'query_bytes': 0,
+        'overwrites': 0,
+    }
+
+
+def _quota_usage(tables, quotas):
+    """
+    Compare the job counts per table to the per table quotas. Only
+    direct loads count against the load quota of a table, the loads of
+    tmp mode go into tmp tables.
+
+    min_seconds is how long the busiest table needs at the quota rate
+    once its bucket capacity is used up, regardless of concurrency.
+    """
+    usage = {}
+    for operation, counter in (('load', 'direct_load_jobs'),
+                               ('query', 'query_jobs')):
+        capacity, seconds = quotas[operation]
+        busiest = max([t[counter] for t in tables.values()] or [0])
+        usage[operation] = {
+            'capacity': capacity,
+            'seconds': seconds,
+            'max_table_jobs': busiest,
+            'min_seconds': max(0, busiest - capacity) * seconds / capacity,
+        }
+
+    return usage
+
+
+def build_plan(bucket_name, prefix, glob_load, resume_load,
+               dest_dataset=None, alias=None, load_mode=DEFAULT_LOAD_MODE,
+               list_workers=DEFAULT_LIST_WORKERS, exclude_regex=(),
+               manifest=None, sync=False, sync_overwrite=False, quotas=None,
+               write_mode=DEFAULT_WRITE_MODE, sources=None, batch_bytes=None,
+               batch_max_uris=DEFAULT_BATCH_MAX_URIS, profile=None,
+               start_date=None, end_date=None, dates=None):
+    """
+    Run the listing, ignore filtering, glob reduction and resume or sync
+    filtering of bulk() and return a plan of the work it would queue.
+
+    No table is created and no load or query job is run. A resume
+    without a warm manifest runs the read-only partition query of
+    get_loaded_paths, as bulk() does.
+
+    The byte counts are the compressed Parquet sizes from the listing,
+    query_bytes is a lower bound of what the append queries scan. Tables
+    loaded into another dataset than dest_dataset, by a source with its
+    own dataset, are named dataset.table.
+
+    With profile, the planning is profiled into that directory, see
+    bulk(). start_date, end_date and dates restrict the plan to a date
+    window, as in bulk().
+    """
+    check_write_options(glob_load, manifest, sync, sync_overwrite,
+                        write_mode)
+    check_load_mode(load_mode)
+    _sources = get_sources(prefix, alias, sources)
+    window = make_window(start_date, end_date, dates)
+
+    _dest_dataset = dest_dataset or DEFAULT_DATASET
+    _quotas = dict(DEFAULT_QUOTAS)
+    _quotas.update(quotas or {})
+
+    started = time.time()
+    profiler = start_profiler(profile, 'planner')
+
+    items = iter_source_items(bucket_name, _sources, glob_load, resume_load,
+                              _dest_dataset, list_workers=list_workers,
+                              exclude_regex=exclude_regex,
+                              manifest=(Manifest(manifest) if manifest
+                                        else None),
+                              sync=sync, sync_overwrite=sync_overwrite,
+                              fingerprints=True, dry_run=True,
+                              write_mode=write_mode, batch_bytes=batch_bytes,
+                              batch_max_uris=batch_max_uris, window=window)
+
+    tables = {}
+    skipped = 0
+    for item in items:
+        try:
+            meta = get_object_key_metadata(item['object_key'])
+        except ValueError:
+            logging.warning('Unable to parse {}, ignoring.'.format(
+                item['object_key']))
+            skipped += 1
+            continue
+
+        table_id = item['alias'] or meta['table_id']
+        if item['dataset'] != _dest_dataset:
+            table_id = '{}.{}'.format(item['dataset'], table_id)
+
+        table = tables.setdefault(table_id, _new_table())
+        dp = meta['date_partition']
+        size = item['fingerprint'][1] or 0
+
+        table['dates'].add(dp['value'])
+        table['partitions'].add((dp['value'],) + tuple(
+            '='.join(p) for p in meta['partitions']))
+        table['items'] += 1
+        table['objects'] += item['objects']
+        table['bytes'] += size
+        table['overwrites'] += item['overwrite']
+
+        item_load_mode = effective_load_mode(load_mode, meta,
+                                             item['overwrite'])
+        if item_load_mode != 'external':
+            table['load_jobs'] += 1
+        if item_load_mode == 'direct':
+            table['direct_load_jobs'] += 1
+        else:
+            table['query_jobs'] += 1
+            table['query_bytes'] += size
+
+    planning_seconds = time.time() - started
+    if profiler is not None:
+        profiler.stop()
+        merge_profiles(profile, since=started)
+
+    totals = dict((counter, sum(t[counter] for t in tables.values()))
+                  for counter in ('items', 'objects', 'bytes', 'load_jobs',
+                                  'direct_load_jobs', 'query_jobs',
+                                  'query_bytes', 'overwrites'))
+    totals['tables'] = len(tables)
+    totals['partitions'] = sum(len(t['partitions'])
+                               for t in tables.values())
+    totals['skipped'] = skipped
+
+    for table in tables.values():
+        dates = sorted(table.pop('dates'))
+        table['partitions'] = len(table['partitions'])
+        table['first_date'] = dates[0]
+        table['last_date'] = dates[-1]
+
+    return {
+        'bucket': bucket_name,
+        'prefix': prefix,
+        'sources': _sources,
+        'dataset': _dest_dataset,
+        'glob_load': glob_load,
+        'resume_load': resume_load,
+        'sync': sync,
+        'load_mode': load_mode,
+        'write_mode': write_mode,
+        'batch_bytes': batch_bytes,
+        'window': window,
+        'planning': {
+            'seconds': planning_seconds,
+            'items_per_second': (totals['items'] / planning_seconds
+                                 if planning_seconds else None),
+        },
+        'totals': totals,
+        'quota': _quota_usage(tables, _quotas),
+        'tables': tables,
+    }
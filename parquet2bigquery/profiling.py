@@ -0,0 +1,189 @@
+import cProfile
+import collections
+import glob
+import logging
+import os
+import pstats
+import sys
+import threading
+
+
+# seconds between stack samples
+DEFAULT_SAMPLE_INTERVAL = 0.01
+# functions listed in the text report
+REPORT_FUNCTIONS = 50
+
+MERGED_NAME = 'merged'
+
+# from Python 3.12 only one cProfile profiler can be active at a time
+PER_THREAD_PROFILERS = sys.version_info < (3, 12)
+
+
+def _frame_label(code):
+    return '{} ({}:{})'.format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+class Profiler(object):
+    """
+    Profiles every thread of the current process until stop().
+
+    Each thread gets its own deterministic profiler (cProfile only sees
+    the thread it is enabled in) and a sampler thread records the stacks
+    of all threads every interval, including the time they spend waiting
+    on jobs, locks or the network. From Python 3.12 only the thread
+    calling start() is profiled deterministically, the other threads are
+    left to the sampler. stop() writes NAME-PID.prof (pstats)
+    and NAME-PID.collapsed (one "frame;frame;... count" line per stack,
+    as read by flamegraph.pl or speedscope) to directory.
+    """
+
+    def __init__(self, directory, name, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.directory = directory
+        self.name = name
+        self.interval = interval
+
+        self._profilers = []
+        self._stacks = collections.Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _thread_profile(self, frame, event, arg):
+        # first profile event of a new thread, which gets its own
+        # profiler from now on
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._profilers.append(profiler)
+        profiler.enable()
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        if PER_THREAD_PROFILERS:
+            threading.setprofile(self._thread_profile)
+        self._thread_profile(None, None, None)
+
+        self._sampler = threading.Thread(target=self._sample,
+                                         name='profile-sampler')
+        self._sampler.daemon = True
+        self._sampler.start()
+        return self
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                self._stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        """
+        Stop profiling and write the profiles of the process, returns the
+        path of the pstats file, or None if nothing was profiled.
+        """
+        if PER_THREAD_PROFILERS:
+            threading.setprofile(None)
+        self._stop.set()
+        self._sampler.join()
+
+        path = os.path.join(self.directory, '{}-{}'.format(self.name,
+                                                           os.getpid()))
+        with self._lock:
+            profilers = list(self._profilers)
+
+        stats = None
+        for profiler in profilers:
+            # threads which are still running keep their profiler, its
+            # stats are those collected so far
+            profiler.disable()
+            profiler.create_stats()
+            if not profiler.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+
+        _write_collapsed(path + '.collapsed', self._stacks)
+        if stats is None:
+            return None
+
+        stats.dump_stats(path + '.prof')
+        logging.info('{}: profile written to {}.prof'.format(self.name,
+                                                             path))
+        return path + '.prof'
+
+
+def start_profiler(directory, name, interval=DEFAULT_SAMPLE_INTERVAL):
+    """
+    Start a Profiler, or return None if directory is not set.
+    """
+    if not directory:
+        return None
+    return Profiler(directory, name, interval).start()
+
+
+def _write_collapsed(path, stacks):
+    with open(path, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write('{} {}\n'.format(stack, count))
+
+
+def _read_collapsed(path, stacks):
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack:
+                stacks[stack] += int(count)
+
+
+def merge_profiles(directory, since=None):
+    """
+    Merge the per process profiles written to directory (after since, a
+    timestamp, to leave out those of earlier runs) into merged.prof,
+    merged.collapsed and merged.txt, the functions with the most
+    cumulative time. Returns the path of merged.prof, or None if there
+    is no profile.
+    """
+    def _files(extension):
+        paths = []
+        for path in sorted(glob.glob(os.path.join(directory,
+                                                  '*' + extension))):
+            name = os.path.basename(path)[:-len(extension)]
+            if name == MERGED_NAME:
+                continue
+            if since is not None and os.path.getmtime(path) < since:
+                continue
+            paths.append(path)
+        return paths
+
+    merged = os.path.join(directory, MERGED_NAME)
+
+    stacks = collections.Counter()
+    for path in _files('.collapsed'):
+        _read_collapsed(path, stacks)
+    _write_collapsed(merged + '.collapsed', stacks)
+
+    profiles = _files('.prof')
+    if not profiles:
+        logging.warning('main_process: no profile found in '
+                        '{}'.format(directory))
+        return None
+
+    stats = pstats.Stats(*profiles)
+    stats.dump_stats(merged + '.prof')
+
+    with open(merged + '.txt', 'w') as f:
+        stats.stream = f
+        stats.sort_stats('cumulative').print_stats(REPORT_FUNCTIONS)
+
+    logging.info('main_process: merged {} profiles into {}.prof, '
+                 '{}.collapsed and {}.txt'.format(len(profiles), merged,
+                                                  merged, merged))
+    return merged + '.prof'
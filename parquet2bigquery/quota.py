@@ -0,0 +1,80 @@
+import time
+
+from parquet2bigquery.locks import DEFAULT_LOCK_STRIPES, StripedLocks
+
+# operation -> (capacity, seconds to refill the full capacity)
+# https://cloud.google.com/bigquery/quotas
+DEFAULT_QUOTAS = {
+    # load jobs per table per day
+    'load': (1500, 86400),
+    # query jobs appending to a table per day
+    'query': (1500, 86400),
+    # table metadata update operations per table per 10 seconds
+    'update': (5, 10),
+}
+
+
+def parse_quota(value):
+    """
+    Parse a 'operation=capacity/seconds' quota string, e.g.
+    'load=1500/86400'.
+    """
+    try:
+        operation, limit = value.split('=')
+        capacity, seconds = limit.split('/')
+        return operation, (int(capacity), float(seconds))
+    except ValueError:
+        raise ValueError('invalid quota {}, expected '
+                         'operation=capacity/seconds'.format(value))
+
+
+class TableQuotas(object):
+    """
+    Token buckets per destination table and operation (see
+    DEFAULT_QUOTAS), used to admit work before BigQuery rejects it with
+    a rate limit error.
+
+    A shared TableQuotas (see shared()) keeps its buckets in a
+    multiprocessing manager so the limits hold across all workers.
+    """
+
+    def __init__(self, quotas=None, buckets=None, locks=None):
+        self.quotas = dict(DEFAULT_QUOTAS)
+        self.quotas.update(quotas or {})
+
+        # 'operation:dataset.table_id' -> (tokens, timestamp)
+        self._buckets = {} if buckets is None else buckets
+        self._locks = locks or StripedLocks()
+
+    @classmethod
+    def shared(cls, manager, quotas=None, stripes=DEFAULT_LOCK_STRIPES):
+        """
+        Create a TableQuotas which is shared across processes.
+        """
+        return cls(quotas, manager.dict(), StripedLocks.shared(stripes))
+
+    def try_acquire(self, operation, table_key, tokens=1):
+        """
+        Take tokens from the bucket of a table operation.
+
+        Returns 0 if the tokens were taken, otherwise the number of
+        seconds until they are available.
+        """
+        if operation not in self.quotas:
+            return 0
+
+        capacity, seconds = self.quotas[operation]
+        rate = capacity / seconds
+        key = '{}:{}'.format(operation, table_key)
+
+        with self._locks.get(key):
+            now = time.time()
+            available, updated = self._buckets.get(key, (capacity, now))
+            available = min(capacity, available + (now - updated) * rate)
+
+            if available >= tokens:
+                self._buckets[key] = (available - tokens, now)
+                return 0
+
+            self._buckets[key] = (available, now)
+            return (tokens - available) / rate
@@ -0,0 +1,162 @@
+import heapq
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+
+import google.api_core.exceptions
+
+from parquet2bigquery.metrics import get_metrics
+
+
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_BACKOFF_BASE = 2.0
+DEFAULT_BACKOFF_MAX = 300.0
+
+RETRYABLE_ERRORS = (
+    google.api_core.exceptions.InternalServerError,
+    google.api_core.exceptions.BadGateway,
+    google.api_core.exceptions.ServiceUnavailable,
+    google.api_core.exceptions.GatewayTimeout,
+    google.api_core.exceptions.TooManyRequests,
+)
+
+# BigQuery reports rate limits as 403s with one of these reasons
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'backendError')
+
+
+def is_retryable(error):
+    """
+    Check if an API error is worth retrying: server errors, 429s and
+    BigQuery rate limit errors.
+    """
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+
+    if isinstance(error, google.api_core.exceptions.Forbidden):
+        return any(e.get('reason') in RATE_LIMIT_REASONS
+                   for e in error.errors or [])
+
+    return False
+
+
+def backoff_delay(attempt, base=DEFAULT_BACKOFF_BASE,
+                  cap=DEFAULT_BACKOFF_MAX):
+    """
+    Exponential backoff with full jitter for the given attempt (>= 1).
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class RetryScheduler(object):
+    """
+    Holds items waiting for a retry in a delay heap and puts them back on
+    the work queue once their retry is due.
+
+    An item is only marked done (task_done) on the work queue once it has
+    been put back, so the queue cannot be joined while retries are
+    pending. Items which reach max_attempts are written to the dead
+    letter file instead.
+    """
+
+    def __init__(self, q, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 backoff_base=DEFAULT_BACKOFF_BASE,
+                 backoff_max=DEFAULT_BACKOFF_MAX, dead_letter=None):
+        self._q = q
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.dead_letter = dead_letter
+
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._dead_letter_lock = threading.Lock()
+
+        thread = threading.Thread(target=self._run, name='retry-scheduler')
+        thread.daemon = True
+        thread.start()
+
+    def defer(self, item, delay):
+        """
+        Put an item back on the work queue after delay seconds without
+        counting an attempt.
+        """
+        with self._cond:
+            heapq.heappush(self._heap,
+                           (time.time() + delay, next(self._seq), item))
+            self._cond.notify()
+
+    def retry(self, item, error=None):
+        """
+        Schedule a retry of a failed item with exponential backoff.
+
+        Returns False if the item ran out of attempts and was dead
+        lettered, in which case the caller marks it done.
+        """
+        item['attempt'] = item.get('attempt', 0) + 1
+
+        if item['attempt'] >= self.max_attempts:
+            self._dead_letter(item, error)
+            return False
+
+        get_metrics().incr('retries')
+        delay = backoff_delay(item['attempt'], self.backoff_base,
+                              self.backoff_max)
+        logging.warning('{}: retry {} of {} in {:.1f}s due to '
+                        'warning'.format(item.get('path') or
+                                         item['object_key'],
+                                         item['attempt'],
+                                         self.max_attempts - 1, delay))
+        self.defer(item, delay)
+
+        return True
+
+    def fail(self, item, error):
+        """
+        Dead letter an item which failed with an error a retry won't fix,
+        e.g. a corrupt file. The caller marks it done.
+        """
+        logging.error('{}: failed with a non-retryable '
+                      'error.'.format(item.get('path') or
+                                      item['object_key']),
+                      exc_info=error)
+        self._write_dead_letter(item, error)
+
+    def _dead_letter(self, item, error):
+        ok = item.get('path') or item['object_key']
+        logging.error('{}: giving up after {} attempts.'.format(
+            ok, item['attempt']))
+        self._write_dead_letter(item, error)
+
+    def _write_dead_letter(self, item, error):
+        get_metrics().incr('dead_lettered')
+        if not self.dead_letter:
+            return
+
+        record = dict(item)
+        record['error'] = repr(error)
+        record['failed_at'] = time.time()
+
+        with self._dead_letter_lock:
+            with open(self.dead_letter, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+
+                due, _, item = self._heap[0]
+                wait = due - time.time()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+
+                heapq.heappop(self._heap)
+
+            self._q.put(item)
+            self._q.task_done(item)
@@ -0,0 +1,186 @@
+import logging
+import time
+
+import google.api_core.exceptions
+from google.cloud import bigquery
+from google.cloud.bigquery.table import TimePartitioning, TimePartitioningType
+
+from parquet2bigquery.clients import get_client_pool
+from parquet2bigquery.locks import DEFAULT_LOCK_STRIPES, StripedLocks
+
+# conditional schema updates are retried if the table changed underneath
+MAX_SCHEMA_UPDATE_ATTEMPTS = 5
+
+
+def _compare_columns(new_col, cur_col):
+    """
+    Compare two columns to see if they are changing.
+    This is currently only checks to see if column MODE
+    is changing.
+    """
+    if isinstance(new_col, tuple):
+        for i in range(len(new_col)):
+            _compare_columns(new_col[i], cur_col[i])
+
+    if isinstance(new_col, google.cloud.bigquery.schema.SchemaField):
+        if new_col.fields and cur_col.fields:
+            _compare_columns(new_col.fields, cur_col.fields)
+
+        # if mode is changing from NULLABLE to REQUIRED
+        if new_col.mode == 'REQUIRED' and cur_col.mode == 'NULLABLE':
+            logging.warn('Column mode changed from '
+                         'REQUIRED to NULLABLE, ignoring.')
+            return False
+
+    return False
+
+
+def get_schema_additions(current_schema, newest_schema):
+    """
+    Compare two BigQuery table schemas and get the additional columns.
+    newest_schema should contain the latest schema and current_schema should be
+    the current schema. We only append additional columns.
+
+    Handling column changes are currently not implemented.
+    """
+    schema_additions = []
+
+    schema_diff = set(newest_schema) - set(current_schema)
+
+    for sd_col in schema_diff:
+        already_exists = False
+        for cs_col in current_schema:
+            # check to see if the column we are attempting to add exists
+            if sd_col.name == cs_col.name:
+                already_exists = True
+                # we found an existing column, find out what has changed
+                col = (_compare_columns(sd_col, cs_col))
+                if col:
+                    raise NotImplementedError()
+        # we found a new column, add it
+        if not already_exists:
+            schema_additions.append(sd_col)
+    return schema_additions
+
+
+class SchemaManager(object):
+    """
+    Caches the schema of primary BigQuery tables and serializes table
+    creation and schema updates per table.
+
+    A shared SchemaManager (see shared()) keeps its cache in a
+    multiprocessing manager and uses striped locks, so it can be handed
+    to every worker process. A table always maps to the same lock, tables
+    on different stripes never wait for each other.
+    """
+
+    def __init__(self, cache=None, locks=None, quotas=None):
+        # 'dataset.table_id' -> (etag, [SchemaField api repr])
+        self._cache = {} if cache is None else cache
+        self._locks = locks or StripedLocks()
+        # optional quota.TableQuotas limiting the table update rate
+        self.quotas = quotas
+
+    @classmethod
+    def shared(cls, manager, stripes=DEFAULT_LOCK_STRIPES, quotas=None):
+        """
+        Create a SchemaManager which is shared across processes.
+        """
+        return cls(manager.dict(), StripedLocks.shared(stripes), quotas)
+
+    def _store(self, key, table):
+        self._cache[key] = (table.etag,
+                            [field.to_api_repr() for field in table.schema])
+
+    def get_cached_schema(self, table_id, dataset):
+        """
+        Return the cached schema of a table or None.
+        """
+        cached = self._cache.get('{}.{}'.format(dataset, table_id))
+        if cached is None:
+            return None
+
+        return [bigquery.SchemaField.from_api_repr(f) for f in cached[1]]
+
+    def _get_or_create_table(self, table_ref, schema, partition_field):
+        client = get_client_pool().bigquery
+
+        try:
+            return client.get_table(table_ref)
+        except google.api_core.exceptions.NotFound:
+            pass
+
+        table_def = bigquery.Table(table_ref, schema=schema)
+        if partition_field:
+            table_def.time_partitioning = TimePartitioning(
+                type_=TimePartitioningType.DAY, field=partition_field)
+
+        try:
+            table = client.create_table(table_def)
+            logging.info('{}: table created.'.format(table_ref.table_id))
+            return table
+        except google.api_core.exceptions.Conflict:
+            # created outside of this run
+            logging.info('{}: BigQuery table already '
+                         'exists.'.format(table_ref.table_id))
+            return client.get_table(table_ref)
+
+    def merge_schema(self, table_id, dataset, new_schema,
+                     partition_field=None):
+        """
+        Make sure the primary table exists and contains every column of
+        new_schema, and return its schema.
+
+        If new_schema is a subset of the cached schema no API call is
+        made. Otherwise the table is created or its additional columns
+        are added with one conditional (etag) update, under the table's
+        lock. The lock is released while the table is out of update
+        quota, the tables on the same stripe carry on meanwhile.
+        """
+        key = '{}.{}'.format(dataset, table_id)
+
+        cached_schema = self.get_cached_schema(table_id, dataset)
+        if (cached_schema is not None and
+                not get_schema_additions(cached_schema, new_schema)):
+            return cached_schema
+
+        client = get_client_pool().bigquery
+        table_ref = client.dataset(dataset).table(table_id)
+
+        attempt = 0
+        while attempt < MAX_SCHEMA_UPDATE_ATTEMPTS:
+            wait = 0
+            with self._locks.get(key):
+                # another worker may have changed the table while we waited
+                table = self._get_or_create_table(table_ref, new_schema,
+                                                  partition_field)
+
+                schema_additions = get_schema_additions(table.schema,
+                                                        new_schema)
+                if schema_additions and self.quotas is not None:
+                    wait = self.quotas.try_acquire('update', key)
+
+                if not wait:
+                    if schema_additions:
+                        table.schema = table.schema[:] + schema_additions
+                        try:
+                            table = client.update_table(table, ['schema'])
+                        except google.api_core.exceptions.PreconditionFailed:
+                            logging.warning('{}: table changed during '
+                                            'schema update, '
+                                            'retrying.'.format(table_id))
+                            attempt += 1
+                            continue
+                        logging.info('{}: BigQuery table schema '
+                                     'updated.'.format(table_id))
+
+                    self._store(key, table)
+                    return table.schema
+
+            logging.info('{}: update quota exhausted, waiting '
+                         '{:.1f}s'.format(key, wait))
+            time.sleep(wait)
+
+        raise RuntimeError('{}: unable to update table schema after {} '
+                           'attempts'.format(table_id,
+                                             MAX_SCHEMA_UPDATE_ATTEMPTS))
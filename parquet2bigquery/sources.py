@@ -0,0 +1,108 @@
+import json
+
+
+DEFAULT_WEIGHT = 1
+
+
+def make_source(prefix, alias=None, dataset=None, weight=DEFAULT_WEIGHT):
+    """
+    Create a load source: an object prefix, the table alias and dataset
+    its objects are loaded into and its share of the worker pool.
+    """
+    if not prefix:
+        raise ValueError('a source needs a prefix')
+    if not isinstance(weight, int) or weight < 1:
+        raise ValueError('{}: weight must be a positive integer, '
+                         'got {!r}'.format(prefix, weight))
+
+    return {
+        'prefix': prefix,
+        'alias': alias,
+        'dataset': dataset,
+        'weight': weight
+    }
+
+
+def load_sources(path):
+    """
+    Read sources from a JSON config file, either a list of sources or an
+    object with a "sources" list:
+
+        {"sources": [
+            {"prefix": "main_summary/v4", "alias": "main_summary",
+             "dataset": "telemetry", "weight": 4},
+            {"prefix": "crash_summary/v2"}
+        ]}
+
+    Only prefix is required, dataset defaults to the dataset of the run.
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    if isinstance(config, dict):
+        config = config.get('sources')
+    if not isinstance(config, list):
+        raise ValueError('{}: expected a list of sources'.format(path))
+
+    sources = []
+    for entry in config:
+        unknown = set(entry) - {'prefix', 'alias', 'dataset', 'weight'}
+        if unknown:
+            raise ValueError('{}: unknown source keys {}'.format(
+                path, ', '.join(sorted(unknown))))
+        sources.append(make_source(**entry))
+
+    return sources
+
+
+def get_sources(prefixes=None, alias=None, sources=None):
+    """
+    Combine prefixes, e.g. given on the command line, with sources, e.g.
+    from load_sources. An alias names a single table, so it only applies
+    to a single prefix.
+    """
+    if isinstance(prefixes, str):
+        prefixes = [prefixes]
+    prefixes = prefixes or []
+
+    if alias and len(prefixes) > 1:
+        raise ValueError('an alias can only be given for a single prefix, '
+                         'use a sources file to alias several')
+
+    sources = [make_source(prefix, alias)
+               for prefix in prefixes] + list(sources or [])
+
+    if not sources:
+        raise ValueError('at least one prefix or source is required')
+
+    seen = set()
+    for source in sources:
+        if source['prefix'] in seen:
+            raise ValueError('{}: duplicate source'.format(source['prefix']))
+        seen.add(source['prefix'])
+
+    return sources
+
+
+def interleave(iterables, weights=None):
+    """
+    Weighted round robin over iterables: take weights[i] items from the
+    i-th iterable in turn, until all of them are exhausted. Iterables are
+    only advanced when their turn comes.
+    """
+    iterators = [iter(iterable) for iterable in iterables]
+    weights = list(weights or [DEFAULT_WEIGHT] * len(iterators))
+
+    while iterators:
+        exhausted = []
+        for i, iterator in enumerate(iterators):
+            for _ in range(weights[i]):
+                try:
+                    yield next(iterator)
+                except StopIteration:
+                    exhausted.append(i)
+                    break
+
+        for i in reversed(exhausted):
+            del iterators[i]
+            del weights[i]
@@ -0,0 +1,129 @@
+from datetime import date, datetime
+
+from dateutil.parser import parse
+
+from parquet2bigquery.keys import DATE_FORMATS
+
+
+def parse_date(value):
+    """
+    Parse a date given as a date, 'YYYY-MM-DD' or 'YYYYMMDD' and return
+    it as 'YYYY-MM-DD'.
+    """
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+
+    raise ValueError('unable to parse date {!r}, expected YYYY-MM-DD or '
+                     'YYYYMMDD'.format(value))
+
+
+def make_window(start_date=None, end_date=None, dates=None):
+    """
+    Create a date window: the date partitions from start_date to end_date,
+    both included and either open, and/or an explicit list of dates.
+    Returns None if nothing is set, i.e. every date.
+    """
+    if start_date is None and end_date is None and not dates:
+        return None
+
+    window = {
+        'start_date': parse_date(start_date) if start_date else None,
+        'end_date': parse_date(end_date) if end_date else None,
+        'dates': sorted(set(parse_date(d) for d in dates)) if dates else None
+    }
+
+    if (window['start_date'] and window['end_date'] and
+            window['start_date'] > window['end_date']):
+        raise ValueError('start date {start_date} is after end date '
+                         '{end_date}'.format(**window))
+
+    return window
+
+
+def in_window(window, value):
+    """
+    Check if a 'YYYY-MM-DD' date is in a window, a None window has every
+    date.
+    """
+    if window is None:
+        return True
+    if window['start_date'] and value < window['start_date']:
+        return False
+    if window['end_date'] and value > window['end_date']:
+        return False
+    if window['dates'] is not None and value not in window['dates']:
+        return False
+    return True
+
+
+def partition_date(partition_prefix):
+    """
+    Return the date of a date partition prefix,
+    'dataset/version/field=value/', as 'YYYY-MM-DD', or None.
+    """
+    name = partition_prefix.rstrip('/').rpartition('/')[2]
+    _, _, value = name.partition('=')
+    if not value:
+        return None
+
+    try:
+        return parse_date(value)
+    except ValueError:
+        pass
+    # as get_object_key_metadata does for other formats
+    try:
+        return parse(value).strftime('%Y-%m-%d')
+    except (ValueError, OverflowError):
+        return None
+
+
+def filter_partition_prefixes(partition_prefixes, window):
+    """
+    Keep the date partition prefixes in a window. Prefixes which are not
+    a date partition can't be in a window and are left out.
+    """
+    result = []
+    for partition_prefix in partition_prefixes:
+        value = partition_date(partition_prefix)
+        if value is not None and in_window(window, value):
+            result.append(partition_prefix)
+    return result
+
+
+def window_predicate(window, date_partition_field):
+    """
+    Return a standard SQL predicate restricting a date partition column
+    to a window, which lets BigQuery prune the partitions outside of it.
+    """
+    predicates = []
+    if window['start_date']:
+        predicates.append("{} >= DATE '{}'".format(
+            date_partition_field, window['start_date']))
+    if window['end_date']:
+        predicates.append("{} <= DATE '{}'".format(
+            date_partition_field, window['end_date']))
+    if window['dates'] is not None:
+        predicates.append('{} IN ({})'.format(
+            date_partition_field,
+            ', '.join("DATE '{}'".format(d) for d in window['dates'])))
+
+    return ' AND '.join(predicates)
+
+
+def describe_window(window):
+    if window is None:
+        return 'every date'
+
+    parts = []
+    if window['start_date'] or window['end_date']:
+        parts.append('{} to {}'.format(window['start_date'] or '-',
+                                       window['end_date'] or '-'))
+    if window['dates'] is not None:
+        parts.append('{} listed dates'.format(len(window['dates'])))
+    return ', '.join(parts)
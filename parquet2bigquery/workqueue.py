@@ -0,0 +1,490 @@
+import collections
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from multiprocessing import JoinableQueue
+from multiprocessing.managers import BaseManager
+
+from parquet2bigquery.metrics import get_metrics
+
+
+# seconds a claimed task stays leased without a heartbeat
+DEFAULT_LEASE_SECONDS = 300.0
+# seconds between claims while no task is available
+DEFAULT_CLAIM_INTERVAL = 1.0
+# seconds a worker waits for the coordinator of a tcp:// queue to listen
+DEFAULT_CONNECT_TIMEOUT = 120.0
+# claim intervals the coordinator of a tcp:// queue keeps serving it
+# once closed
+SHUTDOWN_CLAIMS = 3
+# the authkey of tcp:// queues, if not given explicitly
+AUTHKEY_ENV = 'P2B_QUEUE_AUTHKEY'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    item TEXT NOT NULL,
+    owner TEXT,
+    lease_expires REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_lease ON tasks (lease_expires, id);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class LocalQueue(object):
+    """
+    Work queue of a single host, shared by the processes bulk() forks.
+    """
+
+    def __init__(self, maxsize=0):
+        self._q = JoinableQueue(maxsize=maxsize)
+
+    def put(self, item):
+        self._q.put(item)
+
+    def get(self):
+        return self._q.get()
+
+    def task_done(self, item=None):
+        self._q.task_done()
+
+    def join(self):
+        self._q.join()
+
+    def qsize(self):
+        return self._q.qsize()
+
+    def close(self, workers):
+        """
+        Stop the workers once the queue is drained, one sentinel per
+        worker.
+        """
+        for _ in range(workers):
+            self._q.put(None)
+
+    def set_options(self, options):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class SqliteLeaseStore(object):
+    """
+    Lease store in a SQLite file, shared by the hosts which can open it.
+    A task is ready while it has no owner, leased while its lease has not
+    expired, and deleted once done.
+
+    The file uses a rollback journal: WAL relies on memory shared by the
+    processes of a single host and breaks on network filesystems. The
+    filesystem has to support file locks.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=60,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=DELETE')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def reset(self):
+        conn = self._conn()
+        conn.execute('DELETE FROM tasks')
+        conn.execute('DELETE FROM meta')
+
+    def add(self, payload):
+        self._conn().execute('INSERT INTO tasks (item) VALUES (?)',
+                             (payload,))
+
+    def claim(self, owner, lease_seconds):
+        """
+        Lease the oldest ready task, or a task whose lease expired.
+        Returns an (id, payload, reclaimed) tuple or None.
+        """
+        now = time.time()
+        conn = self._conn()
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute("""
+                SELECT id, item, owner FROM tasks
+                WHERE lease_expires IS NULL ORDER BY id LIMIT 1
+                """).fetchone()
+            if row is None:
+                row = conn.execute("""
+                    SELECT id, item, owner FROM tasks
+                    WHERE lease_expires < ? ORDER BY lease_expires LIMIT 1
+                    """, (now,)).fetchone()
+            if row is not None:
+                conn.execute("""
+                    UPDATE tasks SET owner = ?, lease_expires = ?
+                    WHERE id = ?
+                    """, (owner, now + lease_seconds, row[0]))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+        if row is None:
+            return None
+        return row[0], row[1], row[2] is not None
+
+    def renew(self, owner, ids, lease_seconds):
+        self._conn().executemany("""
+            UPDATE tasks SET lease_expires = ? WHERE id = ? AND owner = ?
+            """, [(time.time() + lease_seconds, i, owner) for i in ids])
+
+    def ack(self, owner, task_id):
+        # a task reclaimed by another owner is theirs to finish
+        self._conn().execute('DELETE FROM tasks WHERE id = ? AND owner = ?',
+                             (task_id, owner))
+
+    def counts(self):
+        """
+        Return the number of ready and leased tasks.
+        """
+        row = self._conn().execute("""
+            SELECT COUNT(*) - COUNT(owner), COUNT(owner) FROM tasks
+            """).fetchone()
+        return row[0], row[1]
+
+    def set_meta(self, name, value):
+        self._conn().execute("""
+            INSERT INTO meta (name, value) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET value = excluded.value
+            """, (name, value))
+
+    def get_meta(self, name):
+        row = self._conn().execute('SELECT value FROM meta WHERE name = ?',
+                                   (name,)).fetchone()
+        return row[0] if row else None
+
+
+class MemoryLeaseStore(object):
+    """
+    Lease store held in memory by the coordinator and served to the
+    workers over TCP, see QueueManager. Same semantics as
+    SqliteLeaseStore.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._ids = 0
+            self._ready = collections.deque()
+            # id -> [payload, owner, lease_expires]
+            self._leased = {}
+            self._meta = {}
+
+    def add(self, payload):
+        with self._lock:
+            self._ids += 1
+            self._ready.append((self._ids, payload))
+
+    def claim(self, owner, lease_seconds):
+        now = time.time()
+        with self._lock:
+            if self._ready:
+                task_id, payload = self._ready.popleft()
+                reclaimed = False
+            else:
+                expired = [i for i, (_, _, expires) in self._leased.items()
+                           if expires < now]
+                if not expired:
+                    return None
+                task_id = min(expired)
+                payload = self._leased[task_id][0]
+                reclaimed = True
+
+            self._leased[task_id] = [payload, owner, now + lease_seconds]
+            return task_id, payload, reclaimed
+
+    def renew(self, owner, ids, lease_seconds):
+        expires = time.time() + lease_seconds
+        with self._lock:
+            for task_id in ids:
+                task = self._leased.get(task_id)
+                if task is not None and task[1] == owner:
+                    task[2] = expires
+
+    def ack(self, owner, task_id):
+        with self._lock:
+            task = self._leased.get(task_id)
+            if task is not None and task[1] == owner:
+                del self._leased[task_id]
+
+    def counts(self):
+        with self._lock:
+            return len(self._ready), len(self._leased)
+
+    def set_meta(self, name, value):
+        with self._lock:
+            self._meta[name] = value
+
+    def get_meta(self, name):
+        with self._lock:
+            return self._meta.get(name)
+
+
+_memory_store = None
+
+
+def _get_memory_store():
+    global _memory_store
+    if _memory_store is None:
+        _memory_store = MemoryLeaseStore()
+    return _memory_store
+
+
+class QueueManager(BaseManager):
+    pass
+
+
+QueueManager.register('store', callable=_get_memory_store)
+
+
+class LeaseQueue(object):
+    """
+    Work queue of leased tasks in a store shared by several hosts.
+
+    A claimed task is leased to its process for lease_seconds, and the
+    lease is renewed by a heartbeat thread until the task is done. The
+    task of a process which dies is claimed again once its lease has
+    expired. Workers stop once the coordinator closed the queue and no
+    task is left.
+    """
+
+    def __init__(self, store, maxsize=0, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 claim_interval=DEFAULT_CLAIM_INTERVAL, manager=None):
+        self.store = store
+        self.maxsize = maxsize
+        self.lease_seconds = lease_seconds
+        self.claim_interval = claim_interval
+        self._manager = manager
+        self._puts = 0
+        self._pid = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        # the server and the heartbeat stay with their process
+        state['_manager'] = None
+        state['_pid'] = None
+        for name in ('_held', '_held_lock', '_stop', '_heartbeat'):
+            state.pop(name, None)
+        return state
+
+    def _start(self):
+        """
+        Set up the leases of the current process.
+        """
+        if self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        self.owner = '{}:{}'.format(socket.gethostname(), self._pid)
+        self._held = set()
+        self._held_lock = threading.Lock()
+        self._stop = threading.Event()
+
+        self._heartbeat = threading.Thread(target=self._renew,
+                                           name='lease-heartbeat')
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+
+    def _renew(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            with self._held_lock:
+                held = list(self._held)
+            if not held:
+                continue
+            try:
+                self.store.renew(self.owner, held, self.lease_seconds)
+            except Exception:
+                logging.exception('{}: unable to renew {} '
+                                  'leases'.format(self.owner, len(held)))
+
+    def put(self, item):
+        # listing waits while the queue is full, checked every 100 items
+        self._puts += 1
+        while (self.maxsize and self._puts % 100 == 0 and
+               self.store.counts()[0] >= self.maxsize):
+            time.sleep(self.claim_interval)
+
+        self.store.add(json.dumps(dict((k, v) for k, v in item.items()
+                                       if k != 'lease')))
+
+    def get(self):
+        """
+        Claim a task and return its item, or None once the queue is
+        closed and empty, or its coordinator is gone.
+        """
+        self._start()
+
+        try:
+            return self._claim()
+        except (EOFError, ConnectionError):
+            # the coordinator of a tcp:// queue stops serving it once
+            # every task is done
+            logging.info('{}: the coordinator closed the work '
+                         'queue'.format(self.owner))
+            return None
+
+    def _claim(self):
+        while True:
+            claimed = self.store.claim(self.owner, self.lease_seconds)
+            if claimed is not None:
+                task_id, payload, reclaimed = claimed
+                item = json.loads(payload)
+                item['lease'] = task_id
+                if reclaimed:
+                    logging.warning('{}: reclaimed the expired lease of '
+                                    '{}'.format(self.owner,
+                                                item['path'] or
+                                                item['object_key']))
+                    get_metrics().incr('leases_reclaimed')
+                with self._held_lock:
+                    self._held.add(task_id)
+                return item
+
+            if self.store.get_meta('closed') and not any(
+                    self.store.counts()):
+                return None
+
+            time.sleep(self.claim_interval)
+
+    def task_done(self, item=None):
+        if item is None or item.get('lease') is None:
+            return
+
+        self.store.ack(self.owner, item['lease'])
+        with self._held_lock:
+            self._held.discard(item['lease'])
+
+    def join(self):
+        """
+        Wait until every task is done, on any host.
+        """
+        while any(self.store.counts()):
+            time.sleep(self.claim_interval)
+
+    def qsize(self):
+        return self.store.counts()[0]
+
+    def close(self, workers=None):
+        self.store.set_meta('closed', '1')
+
+    def set_options(self, options):
+        """
+        Publish the run options the workers of other hosts use.
+        """
+        self.store.set_meta('options', json.dumps(options))
+
+    def get_options(self):
+        """
+        Wait for the coordinator to publish the run options.
+        """
+        while True:
+            options = self.store.get_meta('options')
+            if options is not None:
+                return json.loads(options)
+            time.sleep(self.claim_interval)
+
+    def shutdown(self):
+        if self._pid == os.getpid():
+            self._stop.set()
+        if self._manager is not None:
+            # workers of other hosts poll for the queue to be closed
+            # and empty, give them a few claims to see it
+            time.sleep(SHUTDOWN_CLAIMS * self.claim_interval)
+            self._manager.shutdown()
+
+
+def _parse_address(spec):
+    host, _, port = spec[len('tcp://'):].rpartition(':')
+    return host or '', int(port)
+
+
+def _connect(manager, timeout=DEFAULT_CONNECT_TIMEOUT):
+    # workers may well be started before the coordinator
+    deadline = time.time() + timeout
+    while True:
+        try:
+            manager.connect()
+            return
+        except ConnectionRefusedError:
+            if time.time() > deadline:
+                raise
+            time.sleep(DEFAULT_CLAIM_INTERVAL)
+
+
+def open_work_queue(spec=None, maxsize=0, authkey=None, coordinator=True,
+                    lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Open the work queue described by spec:
+
+        None or 'local'   the processes of this host
+        'sqlite:PATH'     leases in a SQLite file every host can open
+        'tcp://HOST:PORT' leases held by the coordinator, which listens
+                          on HOST:PORT
+
+    The coordinator starts the queue afresh, workers attach to it. tcp
+    queues require an authkey, by default from $P2B_QUEUE_AUTHKEY.
+    """
+    if spec in (None, 'local'):
+        if not coordinator:
+            raise ValueError('workers need a shared queue, sqlite: or '
+                             'tcp://')
+        return LocalQueue(maxsize)
+
+    if spec.startswith('sqlite:'):
+        store = SqliteLeaseStore(spec[len('sqlite:'):])
+        if coordinator:
+            store.reset()
+        return LeaseQueue(store, maxsize, lease_seconds)
+
+    if spec.startswith('tcp://'):
+        authkey = authkey or os.environ.get(AUTHKEY_ENV)
+        if not authkey:
+            raise ValueError('tcp:// queues need an authkey, set '
+                             '${}'.format(AUTHKEY_ENV))
+
+        manager = QueueManager(address=_parse_address(spec),
+                               authkey=authkey.encode('utf-8'))
+        if coordinator:
+            manager.start()
+            logging.info('main_process: serving the work queue on '
+                         '{}'.format(spec))
+        else:
+            _connect(manager)
+        return LeaseQueue(manager.store(), maxsize, lease_seconds,
+                          manager=manager if coordinator else None)
+
+    raise ValueError('unknown work queue {}'.format(spec))
@@ -0,0 +1,46 @@
+import pytest
+
+from parquet2bigquery import lib
+from parquet2bigquery.manifest import Manifest
+
+
+@pytest.fixture
+def manifest(tmpdir):
+    return Manifest(str(tmpdir.join('manifest.db')))
+
+
+@pytest.fixture
+def listing(monkeypatch):
+    """
+    Replace the bucket listing by the records of a list, in glob_load
+    mode, or their object keys.
+    """
+    records = []
+
+    def _iter_latest_objects(bucket_name, prefix, **kwargs):
+        return iter(records)
+
+    def _iter_blobs_with_prefix(bucket_name, prefix, **kwargs):
+        return ((object_key, fingerprint)
+                for _, object_key, fingerprint, _ in records)
+
+    monkeypatch.setattr(lib, 'iter_latest_objects', _iter_latest_objects)
+    monkeypatch.setattr(lib, 'iter_blobs_with_prefix',
+                        _iter_blobs_with_prefix)
+    return records
+
+
+@pytest.fixture
+def loaded_paths(monkeypatch):
+    """
+    Replace the partitions loaded into BigQuery by those of a list.
+    """
+    paths = []
+    queried = []
+
+    def _get_loaded_paths(initial_object, dataset, alias, window=None):
+        queried.append(initial_object)
+        return list(paths)
+
+    monkeypatch.setattr(lib, 'get_loaded_paths', _get_loaded_paths)
+    return paths, queried
@@ -0,0 +1,71 @@
+import pytest
+
+from parquet2bigquery.inventory import Inventory
+
+
+KEYS = [
+    'table/v1/submission_date=20200101/part-0.parquet',
+    'table/v1/submission_date=20200101/part-1.parquet',
+    'table/v1/submission_date=20200102/part-0.parquet',
+    'table/v1/submission_date=20200102/',
+    'table/v1/submission_date=20200103/pärt-0.parquet',
+    'top-level',
+]
+
+
+def test_find():
+    inventory = Inventory.from_keys(KEYS)
+
+    assert [inventory.find(key) for key in KEYS] == list(range(len(KEYS)))
+    assert list(inventory) == KEYS
+    for key in ('table/v1/submission_date=20200101/part-2.parquet',
+                'table/v1/submission_date=20200104/part-0.parquet',
+                'table/v1/submission_date=20200101', 'top', ''):
+        assert key not in inventory
+
+
+def test_find_after_add():
+    inventory = Inventory.from_keys(KEYS[:2])
+    assert KEYS[2] not in inventory
+
+    inventory.add(KEYS[2])
+    assert inventory.find(KEYS[2]) == 2
+
+
+def test_fingerprints():
+    inventory = Inventory.from_records([
+        (KEYS[0], None),
+        (KEYS[1], (1, 10, 'AAAAAA==')),
+        (KEYS[2], (2, None, None)),
+    ])
+
+    assert inventory.fingerprint(0) is None
+    assert inventory.fingerprint(1) == (1, 10, 'AAAAAA==')
+    assert inventory.fingerprint(2) == (2, None, None)
+    assert inventory.size(0) == 0
+    assert inventory.size(1) == 10
+
+
+def test_latest():
+    inventory = Inventory()
+    inventory.add('table/v1/submission_date=20200101', objects=2,
+                  latest='table/v1/submission_date=20200101/part-1.parquet')
+    inventory.add('table/v1/submission_date=20200102', objects=1)
+
+    assert inventory.latest(0) == \
+        'table/v1/submission_date=20200101/part-1.parquet'
+    assert inventory.latest(1) == 'table/v1/submission_date=20200102'
+    assert inventory.objects(0) == 2
+
+    with pytest.raises(ValueError):
+        inventory.add('table/v1/submission_date=20200103',
+                      latest='table/v1/submission_date=20200104/part-0')
+    assert len(inventory) == 2
+
+
+def test_empty_columns_take_no_memory():
+    without = Inventory.from_keys(KEYS)
+    with_crc32c = Inventory.from_records((key, (1, 1, 'AAAAAA=='))
+                                         for key in KEYS)
+
+    assert with_crc32c.nbytes() - without.nbytes() == len(KEYS) * (4 + 8)
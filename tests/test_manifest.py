@@ -0,0 +1,39 @@
+from parquet2bigquery.manifest import STATE_APPENDED, STATE_QUEUED, Manifest
+
+
+def _manifest(tmpdir, keys, state=STATE_APPENDED):
+    manifest = Manifest(str(tmpdir.join('manifest.db')))
+    manifest.mark_many(keys, state)
+    return manifest
+
+
+def test_has_prefix_is_a_directory(tmpdir):
+    manifest = _manifest(tmpdir, ['t/v10/submission_date=20200101/a'])
+
+    assert manifest.has_prefix('t/v10')
+    assert manifest.has_prefix('t/v10/')
+    assert not manifest.has_prefix('t/v1')
+    assert not manifest.has_prefix('t/v1/')
+    assert manifest.has_prefix('')
+
+
+def test_has_prefix_glob_path(tmpdir):
+    manifest = _manifest(tmpdir, ['t/v1/submission_date=20200101'])
+
+    assert manifest.has_prefix('t/v1/submission_date=20200101')
+    assert not manifest.has_prefix('t/v1/submission_date=2020010')
+
+
+def test_iter_objects(tmpdir):
+    manifest = _manifest(tmpdir, ['t/v1/submission_date=20200101',
+                                  't/v1/submission_date=20200102/a',
+                                  't/v10/submission_date=20200101/a'])
+    manifest.mark_many(['t/v1/submission_date=20200103/a'], STATE_QUEUED)
+
+    assert [key for key, _ in manifest.iter_objects(
+        't/v1', STATE_APPENDED)] == ['t/v1/submission_date=20200101',
+                                     't/v1/submission_date=20200102/a']
+    assert [key for key, _ in manifest.iter_objects(
+        't/v1/submission_date=20200101', STATE_APPENDED)] == [
+            't/v1/submission_date=20200101']
+    assert manifest.counts('t/v1') == {STATE_APPENDED: 2, STATE_QUEUED: 1}
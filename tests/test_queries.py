@@ -0,0 +1,125 @@
+import threading
+
+from parquet2bigquery.lib import (construct_overwrite_query,
+                                  construct_select_query, overwrite_lock)
+from parquet2bigquery.locks import StripedLocks
+
+
+def _sql(query):
+    return ' '.join(query.split())
+
+
+def test_select_query():
+    query = construct_select_query('t_tmp', 'submission_date', '2020-01-01',
+                                   partitions=[('sample_id', '1')])
+
+    assert _sql(query) == ("SELECT *,CAST('2020-01-01' AS DATE) as "
+                           "submission_date,'1' as sample_id FROM tmp.t_tmp")
+
+
+def test_select_query_external():
+    query = construct_select_query('t_tmp', 'submission_date', '2020-01-01',
+                                   partitions=[], dataset=None)
+
+    assert _sql(query) == ("SELECT *,CAST('2020-01-01' AS DATE) as "
+                           "submission_date FROM t_tmp")
+
+
+def test_overwrite_query_keeps_other_slices():
+    query = construct_overwrite_query(
+        't_tmp', 't', 'telemetry',
+        ['a', 'b', 'submission_date', 'sample_id'],
+        ['a', 'b', 'submission_date', 'sample_id'],
+        'submission_date', '2020-01-01', partitions=[('sample_id', '1')])
+
+    assert _sql(query) == (
+        "SELECT a, b, submission_date, sample_id FROM ( "
+        "SELECT *,CAST('2020-01-01' AS DATE) as submission_date,"
+        "'1' as sample_id FROM tmp.t_tmp ) "
+        "UNION ALL "
+        "SELECT a, b, submission_date, sample_id FROM telemetry.t "
+        "WHERE submission_date = '2020-01-01' "
+        "AND NOT IFNULL(sample_id = '1', FALSE)")
+
+
+def test_overwrite_query_multiple_partitions():
+    query = construct_overwrite_query(
+        't_tmp', 't', 'telemetry', ['a', 'submission_date', 'x', 'y'],
+        ['a', 'submission_date', 'x', 'y'], 'submission_date', '2020-01-01',
+        partitions=[('x', '1'), ('y', 'b')])
+
+    assert _sql(query).endswith(
+        "WHERE submission_date = '2020-01-01' "
+        "AND NOT IFNULL(x = '1' AND y = 'b', FALSE)")
+
+
+def test_overwrite_query_missing_columns_are_null():
+    query = construct_overwrite_query(
+        't_tmp', 't', 'telemetry', ['a', 'b', 'submission_date'],
+        ['a', 'submission_date'], 'submission_date', '2020-01-01',
+        partitions=[])
+
+    assert _sql(query) == (
+        "SELECT a, NULL AS b, submission_date FROM ( "
+        "SELECT *,CAST('2020-01-01' AS DATE) as submission_date "
+        "FROM tmp.t_tmp )")
+    # without extra partitions the whole date partition is replaced
+    assert 'UNION ALL' not in query
+
+
+def _task(date, sample_id, overwrite=True):
+    return {
+        'dest_dataset': 'telemetry',
+        'table_id': 't',
+        'overwrite': overwrite,
+        'meta': {'date_partition': {'field': 'submission_date',
+                                    'value': date},
+                 'partitions': [('sample_id', sample_id)]},
+    }
+
+
+class _RecordingLocks(StripedLocks):
+
+    def __init__(self):
+        super(_RecordingLocks, self).__init__()
+        self.keys = []
+
+    def get(self, key):
+        self.keys.append(key)
+        return super(_RecordingLocks, self).get(key)
+
+
+def test_overwrite_lock_is_per_date_partition():
+    locks = _RecordingLocks()
+
+    for task in (_task('2020-01-01', '0'), _task('2020-01-01', '1'),
+                 _task('2020-01-02', '0'), _task('2020-01-02', '0', False)):
+        with overwrite_lock(task, locks):
+            pass
+
+    assert locks.keys == ['telemetry.t$20200101', 'telemetry.t$20200101',
+                          'telemetry.t$20200102']
+
+
+def test_overwrite_lock_serializes_slices():
+    locks = StripedLocks([threading.Lock() for _ in range(4)])
+    running = []
+    overlaps = []
+
+    def _overwrite(task):
+        with overwrite_lock(task, locks):
+            running.append(task)
+            if len(running) > 1:
+                overlaps.append(task)
+            threading.Event().wait(0.05)
+            running.remove(task)
+
+    threads = [threading.Thread(target=_overwrite,
+                                args=(_task('2020-01-01', str(i)),))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert overlaps == []
@@ -0,0 +1,52 @@
+from parquet2bigquery import lib
+from parquet2bigquery.manifest import STATE_APPENDED
+
+
+PREFIX = 't/v1'
+PATHS = ['t/v1/submission_date=20200101/sample_id=0',
+         't/v1/submission_date=20200101/sample_id=1',
+         't/v1/submission_date=20200102/sample_id=0',
+         't/v1/submission_date=20200102/sample_id=1']
+SHARDS = ['t/v1/submission_date=20200101/',
+          't/v1/submission_date=20200102/']
+
+
+def _items(manifest, window=None):
+    return [item['path'] for item in lib.iter_work_items(
+        'bucket', PREFIX, True, True, 'dataset', manifest=manifest,
+        window=window)]
+
+
+def test_cold_start_resumes_from_bigquery(manifest, listing, loaded_paths):
+    listing.extend((path, path + '/part-0.parquet') for path in PATHS)
+    loaded_paths[0].extend(PATHS[:3])
+
+    assert _items(manifest) == PATHS[3:]
+    assert [key for key, _ in manifest.iter_objects(
+        PREFIX, STATE_APPENDED)] == PATHS[:3]
+
+
+def test_warm_start_resumes_from_manifest(manifest, listing, loaded_paths):
+    listing.extend((path, path + '/part-0.parquet') for path in PATHS)
+    manifest.mark_many(PATHS[:1], STATE_APPENDED)
+
+    assert _items(manifest) == PATHS[1:]
+    assert loaded_paths[1] == []
+
+
+def test_window_resumes_new_partitions_from_bigquery(monkeypatch, manifest,
+                                                     listing, loaded_paths):
+    monkeypatch.setattr(lib, 'list_window_prefixes',
+                        lambda bucket_name, prefix, window: SHARDS)
+    listing.extend((path, path + '/part-0.parquet') for path in PATHS)
+    # an earlier run with a window of the first date only
+    manifest.mark_many(PATHS[:1], STATE_APPENDED)
+    # loaded before the manifest existed
+    loaded_paths[0].extend(PATHS[1:3])
+
+    window = {'start_date': '2020-01-01', 'end_date': '2020-01-02',
+              'dates': None}
+    # the manifest is trusted for the first date, BigQuery for the
+    # second one
+    assert _items(manifest, window) == [PATHS[1], PATHS[3]]
+    assert loaded_paths[1] == [PATHS[2]]
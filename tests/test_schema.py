@@ -0,0 +1,91 @@
+import google.api_core.exceptions
+from google.cloud import bigquery
+
+from parquet2bigquery import schema
+from parquet2bigquery.quota import TableQuotas
+
+
+class _Client(object):
+
+    def __init__(self, conflicts=0):
+        self.table = None
+        self.updates = 0
+        self.conflicts = conflicts
+
+    def dataset(self, dataset_id):
+        return bigquery.DatasetReference('project', dataset_id)
+
+    def get_table(self, table_ref):
+        if self.table is None:
+            raise google.api_core.exceptions.NotFound('table')
+        return bigquery.Table(self.table.reference, self.table.schema)
+
+    def create_table(self, table):
+        self.table = table
+        return table
+
+    def update_table(self, table, fields):
+        if self.conflicts:
+            self.conflicts -= 1
+            raise google.api_core.exceptions.PreconditionFailed('etag')
+        self.updates += 1
+        self.table = table
+        return table
+
+
+class _Pool(object):
+
+    def __init__(self, client):
+        self.bigquery = client
+
+
+def _fields(*names):
+    return [bigquery.SchemaField(name, 'STRING') for name in names]
+
+
+def _manager(monkeypatch, client, quotas=None):
+    monkeypatch.setattr(schema, 'get_client_pool', lambda: _Pool(client))
+    return schema.SchemaManager(quotas=quotas)
+
+
+def test_merge_schema(monkeypatch):
+    client = _Client()
+    manager = _manager(monkeypatch, client)
+
+    assert manager.merge_schema('t', 'd', _fields('a')) == _fields('a')
+    assert manager.merge_schema('t', 'd', _fields('b')) == _fields('a', 'b')
+    # cached, no API call
+    client.table = None
+    assert manager.merge_schema('t', 'd', _fields('a')) == _fields('a', 'b')
+    assert client.updates == 1
+
+
+def test_merge_schema_retries_conflicts(monkeypatch):
+    client = _Client(conflicts=2)
+    manager = _manager(monkeypatch, client)
+    manager.merge_schema('t', 'd', _fields('a'))
+
+    assert manager.merge_schema('t', 'd', _fields('b')) == _fields('a', 'b')
+    assert client.updates == 1
+
+
+def test_merge_schema_waits_for_quota_without_lock(monkeypatch):
+    client = _Client()
+    manager = _manager(monkeypatch, client,
+                       TableQuotas({'update': (1, 10)}))
+    manager.merge_schema('t', 'd', _fields('a'))
+    manager.merge_schema('t', 'd', _fields('b'))
+
+    waits = []
+
+    def _sleep(seconds):
+        waits.append(manager._locks.get('d.t').locked())
+        # the bucket is full again
+        manager.quotas._buckets.clear()
+
+    monkeypatch.setattr(schema.time, 'sleep', _sleep)
+
+    assert manager.merge_schema('t', 'd', _fields('c')) == _fields('a', 'b',
+                                                                   'c')
+    assert waits == [False]
+    assert client.updates == 2
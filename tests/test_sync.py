@@ -0,0 +1,112 @@
+import pytest
+
+from parquet2bigquery import lib
+from parquet2bigquery.manifest import (STATE_APPENDED, STATE_LOADED_TMP,
+                                       STATE_QUEUED)
+
+
+PREFIX = 't/v1'
+PATHS = ['t/v1/submission_date=20200101/sample_id=0',
+         't/v1/submission_date=20200101/sample_id=1',
+         't/v1/submission_date=20200102/sample_id=0']
+
+
+def _record(path, generation=1):
+    return (path, path + '/part-0.parquet', (generation, 10, 'crc'), 1)
+
+
+def _changed(records, manifest):
+    return [(record[0], changed) for record, changed in
+            lib.filter_changed_objects(records, manifest, PREFIX)]
+
+
+def test_filter_changed_objects(manifest):
+    manifest.mark_objects([(PATHS[0], (1, 10, 'crc'))], STATE_APPENDED)
+    manifest.mark_objects([(PATHS[1], (1, 10, 'crc'))], STATE_APPENDED)
+
+    assert _changed([_record(PATHS[0]), _record(PATHS[1], 2),
+                     _record(PATHS[2])], manifest) == [(PATHS[1], True),
+                                                       (PATHS[2], False)]
+
+
+def test_filter_changed_objects_adopts_fingerprints(manifest):
+    # appended by a run without sync
+    manifest.mark_many([PATHS[0]], STATE_APPENDED)
+
+    assert _changed([_record(PATHS[0])], manifest) == []
+    assert list(manifest.iter_objects(PREFIX, STATE_APPENDED)) == [
+        (PATHS[0], (1, 10, 'crc'))]
+    assert _changed([_record(PATHS[0], 2)], manifest) == [(PATHS[0], True)]
+
+
+@pytest.mark.parametrize('state', [STATE_QUEUED, STATE_LOADED_TMP])
+def test_unfinished_overwrite_is_still_changed(manifest, state):
+    manifest.mark_objects([(PATHS[0], (1, 10, 'crc'))], STATE_APPENDED)
+    assert _changed([_record(PATHS[0], 2)], manifest) == [(PATHS[0], True)]
+
+    # the overwrite is queued again but never appended
+    manifest.mark_objects([(PATHS[0], None)], state)
+
+    assert _changed([_record(PATHS[0], 2)], manifest) == [(PATHS[0], True)]
+
+
+def _items(manifest, glob_load=True, **kwargs):
+    return [(item['path'] or item['object_key'], item['overwrite'])
+            for item in lib.iter_work_items(
+                'bucket', PREFIX, glob_load, False, 'dataset',
+                manifest=manifest, sync=True, sync_overwrite=glob_load,
+                **kwargs)]
+
+
+def test_sync_cold_start_skips_loaded_partitions(manifest, listing,
+                                                 loaded_paths):
+    listing.extend(_record(path) for path in PATHS)
+    loaded_paths[0].extend(PATHS[:2])
+
+    assert _items(manifest) == [(PATHS[2], False)]
+    # the partitions found in BigQuery are recorded with the fingerprint
+    # of the listing, the next sync is warm and doesn't query BigQuery
+    assert list(manifest.iter_objects(PREFIX, STATE_APPENDED)) == [
+        (path, (1, 10, 'crc')) for path in PATHS[:2]]
+
+    del loaded_paths[1][:]
+    listing[0] = _record(PATHS[0], 2)
+    assert _items(manifest) == [(PATHS[0], True), (PATHS[2], False)]
+    assert loaded_paths[1] == []
+
+
+def test_sync_cold_start_without_glob_load(manifest, listing,
+                                           loaded_paths):
+    listing.extend(_record(path) for path in PATHS)
+    loaded_paths[0].append(PATHS[0])
+
+    assert _items(manifest, glob_load=False) == [
+        (PATHS[1] + '/part-0.parquet', False),
+        (PATHS[2] + '/part-0.parquet', False)]
+
+
+def test_sync_skips_changed_objects_without_glob_load(manifest, listing,
+                                                      loaded_paths):
+    listing.extend(_record(path) for path in PATHS)
+    manifest.mark_objects([(record[1], record[2]) for record in listing],
+                          STATE_APPENDED)
+
+    listing[0] = _record(PATHS[0], 2)
+    listing.append(_record('t/v1/submission_date=20200103/sample_id=0'))
+
+    assert _items(manifest, glob_load=False) == [
+        ('t/v1/submission_date=20200103/sample_id=0/part-0.parquet', False)]
+    assert loaded_paths[1] == []
+
+
+def test_check_write_options():
+    lib.check_write_options(True, 'manifest', sync=True, sync_overwrite=True)
+    lib.check_write_options(False, 'manifest', sync=True)
+
+    with pytest.raises(ValueError):
+        lib.check_write_options(True, None, sync=True, sync_overwrite=True)
+    with pytest.raises(ValueError):
+        lib.check_write_options(True, 'manifest', sync=True)
+    with pytest.raises(ValueError):
+        lib.check_write_options(False, 'manifest', sync=True,
+                                sync_overwrite=True)